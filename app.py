@@ -1,22 +1,41 @@
-from flask import Flask, request, render_template, redirect, url_for, jsonify
-from flask_mongoengine import MongoEngine, MongoEngineSessionInterface
+from flask import Flask, request, render_template, redirect, url_for, jsonify, abort, Markup
+from flask_mongoengine import MongoEngine
 from flask_login import LoginManager, login_user, current_user, login_required, logout_user
 from forms import SignupForm, SigninForm, CreateNewCircleForm, CreateNewPostForm
 from models import User as DbUser
-from models import Circle, Post, Comment
-from utils import flash_error, redirect_back
+from models import Circle, Post, Comment, TimelineEntry, SearchEntry, cache
+from utils import flash_error, redirect_back, parse_cursor
 from os import urandom
+from datetime import timedelta
 import os
 import sys
 from pymongo.uri_parser import parse_uri
+from bson.objectid import ObjectId
 from custom_exceptions import UnauthorizedAccess
+from hashing import hasher, DEFAULT_METHOD as DEFAULT_PASSWORD_HASH_METHOD
+from ratelimit import sign_in_throttle
 from flask_restful import Api
-from resources.user import UserList, Me
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+from resources.user import UserList, User, Me
+from resources.post import PostList, Post as PostResource
+from resources.comment import CommentList
+from resources.search import SearchResults
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_refresh_token_required
+from auth import init_app as init_tokens, token_user
+from migrations import migrate_comment_threads, backfill_snapshots, reconcile_counters, collect_garbage
+from indexes import index_report
+from cleanup import cleaner
+from transfer import export_documents, import_documents
+from sessions import create_session_interface, regenerate_on_sign_in
+from instrumentation import Instrumentation
+from fragments import post_cards, post_card_key
+import click
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
-app.secret_key = urandom(24)
+# Must be shared by all workers when sessions are stored in signed cookies
+app.secret_key = os.environ.get('SECRET_KEY') or urandom(24)
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
 login_manager.init_app(app)
@@ -26,13 +45,58 @@ app.config['MONGODB_SETTINGS'] = {
     'db': mongodb_db,
     'host': mongodb_uri
 }
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+# Before MongoEngine, so that the Mongo client reports its commands to it
+instrumentation = Instrumentation(app)
 db = MongoEngine(app)
-app.session_interface = MongoEngineSessionInterface(db)
+# 'read' computes the home feed from all visible posts on every view, 'timeline' reads per-user timelines written on post
+app.config['FEED_MODE'] = os.environ.get('FEED_MODE', 'read')
+TimelineEntry.enabled = app.config['FEED_MODE'] == 'timeline'
+app.config['CACHE_MAX_SIZE'] = int(os.environ.get('CACHE_MAX_SIZE', 10000))
+app.config['CACHE_TTL_SECONDS'] = float(os.environ.get('CACHE_TTL_SECONDS', 30))
+cache.configure(app.config['CACHE_MAX_SIZE'], app.config['CACHE_TTL_SECONDS'])
+instrumentation.gauges['cache_hits'] = lambda: cache.hits
+instrumentation.gauges['cache_misses'] = lambda: cache.misses
+instrumentation.gauges['cache_size'] = lambda: len(cache.local)
+# Rendered post cards, in bytes of their UTF-8 encoding
+app.config['POST_CARD_CACHE_MAX_BYTES'] = int(os.environ.get('POST_CARD_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+post_cards.max_bytes = app.config['POST_CARD_CACHE_MAX_BYTES']
+instrumentation.gauges['post_card_cache_hits'] = lambda: post_cards.hits
+instrumentation.gauges['post_card_cache_misses'] = lambda: post_cards.misses
+instrumentation.gauges['post_card_cache_bytes'] = lambda: post_cards.size
+# Password hashing runs in its own processes, sign ins beyond workers + queue size are rejected with 503
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 1))
+app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 8))
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_PASSWORD_HASH_METHOD)
+hasher.configure(
+    app.config['PASSWORD_HASH_WORKERS'],
+    app.config['PASSWORD_HASH_QUEUE_SIZE'],
+    app.config['PASSWORD_HASH_METHOD'])
+# Sign in attempts are limited by token buckets per client IP and per user id, rejected ones get 429 with Retry-After
+app.config['SIGN_IN_USER_BURST'] = float(os.environ.get('SIGN_IN_USER_BURST', 10))
+app.config['SIGN_IN_USER_PER_MINUTE'] = float(os.environ.get('SIGN_IN_USER_PER_MINUTE', 5))
+app.config['SIGN_IN_IP_BURST'] = float(os.environ.get('SIGN_IN_IP_BURST', 30))
+app.config['SIGN_IN_IP_PER_MINUTE'] = float(os.environ.get('SIGN_IN_IP_PER_MINUTE', 30))
+sign_in_throttle.configure(
+    app.config['SIGN_IN_USER_BURST'],
+    app.config['SIGN_IN_USER_PER_MINUTE'],
+    app.config['SIGN_IN_IP_BURST'],
+    app.config['SIGN_IN_IP_PER_MINUTE'])
+instrumentation.gauges['sign_ins_throttled'] = lambda: sign_in_throttle.rejected
+# Deletes hide documents right away and purge them with what references them in a background thread
+app.config['CLEANUP_IN_BACKGROUND'] = os.environ.get('CLEANUP_IN_BACKGROUND', 'true') == 'true'
+cleaner.configure(app.config['CLEANUP_IN_BACKGROUND'])
+# Event stream of async_api, e.g. http://localhost:5001/api/events, pages update themselves from it when set
+app.config['EVENTS_URL'] = os.environ.get('EVENTS_URL')
+# 'cookie', 'memory' or 'mongo', see sessions.create_session_interface
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'mongo')
+app.session_interface = create_session_interface(app.config['SESSION_BACKEND'], db)
+regenerate_on_sign_in(app)
 
 
 @login_manager.user_loader
 def load_user(loaded_id):
-    return DbUser.objects.get(id=loaded_id)
+    return DbUser.get(loaded_id)
 
 
 @app.context_processor
@@ -43,19 +107,70 @@ def inject_user():
 user = current_user  # type: Me
 
 
+@app.template_global()
+def render_post_card(post):
+    """
+    Render cards/_post.jinja2 for the current user, or reuse an earlier rendering
+    :param (Post) post: the post, prefetched
+    :return (Markup): the card
+    """
+    def render():
+        card_template = app.jinja_env.get_template('cards/_post.jinja2')
+        return card_template.make_module({'user': current_user, 'request': request}).render_post(post)
+
+    return Markup(post_cards.get_or_render(post.id, _post_card_key(post), render))
+
+
+def _post_card_key(post):
+    return post_card_key(user, post, request.args.get('next', request.path))
+
+
+def prefetch_post_cards(posts):
+    """
+    Prefetch the posts whose cards render_post_card will render, cached cards need nothing loaded
+    A card evicted in between is still rendered right, its references are then loaded one by one
+    :param (list[Post]) posts: the posts of the page
+    """
+    Post.prefetch([post for post in posts if not post_cards.has(post.id, _post_card_key(post))])
+
+
+@app.template_global()
+def events_token():
+    """
+    :return (str): an access token for the event stream of the signed in user, see EVENTS_URL
+    """
+    return create_access_token(identity=user._get_current_object())
+
+
+@app.route('/events-token')
+@login_required
+def new_events_token():
+    """
+    A new token for the event stream, for pages whose token expired or was revoked while they were open
+    """
+    return jsonify(token=events_token())
+
+
 @app.route('/')
 def index():
     if not current_user.is_authenticated:
         return render_template('signin.jinja2', form=SigninForm())
     else:
-        create_new_post_form = CreateNewPostForm(Circle.objects(owner=user.id))
-        return render_template('index.jinja2', form=create_new_post_form, posts=user.sees_posts())
+        create_new_post_form = CreateNewPostForm(user.owned_circles())
+        before = parse_cursor(request.args.get('before'))
+        if TimelineEntry.enabled:
+            posts, next_cursor = user.timeline_page(before)
+        else:
+            posts, next_cursor = user.sees_posts_page(before=before)
+        prefetch_post_cards(posts)
+        return render_template('index.jinja2', form=create_new_post_form, posts=posts, next_cursor=next_cursor)
 
 
 @app.route('/signin', methods=['POST'])
 def signin():
     signin_form = SigninForm(request.form)
     if signin_form.validate():
+        sign_in_throttle.check(signin_form.id.data, request.remote_addr)
         found_user = DbUser.check(signin_form.id.data, signin_form.password.data)
         if found_user:
             login_user(found_user, remember=True)
@@ -89,12 +204,14 @@ def unauthorized(error):
 @app.route('/add-post', methods=['POST'])
 @login_required
 def add_post():
-    create_new_post_form = CreateNewPostForm(Circle.objects(owner=user.id), request.form)
+    owned_circles = user.owned_circles()
+    create_new_post_form = CreateNewPostForm(owned_circles, request.form)
     if create_new_post_form.validate():
+        circle_ids = set(create_new_post_form.circles.data)
         user.create_post(
             create_new_post_form.content.data,
             create_new_post_form.is_public.data,
-            create_new_post_form.circles.data)
+            [circle for circle in owned_circles if circle.id in circle_ids])
     create_new_post_form.flash_all_errors()
     return redirect_back(request, url_for('index'))
 
@@ -151,6 +268,38 @@ def rm_nested_comment():
     return redirect_back(request, url_for('index'))
 
 
+@app.route('/posts/<post_id>/comments')
+@login_required
+def comments(post_id):
+    """
+    A page of comments of a post, or of replies to a comment, rendered to replace a "Show more" link
+    """
+    post = Post.objects(id=post_id).first() if ObjectId.is_valid(post_id) else None
+    if not post or not user.sees_post(post):
+        abort(404)
+    parent_comment = None
+    if request.args.get('parent'):
+        parent_comment = Comment.objects(id=parse_cursor(request.args['parent']), post=post.id).first()
+        if not parent_comment:
+            abort(404)
+    page, next_cursor = Comment.load_page(post, parent_comment, parse_cursor(request.args.get('after')))
+    return render_template(
+        'comments.jinja2', post=post, parent_comment=parent_comment, comments=page, next_cursor=next_cursor)
+
+
+@app.route('/posts/<post_id>/card')
+@login_required
+def post_card(post_id):
+    """
+    The card of a post, rendered to be inserted into a page that an event told about it
+    """
+    post = Post.objects(id=post_id).first() if ObjectId.is_valid(post_id) else None
+    if not post or not user.sees_post(post):
+        abort(404)
+    prefetch_post_cards([post])
+    return render_post_card(post)
+
+
 @app.route('/signout')
 @login_required
 def signout():
@@ -161,17 +310,22 @@ def signout():
 @app.route('/users')
 @login_required
 def users():
+    query = request.args.get('q', '').strip()
+    listed_users, next_cursor = user.directory_page(query, request.args.get('after') or None)
     return render_template(
         'users.jinja2',
-        users=DbUser.objects(id__ne=user.id),
-        circles=Circle.objects(owner=user.id))
+        query=query,
+        users=listed_users,
+        next_cursor=next_cursor,
+        circles=user.owned_circles(),
+        memberships=user.circle_memberships(listed_users))
 
 
 @app.route('/circles')
 @login_required
 def circles():
     form = CreateNewCircleForm()
-    return render_template('circles.jinja2', form=form, circles=Circle.objects(owner=user.id))
+    return render_template('circles.jinja2', form=form, circles=user.owned_circles())
 
 
 @app.route('/add-circle', methods=['POST'])
@@ -186,6 +340,19 @@ def add_circle():
     return redirect_back(request, url_for('index'))
 
 
+@app.route('/rename-circle', methods=['POST'])
+@login_required
+def rename_circle():
+    circle = Circle.objects.get(id=request.form.get('id'))
+    rename_circle_form = CreateNewCircleForm(request.form)
+    if rename_circle_form.validate():
+        new_circle_name = rename_circle_form.name.data
+        if not user.rename_circle(circle, new_circle_name):
+            flash_error('{} already exists'.format(new_circle_name))
+    rename_circle_form.flash_all_errors()
+    return redirect_back(request, url_for('circles'))
+
+
 @app.route('/toggle-member', methods=['POST'])
 @login_required
 def toggle_member():
@@ -206,16 +373,39 @@ def rm_circle():
 @app.route('/profile/<user_id>')
 @login_required
 def public_profile(user_id):
-    profile_user = DbUser.objects.get(user_id=user_id)
-    return render_template('profile.jinja2', profile_user=profile_user, posts=user.sees_posts(profile_user))
+    profile_user = DbUser.find(user_id)
+    if not profile_user:
+        abort(404)
+    posts, next_cursor = user.sees_posts_page(profile_user, parse_cursor(request.args.get('before')))
+    prefetch_post_cards(posts)
+    return render_template('profile.jinja2', profile_user=profile_user, posts=posts, next_cursor=next_cursor)
+
+
+@app.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 0, type=int), 0)
+    results, has_more = user.search(query, page)
+    prefetch_post_cards([post for post, _ in results])
+    return render_template('search.jinja2', query=query, page=page, results=results, has_more=has_more)
+
+
+@app.route('/cache-stats')
+@login_required
+def cache_stats():
+    return jsonify(cache.stats)
 
 
 ##################
 # Authentication #
 ##################
-app.config['JWT_SECRET_KEY'] = '123456'  # TODO: read from env
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False
-JWTManager(app)
+# Shared with async_api, which accepts the same tokens
+app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', '123456')
+# Access tokens carry the object id and membership version of their user and are checked against the cache, see auth.py
+app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=float(os.environ.get('ACCESS_TOKEN_MINUTES', 15)))
+app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=float(os.environ.get('REFRESH_TOKEN_DAYS', 30)))
+init_tokens(app)
 
 
 @app.route('/api/auth', methods=['POST'])
@@ -228,11 +418,23 @@ def auth():
         return jsonify({"message": {"id": "id is required"}}), 400
     if not password:
         return jsonify({"message": {"password": "password is required"}}), 400
+    sign_in_throttle.check(id, request.remote_addr)
     user_checked = DbUser.check(id, password)
     if not user_checked:
         return jsonify({"message": "invalid id or password"}), 401
-    access_token = create_access_token(identity=id)
-    return jsonify(access_token=access_token), 200
+    return jsonify(
+        access_token=create_access_token(identity=user_checked),
+        refresh_token=create_refresh_token(identity=user_checked)), 200
+
+
+@app.route('/api/refresh', methods=['POST'])
+@jwt_refresh_token_required
+def refresh():
+    claimed_user = token_user()
+    found_user = DbUser.get(claimed_user.id) if claimed_user else None
+    if not found_user:
+        return jsonify({"message": "user not found"}), 401
+    return jsonify(access_token=create_access_token(identity=found_user)), 200
 
 
 ########
@@ -241,9 +443,124 @@ def auth():
 app.config['BUNDLE_ERRORS'] = True
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-api = Api(app)
+
+class TokenErrorsApi(Api):
+    """
+    flask_restful answers every exception of a resource with a 500,
+        token errors fall through to the handlers of flask_jwt_extended instead, e.g. 401 for an expired token
+    """
+
+    def handle_error(self, e):
+        if isinstance(e, (JWTExtendedException, PyJWTError)):
+            raise e
+        return super(TokenErrorsApi, self).handle_error(e)
+
+
+api = TokenErrorsApi(app)
 api.add_resource(UserList, '/api/users')
+api.add_resource(User, '/api/users/<user_id>')
 api.add_resource(Me, '/api/me')
+api.add_resource(PostList, '/api/posts')
+api.add_resource(PostResource, '/api/posts/<post_id>')
+api.add_resource(CommentList, '/api/posts/<post_id>/comments')
+api.add_resource(SearchResults, '/api/search')
+
+############
+# Commands #
+############
+@app.cli.command('migrate-comments')
+def migrate_comments():
+    """Convert comment lists into materialized comment threads."""
+    click.echo('Migrated {} comments'.format(migrate_comment_threads()))
+
+
+@app.cli.command('backfill-snapshots')
+def backfill_snapshots_command():
+    """Write the author and circle snapshots of posts and comments, and repair stale ones."""
+    click.echo('Updated {} posts and comments'.format(backfill_snapshots()))
+
+
+@app.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Rebuild the timelines of all users for FEED_MODE=timeline."""
+    click.echo('Fanned out {} posts'.format(TimelineEntry.backfill()))
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Rebuild the search index from all posts and comments."""
+    click.echo('Indexed {} posts and comments'.format(SearchEntry.rebuild()))
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute comment, post and circle counters and repair the ones that drifted."""
+    click.echo('Repaired {} documents'.format(reconcile_counters()))
+
+
+@app.cli.command('collect-garbage')
+def collect_garbage_command():
+    """Purge tombstones left behind and delete orphaned comments."""
+    collected = collect_garbage()
+    click.echo('Purged {} tombstones, deleted {} orphaned comments'.format(
+        collected['tombstones'], collected['orphaned_comments']))
+
+
+@app.cli.command('ensure-indexes')
+@click.option('--dry-run', is_flag=True, help='Only report, create no index.')
+def ensure_indexes(dry_run):
+    """Create the indexes that the models declare, and report undeclared and unused ones."""
+    report = index_report(create=not dry_run)
+    for entry in report:
+        click.echo('{collection}: {status} {index}'.format(**entry))
+    if not report:
+        click.echo('All declared indexes exist')
+    if dry_run and any(entry['status'] == 'missing' for entry in report):
+        raise click.ClickException('indexes are missing')
+
+
+@app.cli.command('delete-user')
+@click.argument('user_id')
+def delete_user(user_id):
+    """Delete a user with their posts, comments and circles."""
+    found_user = DbUser.find(user_id)
+    if not found_user:
+        raise click.ClickException('no user {}'.format(user_id))
+    found_user.delete_account()
+    cleaner.wait()
+    click.echo('Deleted {}'.format(user_id))
+
+
+def _echo_progress(collection, count, seconds):
+    click.echo('{}: {} documents, {:.0f}/s'.format(collection, count, count / seconds if seconds else 0), err=True)
+
+
+@app.cli.command('export-data')
+@click.argument('output', type=click.File('w'), default='-')
+def export_data(output):
+    """Write users, circles, posts and comments as NDJSON to OUTPUT, stdout by default."""
+    counts = export_documents(output, _echo_progress)
+    click.echo('Exported {} documents'.format(sum(counts.values())), err=True)
+
+
+@app.cli.command('import-data')
+@click.argument('input', type=click.File('r'), default='-')
+def import_data(input):
+    """Insert users, circles, posts and comments from NDJSON written by export-data, stdin by default."""
+    try:
+        counts = import_documents(input, _echo_progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for collection, collection_counts in counts.items():
+        click.echo('{}: inserted {inserted}, skipped {skipped} already imported, remapped {remapped} to existing'.format(
+            collection, **collection_counts), err=True)
+    click.echo('Repaired {} counters'.format(reconcile_counters()), err=True)
+    # circles remapped to existing ones are keyed by their old ids in the snapshots of their posts
+    click.echo('Updated {} snapshots'.format(backfill_snapshots()), err=True)
+    click.echo('Indexed {} posts and comments'.format(SearchEntry.rebuild()), err=True)
+    if TimelineEntry.enabled:
+        click.echo('Fanned out {} posts'.format(TimelineEntry.backfill()), err=True)
+
 
 if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'c9':
@@ -0,0 +1,610 @@
+"""
+Asynchronous JSON API, for clients that hold many connections open at once
+
+    python -m async_api [--host localhost] [--port 5001]
+
+Reads go through motor, so a request that waits on the database holds no thread.
+They use the same visibility and paging queries as models.py, see visibility_query and Comment.page_query.
+Writes run the methods of models.py in a small thread pool, so that counters, the search index, timelines and caches
+    are kept up to date by the same code as in the Flask app.
+Accepts the access tokens issued by /api/auth of the Flask app, both read JWT_SECRET_KEY from the environment.
+/api/events streams what changes to the viewers who can see it, as Server-Sent Events, see events
+"""
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import jwt
+from aiohttp import web
+from bson.objectid import ObjectId
+from mongoengine import connect
+from auth import claimed_user, USER_CLAIMS
+from cache import LRUCache, MISSING
+from custom_exceptions import UnauthorizedAccess
+from events import events, MEMBERSHIPS_CHANGED
+from models import User, Circle, Post, Comment, POSTS_PER_PAGE, REPLIES_PER_COMMENT
+from models import visibility_query, _reference_id, _reference_ids, _hydrate_reference, _hydrate_author_snapshots
+from resources.post import serialize_post, MAX_POSTS_PER_PAGE
+from resources.comment import serialize_comment, MAX_COMMENTS_PER_PAGE
+from utils import parse_cursor
+
+DEFAULT_JWT_SECRET_KEY = '123456'
+# Claims of the access tokens of flask_jwt_extended
+JWT_IDENTITY_CLAIM = 'identity'
+JWT_ALGORITHM = 'HS256'
+# Membership versions of the users of recent requests are kept this long, unless a membership event drops them first
+MEMBERSHIP_VERSIONS_MAX_SIZE = 100000
+MEMBERSHIP_VERSIONS_TTL_SECONDS = 30
+# Threads that run writes through models.py
+WRITE_THREADS = 8
+NOT_DELETED = {'deleted': {'$ne': True}}
+# Paths that also take the access token as ?token=, since browsers cannot set headers on an EventSource
+QUERY_TOKEN_PATHS = {'/api/events'}
+# Seconds between comments written to idle event streams, which keep proxies from closing them
+HEARTBEAT_SECONDS = 15
+# An event stream that falls this many events behind is closed, its client reconnects and reloads
+MAX_PENDING_EVENTS = 100
+
+routes = web.RouteTableDef()
+
+
+def _error(status, message):
+    """
+    :return (web.HTTPException): an error response with a JSON body, in the format of the Flask API
+    """
+    return status(text=json.dumps({'message': message}), content_type='application/json')
+
+
+def _limit(request, default, maximum):
+    try:
+        return min(max(int(request.query.get('limit', default)), 1), maximum)
+    except ValueError:
+        raise _error(web.HTTPBadRequest, {'limit': 'invalid literal for int()'})
+
+
+async def _json_body(request, *required):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise _error(web.HTTPBadRequest, 'body is not JSON')
+    if not isinstance(body, dict):
+        raise _error(web.HTTPBadRequest, 'body is not a JSON object')
+    for field in required:
+        if not body.get(field):
+            raise _error(web.HTTPBadRequest, {field: 'Missing required parameter in the JSON body'})
+    return body
+
+
+def _collection(request, document_class):
+    return request.app['db'][document_class._get_collection_name()]
+
+
+async def _run_model(request, fn, *args):
+    """
+    Run a synchronous models.py call in the write thread pool
+    """
+    return await asyncio.get_running_loop().run_in_executor(request.app['writer'], partial(fn, *args))
+
+
+def _model_user(request):
+    """
+    :return (User): the signed in user, loaded through models.py, to be called in the write thread pool
+    """
+    user = User.find(request['user_id'])
+    if not user:
+        raise _error(web.HTTPNotFound, 'user not found')
+    return user
+
+
+@web.middleware
+async def allow_cross_origin(request, handler):
+    """
+    Answer preflight requests from any origin, like the CORS settings of the Flask API
+    """
+    if request.method == 'OPTIONS':
+        return web.Response(headers={
+            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE',
+            'Access-Control-Allow-Headers': 'Authorization, Content-Type'
+        })
+    return await handler(request)
+
+
+async def _allow_origin(request, response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+async def _membership_version(request, user_object_id):
+    """
+    :return (int|None): the membership version of a user, None if they are deleted,
+        kept in memory until it expires or the user's memberships change, see EventHub
+    """
+    versions = request.app['membership_versions']
+    version = versions.get(user_object_id)
+    if version is MISSING:
+        user = await _collection(request, User).find_one(
+            dict(NOT_DELETED, _id=user_object_id), {'membership_version': 1})
+        version = user.get('membership_version', 0) if user is not None else None
+        versions.set(user_object_id, version)
+    return version
+
+
+@web.middleware
+async def authenticate(request, handler):
+    """
+    Check the access token of every request, and put the user id and object id of the signed in user on the request
+    Both come from the claims of the token, which is revoked like in auth.is_revoked, without a query on a warm cache
+    Errors are returned with the status codes of flask_jwt_extended
+    """
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        token = header[len('Bearer '):]
+    elif request.path in QUERY_TOKEN_PATHS and request.query.get('token'):
+        token = request.query['token']
+    else:
+        return web.json_response({'msg': 'Missing Authorization Header'}, status=401)
+    try:
+        claims = jwt.decode(token, request.app['jwt_secret_key'], algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        return web.json_response({'msg': 'Token has expired'}, status=401)
+    except jwt.InvalidTokenError as e:
+        return web.json_response({'msg': str(e)}, status=422)
+    if claims.get('type') != 'access' or JWT_IDENTITY_CLAIM not in claims:
+        return web.json_response({'msg': 'Only access tokens are allowed'}, status=422)
+    user = claimed_user(claims[JWT_IDENTITY_CLAIM], claims.get(USER_CLAIMS))
+    if user is None or await _membership_version(request, user.id) != user.membership_version:
+        return web.json_response({'msg': 'Token has been revoked'}, status=401)
+    request['user_id'] = user.user_id
+    request['user_object_id'] = user.id
+    return await handler(request)
+
+
+@web.middleware
+async def forbid_unauthorized_access(request, handler):
+    try:
+        return await handler(request)
+    except UnauthorizedAccess:
+        raise _error(web.HTTPForbidden, 'unauthorized access')
+
+
+async def _find_member_circle_ids(database, user_id):
+    """
+    :return (list[ObjectId]): ids of the circles that a user is a member of
+    """
+    circles = database[Circle._get_collection_name()].find(dict(NOT_DELETED, members=user_id), {'_id': 1})
+    return [circle['_id'] async for circle in circles]
+
+
+async def _member_circle_ids(request):
+    """
+    :return (list[ObjectId]): ids of the circles that the signed in user is a member of
+    """
+    return await _find_member_circle_ids(request.app['db'], request['user_object_id'])
+
+
+async def _visible_post(request, post_id):
+    """
+    :return (Post): a post that the signed in user can see, not hydrated
+    :raise (web.HTTPNotFound) when there is no such post
+    """
+    post_id = parse_cursor(post_id)
+    query = {'$and': [
+        dict(NOT_DELETED, _id=post_id),
+        visibility_query(request['user_object_id'], await _member_circle_ids(request))
+    ]}
+    son = await _collection(request, Post).find_one(query) if post_id else None
+    if son is None:
+        raise _error(web.HTTPNotFound, 'post not found')
+    return Post._from_son(son)
+
+
+async def _hydrate_authors(request, documents):
+    """
+    Hydrate the authors of posts or comments from their snapshots, and load the ones without a snapshot with one query
+    """
+    documents = _hydrate_author_snapshots(documents)
+    author_ids = list({_reference_id(document, 'author') for document in documents})
+    if not author_ids:
+        return
+    users = _collection(request, User).find({'_id': {'$in': author_ids}}, {'user_id': 1})
+    loaded = {son['_id']: User._from_son(son) async for son in users}
+    for document in documents:
+        _hydrate_reference(document, 'author', loaded)
+
+
+async def _load_comments(request, query, limit):
+    """
+    Load a page of comments at one level of a thread, and whether each of them has replies, with one query each
+    :return (list[Comment], ObjectId|None): the comments, and the cursor for the next page
+    """
+    comments = _collection(request, Comment).find(dict(NOT_DELETED, **query)).sort('_id', 1).limit(limit + 1)
+    comments = [Comment._from_son(son) async for son in comments]
+    next_cursor = comments[limit - 1].id if len(comments) > limit else None
+    comments = comments[:limit]
+    if comments:
+        depth = len(query['ancestors'])
+        with_replies = _collection(request, Comment).aggregate([
+            {'$match': dict(NOT_DELETED, post=query['post'], **{'ancestors.{}'.format(depth): {'$in': [c.id for c in comments]}})},
+            {'$group': {'_id': {'$arrayElemAt': ['$ancestors', depth]}}}
+        ])
+        parent_ids = {group['_id'] async for group in with_replies}
+        for comment in comments:
+            comment._has_more_comments = comment.id in parent_ids
+        await _hydrate_authors(request, comments)
+    return comments, next_cursor
+
+
+# Users
+
+
+@routes.get('/api/me')
+async def me(request):
+    return web.json_response({'id': request['user_id']})
+
+
+# Posts
+
+
+@routes.get('/api/feed')
+async def feed(request):
+    """
+    A page of the posts that the signed in user can see, like /api/posts of the Flask API
+    """
+    limit = _limit(request, POSTS_PER_PAGE, MAX_POSTS_PER_PAGE)
+    query = dict(NOT_DELETED, **visibility_query(request['user_object_id'], await _member_circle_ids(request)))
+    before = parse_cursor(request.query.get('before'))
+    if before is not None:
+        query['_id'] = {'$lt': before}
+    posts = _collection(request, Post).find(query).sort('_id', -1).limit(limit + 1)
+    posts = [Post._from_son(son) async for son in posts]
+    next_cursor = posts[limit - 1].id if len(posts) > limit else None
+    posts = posts[:limit]
+    await _hydrate_authors(request, posts)
+    return web.json_response({
+        'posts': [serialize_post(post) for post in posts],
+        'nextCursor': str(next_cursor) if next_cursor else None
+    })
+
+
+@routes.get('/api/posts/{post_id}')
+async def get_post(request):
+    post = await _visible_post(request, request.match_info['post_id'])
+    await _hydrate_authors(request, [post])
+    return web.json_response(serialize_post(post))
+
+
+@routes.post('/api/posts')
+async def create_post(request):
+    """
+    Create a post, shared with the circles of the signed in user whose ids are in circles
+    """
+    body = await _json_body(request, 'content')
+    circle_ids = {str(circle_id) for circle_id in body.get('circles') or []}
+
+    def create():
+        user = _model_user(request)
+        circles = [circle for circle in user.owned_circles() if str(circle.id) in circle_ids]
+        post = user.create_post(body['content'], bool(body.get('isPublic')), circles)
+        post.author = user
+        return serialize_post(post)
+
+    return web.json_response(await _run_model(request, create), status=201)
+
+
+@routes.delete('/api/posts/{post_id}')
+async def delete_post(request):
+    post = await _visible_post(request, request.match_info['post_id'])
+
+    def delete():
+        _model_user(request).delete_post(post)
+
+    await _run_model(request, delete)
+    return web.Response(status=204)
+
+
+# Comments
+
+
+@routes.get('/api/posts/{post_id}/comments')
+async def get_comments(request):
+    """
+    A page of the top level comments of a post, or of the replies to the comment with id parent,
+        each with hasMoreComments telling whether it has replies
+    """
+    post = await _visible_post(request, request.match_info['post_id'])
+    ancestor_ids = []
+    if request.query.get('parent'):
+        parent_id = parse_cursor(request.query['parent'])
+        parent = await _collection(request, Comment).find_one(
+            dict(NOT_DELETED, _id=parent_id, post=post.id), {'ancestors': 1}) if parent_id else None
+        if parent is None:
+            raise _error(web.HTTPNotFound, 'comment not found')
+        ancestor_ids = parent['ancestors'] + [parent['_id']]
+    limit = _limit(request, REPLIES_PER_COMMENT, MAX_COMMENTS_PER_PAGE)
+    query = Comment.page_query(post.id, ancestor_ids, parse_cursor(request.query.get('after')))
+    comments, next_cursor = await _load_comments(request, query, limit)
+    return web.json_response({
+        'comments': [serialize_comment(comment) for comment in comments],
+        'nextCursor': str(next_cursor) if next_cursor else None
+    })
+
+
+def _live_comment(comment_id, post):
+    """
+    Runs in a model thread, see _run_model
+    :param (ObjectId) comment_id: id of the comment
+    :param (Post) post: the post of the comment
+    :return (Comment|None): the comment, None if it or one of its ancestors is tombstoned,
+        replies stay in the collection until the purge of their tombstoned ancestor deletes them
+    """
+    comment = Comment.objects(id=comment_id, post=post.id).first() if comment_id else None
+    if comment is None:
+        return None
+    ancestor_ids = _reference_ids(comment, 'ancestors')
+    if ancestor_ids and Comment.objects(id__in=ancestor_ids).count() != len(ancestor_ids):
+        return None
+    return comment
+
+
+@routes.post('/api/posts/{post_id}/comments')
+async def create_comment(request):
+    """
+    Comment on a post, or reply to the comment with id parent
+    """
+    post = await _visible_post(request, request.match_info['post_id'])
+    body = await _json_body(request, 'content')
+    parent_id = parse_cursor(body.get('parent'))
+    if body.get('parent') and not parent_id:
+        raise _error(web.HTTPNotFound, 'comment not found')
+
+    def create():
+        user = _model_user(request)
+        if parent_id is None:
+            comment = user.create_comment(body['content'], post)
+        else:
+            parent = _live_comment(parent_id, post)
+            if not parent:
+                raise _error(web.HTTPNotFound, 'comment not found')
+            comment = user.create_nested_comment(body['content'], parent, post)
+        comment.author = user
+        return serialize_comment(comment)
+
+    return web.json_response(await _run_model(request, create), status=201)
+
+
+@routes.delete('/api/posts/{post_id}/comments/{comment_id}')
+async def delete_comment(request):
+    post = await _visible_post(request, request.match_info['post_id'])
+    comment_id = parse_cursor(request.match_info['comment_id'])
+
+    def delete():
+        user = _model_user(request)
+        comment = _live_comment(comment_id, post)
+        if not comment:
+            raise _error(web.HTTPNotFound, 'comment not found')
+        ancestor_ids = _reference_ids(comment, 'ancestors')
+        if ancestor_ids:
+            parent_comment = Comment.objects(id=ancestor_ids[-1]).first()
+            if not parent_comment:
+                raise _error(web.HTTPNotFound, 'comment not found')
+            user.delete_nested_comment(comment, parent_comment, post)
+        else:
+            user.delete_comment(comment, post)
+
+    await _run_model(request, delete)
+    return web.Response(status=204)
+
+
+# Circles
+
+
+@routes.get('/api/circles')
+async def get_circles(request):
+    """
+    The circles of the signed in user, with the user ids of their members
+    """
+    circles = _collection(request, Circle).find(dict(NOT_DELETED, owner=request['user_object_id']))
+    circles = [son async for son in circles]
+    member_ids = list({member_id for circle in circles for member_id in circle.get('members', [])})
+    members = _collection(request, User).find(dict(NOT_DELETED, _id={'$in': member_ids}), {'user_id': 1})
+    user_ids = {son['_id']: son['user_id'] async for son in members}
+    return web.json_response([
+        {
+            'id': str(circle['_id']),
+            'name': circle['name'],
+            'members': [user_ids[member_id] for member_id in circle.get('members', []) if member_id in user_ids]
+        }
+        for circle in circles
+    ])
+
+
+@routes.post('/api/circles')
+async def create_circle(request):
+    body = await _json_body(request, 'name')
+    if not await _run_model(request, lambda: _model_user(request).create_circle(body['name'])):
+        raise _error(web.HTTPConflict, {'name': 'name is already taken'})
+    return web.json_response({'name': body['name']}, status=201)
+
+
+async def _set_member(request, is_member):
+    """
+    Add the user with user id user_id to a circle of the signed in user, or remove them from it
+    """
+    circle_id = parse_cursor(request.match_info['circle_id'])
+    member_user_id = request.match_info['user_id']
+
+    def set_member():
+        circle = Circle.objects(id=circle_id).first() if circle_id else None
+        member = User.find(member_user_id)
+        if not circle or not member:
+            raise _error(web.HTTPNotFound, 'circle or user not found')
+        _model_user(request).set_member(circle, member, is_member)
+
+    await _run_model(request, set_member)
+    return web.Response(status=204)
+
+
+@routes.put('/api/circles/{circle_id}/members/{user_id}')
+async def add_member(request):
+    return await _set_member(request, True)
+
+
+@routes.delete('/api/circles/{circle_id}/members/{user_id}')
+async def remove_member(request):
+    return await _set_member(request, False)
+
+
+# Events
+
+
+class EventStream(object):
+    """
+    Events waiting to be sent to one open /api/events response
+    """
+
+    def __init__(self, viewer, member_circle_ids):
+        """
+        :param (User) viewer: the signed in user, only its ids are loaded
+        :param (list[ObjectId]) member_circle_ids: ids of the circles that the viewer is a member of
+        """
+        self.viewer = viewer
+        self.viewer._member_circle_ids = set(member_circle_ids)
+        self.pending = asyncio.Queue()
+
+    def push(self, event):
+        """
+        Queue an event, or the end of the stream when the client fell too far behind
+        :param (dict|None) event: the event, None ends the stream
+        """
+        if event is not None and self.pending.qsize() >= MAX_PENDING_EVENTS:
+            event = None
+        self.pending.put_nowait(event)
+
+
+class EventHub(object):
+    """
+    Fans the events of the broker out to the event streams open in this process,
+        each event only to the viewers that User.sees_post lets see its post
+    Membership events also drop the membership versions of their users from memory, see authenticate
+    """
+
+    def __init__(self, database, membership_versions):
+        self._database = database
+        self._membership_versions = membership_versions
+        self._streams = set()
+        self._loop = None
+        self._unsubscribe = None
+
+    def __len__(self):
+        return len(self._streams)
+
+    async def start(self, app):
+        self._loop = asyncio.get_running_loop()
+        self._unsubscribe = events.subscribe(self._receive)
+
+    async def stop(self, app):
+        self._unsubscribe()
+        for stream in self._streams:
+            stream.push(None)
+
+    def add(self, stream):
+        self._streams.add(stream)
+
+    def remove(self, stream):
+        self._streams.discard(stream)
+
+    def _receive(self, event):
+        # Called by the broker, in the thread that published
+        self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event):
+        if event['type'] == MEMBERSHIPS_CHANGED:
+            user_ids = set(event['users'])
+            for user_id in user_ids:
+                self._membership_versions.delete(ObjectId(user_id))
+            for stream in self._streams:
+                if str(stream.viewer.id) in user_ids:
+                    asyncio.ensure_future(self._reload_member_circle_ids(stream))
+            return
+        post = Post.from_event(event)
+        for stream in self._streams:
+            if stream.viewer.sees_post(post):
+                stream.push(event)
+
+    async def _reload_member_circle_ids(self, stream):
+        stream.viewer._member_circle_ids = set(await _find_member_circle_ids(self._database, stream.viewer.id))
+
+
+@routes.get('/api/events')
+async def event_stream(request):
+    """
+    Server-Sent Events about posts that the signed in user can see: post_created, post_deleted and comments_changed,
+        each with the id of the post. Clients reload what changed
+    """
+    viewer = User._from_son({'_id': request['user_object_id'], 'user_id': request['user_id']})
+    stream = EventStream(viewer, await _member_circle_ids(request))
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    hub = request.app['events']
+    hub.add(stream)
+    try:
+        await response.write(b'retry: 3000\n\n')
+        while True:
+            try:
+                event = await asyncio.wait_for(stream.pending.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                await response.write(b': heartbeat\n\n')
+                continue
+            if event is None:
+                break
+            await response.write('event: {}\ndata: {}\n\n'.format(
+                event['type'], json.dumps({'post': event['post']})).encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.remove(stream)
+    return response
+
+
+def create_app(database, jwt_secret_key=None, write_threads=WRITE_THREADS):
+    """
+    :param (AsyncIOMotorDatabase) database: the database, models.py must be connected to the same one for writes
+    :param (str) jwt_secret_key: key that access tokens are signed with, JWT_SECRET_KEY from the environment by default
+    :param (int) write_threads: number of threads that run writes
+    :return (web.Application): the app
+    """
+    app = web.Application(middlewares=[allow_cross_origin, authenticate, forbid_unauthorized_access])
+    app.on_response_prepare.append(_allow_origin)
+    app['db'] = database
+    app['jwt_secret_key'] = jwt_secret_key or os.environ.get('JWT_SECRET_KEY', DEFAULT_JWT_SECRET_KEY)
+    app['writer'] = ThreadPoolExecutor(write_threads, thread_name_prefix='writer')
+    app['membership_versions'] = LRUCache(MEMBERSHIP_VERSIONS_MAX_SIZE, MEMBERSHIP_VERSIONS_TTL_SECONDS)
+    app['events'] = EventHub(database, app['membership_versions'])
+    app.on_startup.append(app['events'].start)
+    app.on_shutdown.append(app['events'].stop)
+
+    async def shutdown_writer(app):
+        app['writer'].shutdown(wait=True)
+
+    app.on_cleanup.append(shutdown_writer)
+    app.add_routes(routes)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    # Imported here so that the app can be created with another motor compatible database, e.g. in tests
+    from motor.motor_asyncio import AsyncIOMotorClient
+    mongodb_uri = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/minigplus')
+    connect(host=mongodb_uri)
+    client = AsyncIOMotorClient(mongodb_uri, maxPoolSize=int(os.environ.get('MONGODB_POOL_SIZE', 100)))
+    web.run_app(create_app(client.get_default_database()), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import asyncio
+import resource
+import unittest
+from unittest.mock import patch
+from aiohttp.test_utils import AioHTTPTestCase
+from flask import Flask
+from flask_jwt_extended import create_access_token
+from mongoengine.connection import get_db
+from mongomock_motor import AsyncMongoMockDatabase
+from models_test import MongomockTestCase
+from models import User, Circle, Post, Comment
+from async_api import create_app
+from cleanup import cleaner
+import auth
+
+JWT_SECRET_KEY = 'secret'
+# Idle event streams held open at once by one server
+IDLE_CONNECTIONS = 2000
+
+
+def _access_token(user_id):
+    """
+    :return (str): an access token issued like /api/auth of the Flask app
+    """
+    flask_app = Flask(__name__)
+    flask_app.config['JWT_SECRET_KEY'] = JWT_SECRET_KEY
+    auth.init_app(flask_app)
+    with flask_app.app_context():
+        return create_access_token(identity=User.find(user_id))
+
+
+class AsyncApiTests(MongomockTestCase, AioHTTPTestCase):
+    def __init__(self, *args, **kwargs):
+        super(AsyncApiTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    async def get_application(self):
+        return create_app(AsyncMongoMockDatabase(get_db()), JWT_SECRET_KEY, write_threads=1)
+
+    def setUp(self):
+        super(AsyncApiTests, self).setUp()
+        for user_id in ['alice', 'bob', 'carol']:
+            User.create(user_id, 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.alice.create_circle('friends')
+        self.friends = Circle.objects.get(name='friends')
+        self.alice.toggle_member(self.friends, self.bob)
+        self.public_post = self.alice.create_post('public', True, [])
+        self.friends_post = self.alice.create_post('friends only', False, [self.friends])
+
+    async def _get(self, user_id, path, **kwargs):
+        response = await self.client.get(path, headers={'Authorization': 'Bearer ' + _access_token(user_id)}, **kwargs)
+        return response.status, await response.json()
+
+    async def _send(self, method, user_id, path, body=None):
+        response = await self.client.request(
+            method, path, json=body, headers={'Authorization': 'Bearer ' + _access_token(user_id)})
+        return response.status, (await response.json() if response.content_type == 'application/json' else None)
+
+    async def test_token(self):
+        self.assertEqual(await self._get('alice', '/api/me'), (200, {'id': 'alice'}))
+        response = await self.client.get('/api/me')
+        self.assertEqual(response.status, 401)
+        response = await self.client.get('/api/me', headers={'Authorization': 'Bearer not-a-token'})
+        self.assertEqual(response.status, 422)
+
+    async def test_revoked_token(self):
+        headers = {'Authorization': 'Bearer ' + _access_token('bob')}
+        self.assertEqual((await self.client.get('/api/me', headers=headers)).status, 200)
+        self.alice.toggle_member(self.friends, self.bob)
+        await asyncio.sleep(0)
+        response = await self.client.get('/api/me', headers=headers)
+        self.assertEqual((response.status, await response.json()), (401, {'msg': 'Token has been revoked'}))
+        self.assertEqual((await self._get('bob', '/api/me'))[0], 200)
+        headers = {'Authorization': 'Bearer ' + _access_token('carol')}
+        User.find('carol').delete_account()
+        self.assertEqual((await self.client.get('/api/me', headers=headers)).status, 401)
+
+    async def test_feed(self):
+        status, body = await self._get('bob', '/api/feed')
+        self.assertEqual(status, 200)
+        self.assertEqual([post['content'] for post in body['posts']], ['friends only', 'public'])
+        self.assertEqual(body['posts'][0]['author'], 'alice')
+        status, body = await self._get('carol', '/api/feed', params={'limit': 1})
+        self.assertEqual([post['content'] for post in body['posts']], ['public'])
+        status, body = await self._get('carol', '/api/feed', params={'before': body['nextCursor'] or ''})
+        self.assertEqual(body['nextCursor'], None)
+
+    async def test_post_visibility(self):
+        path = '/api/posts/{}'.format(self.friends_post.id)
+        self.assertEqual((await self._get('bob', path))[0], 200)
+        self.assertEqual((await self._get('carol', path))[0], 404)
+        self.assertEqual((await self._get('carol', '/api/posts/not-an-id'))[0], 404)
+
+    async def test_create_and_delete_post(self):
+        status, body = await self._send('POST', 'alice', '/api/posts', {
+            'content': 'new', 'isPublic': False, 'circles': [str(self.friends.id)]})
+        self.assertEqual(status, 201)
+        self.assertEqual(body['author'], 'alice')
+        self.assertEqual(User.get(self.alice.id).post_count, 3)
+        self.assertEqual((await self._get('bob', '/api/posts/{}'.format(body['id'])))[0], 200)
+        self.assertEqual((await self._send('DELETE', 'bob', '/api/posts/{}'.format(body['id'])))[0], 403)
+        self.assertEqual((await self._send('DELETE', 'alice', '/api/posts/{}'.format(body['id'])))[0], 204)
+        self.assertEqual((await self._get('bob', '/api/posts/{}'.format(body['id'])))[0], 404)
+
+    async def test_comments(self):
+        path = '/api/posts/{}/comments'.format(self.friends_post.id)
+        status, first = await self._send('POST', 'bob', path, {'content': 'first'})
+        self.assertEqual(status, 201)
+        await self._send('POST', 'alice', path, {'content': 'reply', 'parent': first['id']})
+        await self._send('POST', 'alice', path, {'content': 'second'})
+        self.assertEqual((await self._send('POST', 'carol', path, {'content': 'hidden'}))[0], 404)
+
+        status, body = await self._get('bob', path, params={'limit': 1})
+        self.assertEqual([(c['content'], c['hasMoreComments']) for c in body['comments']], [('first', True)])
+        status, body = await self._get('bob', path, params={'after': body['nextCursor']})
+        self.assertEqual([(c['content'], c['hasMoreComments']) for c in body['comments']], [('second', False)])
+        status, body = await self._get('bob', path, params={'parent': first['id']})
+        self.assertEqual([c['content'] for c in body['comments']], ['reply'])
+        self.assertEqual(Post.objects.get(id=self.friends_post.id).comment_count, 3)
+
+        self.assertEqual((await self._send('DELETE', 'alice', '{}/{}'.format(path, first['id'])))[0], 204)
+        status, body = await self._get('bob', path)
+        self.assertEqual([c['content'] for c in body['comments']], ['second'])
+
+    async def test_comments_under_pending_purge(self):
+        path = '/api/posts/{}/comments'.format(self.friends_post.id)
+        status, first = await self._send('POST', 'bob', path, {'content': 'first'})
+        status, reply = await self._send('POST', 'bob', path, {'content': 'reply', 'parent': first['id']})
+        with patch.object(cleaner, 'submit', lambda fn, *args: None):
+            self.assertEqual((await self._send('DELETE', 'bob', '{}/{}'.format(path, first['id'])))[0], 204)
+        self.assertEqual((await self._send('DELETE', 'bob', '{}/{}'.format(path, reply['id'])))[0], 404)
+        self.assertEqual((await self._send('POST', 'bob', path, {'content': 'late', 'parent': reply['id']}))[0], 404)
+
+    async def test_circles(self):
+        path = '/api/circles/{}/members/carol'.format(self.friends.id)
+        self.assertEqual((await self._send('PUT', 'alice', path))[0], 204)
+        self.assertEqual((await self._send('PUT', 'alice', path))[0], 204)
+        self.assertEqual(await self._get('alice', '/api/circles'), (200, [
+            {'id': str(self.friends.id), 'name': 'friends', 'members': ['bob', 'carol']}]))
+        self.assertEqual((await self._get('carol', '/api/posts/{}'.format(self.friends_post.id)))[0], 200)
+        self.assertEqual((await self._send('DELETE', 'alice', path))[0], 204)
+        self.assertEqual((await self._send('PUT', 'bob', path))[0], 403)
+        self.assertEqual((await self._send('POST', 'alice', '/api/circles', {'name': 'friends'}))[0], 409)
+        self.assertEqual((await self._send('POST', 'alice', '/api/circles', {'name': 'family'}))[0], 201)
+
+    async def _open_events(self, user_id, token=None):
+        """
+        Open an event stream over HTTP/1.0, whose body is not chunked; after its first line the stream is registered
+        :return (asyncio.StreamReader, asyncio.StreamWriter): the connection, which closes once the writer is collected
+        """
+        reader, writer = await asyncio.open_connection(self.server.host, self.server.port)
+        writer.write('GET /api/events?token={} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(token or _access_token(user_id)).encode())
+        await writer.drain()
+        await reader.readuntil(b'retry: 3000\n\n')
+        return reader, writer
+
+    async def _next_event(self, reader):
+        """
+        :return (str, str): type of the next event and the id of its post
+        """
+        fields = {}
+        while 'event' not in fields:
+            lines = (await asyncio.wait_for(reader.readuntil(b'\n\n'), 5)).decode().splitlines()
+            fields = dict(line.split(': ', 1) for line in lines if line.startswith(('event', 'data')))
+        return fields['event'], fields['data'][len('{"post": "'):-len('"}')]
+
+    async def test_events(self):
+        (bob, _bob), (carol, _carol) = await self._open_events('bob'), await self._open_events('carol')
+        friends_post = self.alice.create_post('friends', False, [self.friends])
+        public_post = self.alice.create_post('everyone', True, [])
+        self.assertEqual(await self._next_event(bob), ('post_created', str(friends_post.id)))
+        self.assertEqual(await self._next_event(carol), ('post_created', str(public_post.id)))
+        self.bob.create_comment('comment', friends_post)
+        self.assertEqual(await self._next_event(bob), ('post_created', str(public_post.id)))
+        self.assertEqual(await self._next_event(bob), ('comments_changed', str(friends_post.id)))
+
+    async def test_events_after_membership_change(self):
+        carol, _carol = await self._open_events('carol')
+        self.alice.toggle_member(self.friends, User.find('carol'))
+        await asyncio.sleep(0.1)
+        friends_post = self.alice.create_post('friends', False, [self.friends])
+        self.assertEqual(await self._next_event(carol), ('post_created', str(friends_post.id)))
+
+    async def test_idle_connections(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < IDLE_CONNECTIONS * 2 + 100:
+            raise unittest.SkipTest('{} open files are not enough'.format(hard))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, IDLE_CONNECTIONS * 2 + 100), hard))
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+        tokens = [_access_token(user_id) for user_id in ['alice', 'bob', 'carol']]
+        connections = []
+        for start in range(0, IDLE_CONNECTIONS, 100):
+            connections.extend(await asyncio.gather(*[
+                self._open_events(None, tokens[i % 3]) for i in range(start, start + 100)]))
+        self.assertEqual(len(self.app['events']), IDLE_CONNECTIONS)
+
+        friends_post = self.alice.create_post('friends', False, [self.friends])
+        public_post = self.alice.create_post('everyone', True, [])
+        received = await asyncio.gather(*[self._next_event(reader) for reader, _ in connections])
+        # alice and bob see the friends post first, carol only sees the public one
+        self.assertEqual(received, [
+            ('post_created', str(public_post.id) if i % 3 == 2 else str(friends_post.id)) for i in range(IDLE_CONNECTIONS)])
+
+        for _, writer in connections:
+            writer.close()
+        # A closed stream is dropped when its next event or heartbeat fails to write
+        self.alice.create_post('everyone again', True, [])
+        for _ in range(50):
+            if not len(self.app['events']):
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(len(self.app['events']), 0)
@@ -0,0 +1,82 @@
+"""
+Access and refresh tokens of the JSON APIs, issued by /api/auth and accepted by the Flask app and async_api
+Besides the user id, tokens carry the object id and the membership version of the user, so that API handlers
+    know the user without loading it. Access tokens whose membership version is outdated, or whose user is deleted,
+    are revoked. That check reads the user through the cache of models.py, from memory on a hit
+Access tokens expire quickly, clients exchange their refresh token for a new one at /api/refresh
+"""
+from datetime import timedelta
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask_jwt_extended import JWTManager, get_jwt_identity, get_jwt_claims
+from models import User
+
+ACCESS_TOKEN_EXPIRES = timedelta(minutes=15)
+REFRESH_TOKEN_EXPIRES = timedelta(days=30)
+# Claims of the tokens, under the user claims of flask_jwt_extended
+USER_CLAIMS = 'user_claims'
+OBJECT_ID_CLAIM = 'oid'
+MEMBERSHIP_VERSION_CLAIM = 'membership_version'
+
+
+def token_claims(user):
+    """
+    :param (User) user: the user that a token is issued to
+    :return (dict): the user claims of the token
+    """
+    return {OBJECT_ID_CLAIM: str(user.id), MEMBERSHIP_VERSION_CLAIM: user.membership_version}
+
+
+def claimed_user(user_id, claims):
+    """
+    The user that a token was issued to, with only id, user_id and membership_version loaded
+    :param (str) user_id: identity of the token
+    :param (dict) claims: user claims of the token
+    :return (User|None): the user, None if the token lacks the claims, e.g. it was issued before they existed
+    """
+    try:
+        return User._from_son({
+            '_id': ObjectId(claims[OBJECT_ID_CLAIM]),
+            'user_id': user_id,
+            'membership_version': int(claims[MEMBERSHIP_VERSION_CLAIM])
+        })
+    except (KeyError, TypeError, ValueError, InvalidId):
+        return None
+
+
+def is_revoked(user):
+    """
+    :param (User|None) user: user of a token, see claimed_user
+    :return (bool): whether the token is revoked, because its user is deleted or their memberships changed since
+    """
+    if user is None:
+        return True
+    current_user = User.get(user.id)
+    return current_user is None or current_user.membership_version != user.membership_version
+
+
+def token_user():
+    """
+    :return (User): the user of the access token of the current request, see claimed_user
+    """
+    return claimed_user(get_jwt_identity(), get_jwt_claims())
+
+
+def init_app(app):
+    """
+    Issue and check tokens with the claims above, identities passed to create_access_token are users
+    :param (Flask) app: the app
+    :return (JWTManager): the token manager
+    """
+    app.config.setdefault('JWT_ACCESS_TOKEN_EXPIRES', ACCESS_TOKEN_EXPIRES)
+    app.config.setdefault('JWT_REFRESH_TOKEN_EXPIRES', REFRESH_TOKEN_EXPIRES)
+    app.config['JWT_USER_CLAIMS'] = USER_CLAIMS
+    app.config['JWT_CLAIMS_IN_REFRESH_TOKEN'] = True
+    app.config['JWT_BLACKLIST_ENABLED'] = True
+    app.config['JWT_BLACKLIST_TOKEN_CHECKS'] = ['access']
+    jwt = JWTManager(app)
+    jwt.user_identity_loader(lambda user: user.user_id)
+    jwt.user_claims_loader(token_claims)
+    jwt.token_in_blacklist_loader(
+        lambda decoded_token: is_revoked(claimed_user(decoded_token['identity'], decoded_token.get(USER_CLAIMS))))
+    return jwt
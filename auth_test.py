@@ -0,0 +1,81 @@
+import jwt
+from flask import Flask, jsonify
+from flask_jwt_extended import create_access_token, jwt_required
+from models_test import MongomockTestCase, count_queries
+from models import User, Circle, cache
+import auth
+
+
+class TokenTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(TokenTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle])
+
+    def setUp(self):
+        super(TokenTests, self).setUp()
+        cache.configure()
+        self.addCleanup(cache.configure)
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.app = Flask(__name__)
+        self.app.config['JWT_SECRET_KEY'] = 'secret'
+        auth.init_app(self.app)
+
+        @self.app.route('/me')
+        @jwt_required
+        def me():
+            user = auth.token_user()
+            return jsonify(id=user.user_id, oid=str(user.id))
+
+        self.client = self.app.test_client()
+
+    def _token(self, user):
+        with self.app.app_context():
+            return create_access_token(identity=user)
+
+    def _get_me(self, token):
+        return self.client.get('/me', headers={'Authorization': 'Bearer ' + token})
+
+    def test_claims(self):
+        token = self._token(self.alice)
+        claims = jwt.decode(token, 'secret', algorithms=['HS256'])
+        self.assertEqual(claims['identity'], 'alice')
+        self.assertEqual(claims['user_claims'], {'oid': str(self.alice.id), 'membership_version': 0})
+        self.assertLess(claims['exp'] - claims['iat'], 3600)
+        response = self._get_me(token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'id': 'alice', 'oid': str(self.alice.id)})
+
+    def test_checks_from_memory(self):
+        token = self._token(self.alice)
+        self._get_me(token)
+        with count_queries() as queries:
+            self.assertEqual(self._get_me(token).status_code, 200)
+        self.assertEqual(queries[0], 0)
+
+    def test_membership_change_revokes(self):
+        self.alice.create_circle('friends')
+        circle = Circle.objects(owner=self.alice.id).first()
+        token = self._token(self.bob)
+        self.assertEqual(self._get_me(token).status_code, 200)
+        self.alice.toggle_member(circle, self.bob)
+        response = self._get_me(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json, {'msg': 'Token has been revoked'})
+        self.assertEqual(self._get_me(self._token(User.find('bob'))).status_code, 200)
+        token = self._token(User.find('bob'))
+        self.alice.delete_circle(Circle.objects(id=circle.id).first())
+        self.assertEqual(self._get_me(token).status_code, 401)
+
+    def test_deleted_user_revokes(self):
+        token = self._token(self.alice)
+        self.alice.delete_account()
+        self.assertEqual(self._get_me(token).status_code, 401)
+
+    def test_token_without_claims_revoked(self):
+        self.app.config['JWT_USER_CLAIMS'] = 'other_claims'
+        token = self._token(self.alice)
+        self.app.config['JWT_USER_CLAIMS'] = auth.USER_CLAIMS
+        self.assertEqual(self._get_me(token).status_code, 401)
@@ -0,0 +1,77 @@
+import time
+from mongoengine import connect, disconnect
+from mongoengine.connection import get_db
+
+
+def connect_database(mongodb_uri=None):
+    """
+    Point the models at a benchmark database, mongomock unless a uri is given
+    The database is dropped first, never pass the uri of a database you care about
+    :param (str) mongodb_uri: uri of a mongod database
+    """
+    disconnect()
+    if mongodb_uri:
+        connect(host=mongodb_uri)
+    else:
+        connect('benchmark', host='mongomock://localhost')
+    db = get_db()
+    db.client.drop_database(db.name)
+
+
+def sign_in(client, user_id, password):
+    """
+    :param (FlaskClient) client: test client
+    :param (str) user_id: user id
+    :param (str) password: password
+    """
+    client.post('/signin', data={'id': user_id, 'password': password})
+
+
+def requests_per_second(client, path, requests, headers=None):
+    """
+    Send GET requests to a path one after another
+    :param (FlaskClient) client: test client
+    :param (str) path: the path
+    :param (int) requests: number of requests
+    :param (dict) headers: headers of every request
+    :return (float): requests per second
+    """
+    client.get(path, headers=headers)
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200, '{} returned {}'.format(path, response.status_code)
+    return requests / (time.perf_counter() - start)
+
+
+def percentiles(latencies):
+    """
+    :param (list[float]) latencies: latencies
+    :return (dict): count, p50, p99 and max of the latencies
+    """
+    ordered = sorted(latencies)
+    if not ordered:
+        return {'count': 0, 'p50': 0, 'p99': 0, 'max': 0}
+    return {
+        'count': len(ordered),
+        'p50': ordered[len(ordered) // 2],
+        'p99': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        'max': ordered[-1]
+    }
+
+
+def timings(fn, repeat):
+    """
+    Call a function repeatedly
+    :param (callable) fn: the function
+    :param (int) repeat: number of calls
+    :return (dict): count, mean, p50, p99 and max of the call durations in milliseconds
+    """
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    result = percentiles(latencies)
+    result['mean'] = sum(latencies) / len(latencies) if latencies else 0
+    return result
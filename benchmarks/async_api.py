@@ -0,0 +1,141 @@
+"""
+Throughput and latency of the feed at rising numbers of concurrent connections,
+served by the Flask API (/api/posts) and by the asynchronous API (/api/feed)
+
+    python -m benchmarks.async_api [--concurrency 10,100,1000] [--seconds 5] [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+
+Both servers run in this process, next to the clients, so compare the two rather than read absolute numbers.
+The asynchronous API only waits on the database without blocking with a mongod: on mongomock its queries run
+    inline in the event loop, pass --mongodb-uri for a meaningful comparison
+"""
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+import aiohttp
+from aiohttp import web
+from werkzeug.serving import make_server
+from flask_jwt_extended import create_access_token
+from mongoengine.connection import get_db
+from app import app
+from models import User
+import async_api
+from benchmarks import connect_database, percentiles
+from benchmarks.datagen import generate
+
+# Seconds a request may take before it counts as failed
+REQUEST_TIMEOUT = 30
+
+
+def _serve_flask():
+    """
+    :return (int, callable): port of the Flask app served by threaded werkzeug, and a function that stops it
+    """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.port, server.shutdown
+
+
+def _serve_async(mongodb_uri):
+    """
+    :return (int, callable): port of the asynchronous API served in its own event loop thread, and a function that stops it
+    """
+    if mongodb_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        database = AsyncIOMotorClient(mongodb_uri).get_default_database()
+    else:
+        from mongomock_motor import AsyncMongoMockDatabase
+        database = AsyncMongoMockDatabase(get_db())
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(async_api.create_app(database, app.config['JWT_SECRET_KEY']), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0, backlog=4096)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    return port, stop
+
+
+async def _load(url, token, concurrency, seconds):
+    """
+    Send requests from concurrency connections, each one after another, for some seconds
+    :return (dict): latency percentiles in milliseconds, requests per second and number of failed requests
+    """
+    latencies = []
+    failures = [0]
+    deadline = time.perf_counter() + seconds
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        async def client():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        await response.read()
+                        if response.status != 200:
+                            failures[0] += 1
+                            continue
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    failures[0] += 1
+                    continue
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    result = percentiles(latencies)
+    result['requests_per_second'] = len(latencies) / elapsed
+    result['failures'] = failures[0]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='10,100,1000', help='comma separated numbers of concurrent connections')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    connect_database(args.mongodb_uri)
+    generate(users=args.users, seed=args.seed)
+    with app.app_context():
+        token = create_access_token(identity=User.find('user0'))
+    servers = {
+        'flask': (_serve_flask(), '/api/posts'),
+        'async': (_serve_async(args.mongodb_uri), '/api/feed')
+    }
+
+    results = {}
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        for tier, ((port, _), path) in servers.items():
+            url = 'http://127.0.0.1:{}{}'.format(port, path)
+            results.setdefault(tier, {})[concurrency] = asyncio.run(_load(url, token, concurrency, args.seconds))
+    for (_, stop), _ in servers.values():
+        stop()
+
+    print('{:<8}{:>12}{:>12}{:>10}{:>10}{:>10}'.format('api', 'connections', 'requests/s', 'p50 ms', 'p99 ms', 'failed'))
+    for tier, by_concurrency in results.items():
+        for concurrency, result in by_concurrency.items():
+            print('{:<8}{:>12}{:>12.0f}{:>10.1f}{:>10.1f}{:>10}'.format(
+                tier, concurrency, result['requests_per_second'], result['p50'], result['p99'], result['failures']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
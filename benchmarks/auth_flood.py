@@ -0,0 +1,108 @@
+"""
+Latency of a non-auth route while /api/auth is flooded with sign ins that try every user id with a wrong password,
+with password hashing inline in the web threads, in the worker pool, and in the pool behind the sign in throttle
+
+    python -m benchmarks.auth_flood [--flooders 16] [--seconds 5] [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+"""
+import argparse
+import http.client
+import json
+import logging
+import threading
+import time
+from werkzeug.serving import make_server
+from flask_jwt_extended import create_access_token
+from app import app
+from models import User
+from hashing import hasher
+from ratelimit import sign_in_throttle
+from benchmarks import connect_database, percentiles
+
+PROBED_ROUTE = '/api/users'
+USERS = 20
+
+
+def _request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run(port, flooders, seconds, token):
+    """
+    Probe PROBED_ROUTE for some seconds while flooders threads sign in as fast as they can
+    :return (dict): probe latency percentiles in milliseconds and auth response counts
+    """
+    stop = threading.Event()
+    auth_statuses = {}
+
+    def flood():
+        attempt = 0
+        while not stop.is_set():
+            auth_body = json.dumps({'id': 'user{}'.format(attempt % USERS), 'password': 'wrong password'})
+            attempt += 1
+            status = _request(port, 'POST', '/api/auth', auth_body, {'Content-Type': 'application/json'})
+            auth_statuses[status] = auth_statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=flood) for _ in range(flooders)]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        _request(port, 'GET', PROBED_ROUTE, headers={'Authorization': 'Bearer {}'.format(token)})
+        latencies.append((time.perf_counter() - start) * 1000)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    result = percentiles(latencies)
+    result['auth_statuses'] = auth_statuses
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flooders', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=1, help='password hashing worker processes')
+    parser.add_argument('--queue-size', type=int, default=4)
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    connect_database(args.mongodb_uri)
+    hasher.configure()
+    for i in range(USERS):
+        User.create('user{}'.format(i), 'password')
+    with app.app_context():
+        token = create_access_token(identity=User.find('user0'))
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {'idle': run(server.port, 0, args.seconds, token)}
+    for mode, workers, throttled in [('inline', 0, False), ('pool', args.workers, False), ('throttled', args.workers, True)]:
+        hasher.configure(workers, args.queue_size, app.config['PASSWORD_HASH_METHOD'])
+        sign_in_throttle.configure(enabled=throttled)
+        results[mode] = run(server.port, args.flooders, args.seconds, token)
+    server.shutdown()
+    hasher.configure()
+    sign_in_throttle.configure()
+
+    print('{:<10}{:>10}{:>10}{:>10}  {}'.format('hashing', 'p50 ms', 'p99 ms', 'max ms', 'auth responses'))
+    for mode, result in results.items():
+        print('{:<10}{:>10.1f}{:>10.1f}{:>10.1f}  {}'.format(
+            mode, result['p50'], result['p99'], result['max'], result['auth_statuses']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
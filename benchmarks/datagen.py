@@ -0,0 +1,142 @@
+"""
+Seedable synthetic data for benchmarks: users, circles with a skewed membership spread,
+posts with mixed visibility and deep comment threads, with text drawn from a skewed vocabulary
+
+Documents are written in bulk straight into the collections, in the same shape the models write them
+"""
+import random
+from bson.objectid import ObjectId
+from models import User, Circle, Post, Comment
+from hashing import PasswordHasher
+from migrations import reconcile_counters
+
+PASSWORD = 'password'
+BATCH_SIZE = 1000
+VOCABULARY_SIZE = 5000
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'ph', 'an', 'el', 'or', 'us', 'ix']
+
+# Cheap hash so that generating many users does not take long, it is upgraded on first sign in
+_password_hash = PasswordHasher(method='pbkdf2:sha256:1000').hash(PASSWORD)
+
+
+def _insert(collection, documents):
+    for start in range(0, len(documents), BATCH_SIZE):
+        collection.insert_many(documents[start:start + BATCH_SIZE], ordered=False)
+
+
+def _popular_user_indexes(rng, count, size, skew):
+    """
+    Pick distinct users, popular ones (low indexes) more often, like follower counts in a social network
+    """
+    picked = set()
+    for _ in range(size * 20):
+        if len(picked) >= size:
+            break
+        picked.add(min(int(rng.paretovariate(skew)) - 1, count - 1))
+    return picked
+
+
+def _vocabulary(rng):
+    return sorted({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(VOCABULARY_SIZE)})
+
+
+def _text(rng, vocabulary, words):
+    """
+    Words picked with a Zipf like skew, so that a few words are common and most are rare, like in real text
+    """
+    return ' '.join(vocabulary[min(int(rng.paretovariate(1.0)) - 1, len(vocabulary) - 1)] for _ in range(words))
+
+
+def generate(users=100,
+             circles_per_user=3,
+             members_per_circle=10,
+             posts_per_user=5,
+             public_ratio=0.3,
+             comments_per_post=4,
+             reply_ratio=0.6,
+             max_depth=8,
+             snapshots=True,
+             seed=0):
+    """
+    Generate a data set into the connected database
+    :param (int) users: number of users, their ids are user0, user1, ... and their passwords PASSWORD
+    :param (int) circles_per_user: circles that each user owns
+    :param (int) members_per_circle: average members of a circle
+    :param (int) posts_per_user: average posts of a user
+    :param (float) public_ratio: share of public posts, the rest are shared with circles or private
+    :param (int) comments_per_post: average comments of a post
+    :param (float) reply_ratio: share of comments that reply to another comment instead of the post
+    :param (int) max_depth: max depth of a reply
+    :param (bool) snapshots: whether to write the author and circle name snapshots that the models write,
+        False for data like the one written before snapshots existed
+    :param (int) seed: random seed
+    :return (dict): counts of generated documents
+    """
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(rng)
+    rng.shuffle(vocabulary)
+    user_ids = [ObjectId() for _ in range(users)]
+    user_id_of = {user_id: 'user{}'.format(i) for i, user_id in enumerate(user_ids)}
+    _insert(User._get_collection(), [
+        {'_id': user_id, 'user_id': user_id_of[user_id], 'password': _password_hash} for user_id in user_ids
+    ])
+
+    circles = []
+    circle_names = {}
+    circle_ids_by_owner = {}
+    for owner_index, owner_id in enumerate(user_ids):
+        for i in range(circles_per_user):
+            size = max(1, int(rng.expovariate(1.0 / members_per_circle)))
+            members = [user_ids[j] for j in _popular_user_indexes(rng, users, size, 1.2) if j != owner_index]
+            circle = {'_id': ObjectId(), 'owner': owner_id, 'name': 'circle{}'.format(i), 'members': members}
+            circles.append(circle)
+            circle_names[circle['_id']] = circle['name']
+            circle_ids_by_owner.setdefault(owner_id, []).append(circle['_id'])
+    _insert(Circle._get_collection(), circles)
+
+    posts = []
+    for _ in range(users * posts_per_user):
+        author_id = user_ids[min(int(rng.paretovariate(1.5)) - 1, users - 1)]
+        is_public = rng.random() < public_ratio
+        owned_circle_ids = circle_ids_by_owner.get(author_id, [])
+        if is_public or not owned_circle_ids or rng.random() < 0.1:
+            shared_circle_ids = []
+        else:
+            shared_circle_ids = rng.sample(owned_circle_ids, rng.randint(1, len(owned_circle_ids)))
+        post = {
+            '_id': ObjectId(),
+            'author': author_id,
+            'content': _text(rng, vocabulary, rng.randint(5, 30)),
+            'is_public': is_public,
+            'circles': shared_circle_ids
+        }
+        if snapshots:
+            post['author_user_id'] = user_id_of[author_id]
+            post['circle_names'] = {str(circle_id): circle_names[circle_id] for circle_id in shared_circle_ids}
+        posts.append(post)
+    _insert(Post._get_collection(), posts)
+
+    comments = []
+    for post in posts:
+        thread = []
+        for _ in range(int(rng.expovariate(1.0 / comments_per_post)) if comments_per_post else 0):
+            parent = rng.choice(thread) if thread and rng.random() < reply_ratio else None
+            if parent is not None and len(parent['ancestors']) + 1 >= max_depth:
+                parent = None
+            comment = {
+                '_id': ObjectId(),
+                'author': rng.choice(user_ids),
+                'content': _text(rng, vocabulary, rng.randint(3, 15)),
+                'post': post['_id'],
+                'ancestors': parent['ancestors'] + [parent['_id']] if parent else []
+            }
+            if snapshots:
+                comment['author_user_id'] = user_id_of[comment['author']]
+            thread.append(comment)
+            comments.append(comment)
+    _insert(Comment._get_collection(), comments)
+    reconcile_counters()
+
+    for document_class in [User, Circle, Post, Comment]:
+        document_class.ensure_indexes()
+    return {'users': users, 'circles': len(circles), 'posts': len(posts), 'comments': len(comments)}
@@ -0,0 +1,134 @@
+"""
+Time the model methods and the Flask routes at several data sizes and save the results as JSON
+
+    python -m benchmarks.run [--sizes 100,1000] [--repeat 20] [--output results.json]
+                             [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+
+Sizes are numbers of users, the rest of the data set scales with them, see benchmarks.datagen
+"""
+import argparse
+import datetime
+import json
+import subprocess
+from app import app
+from models import User, Circle, Post, TimelineEntry, cache
+from fragments import post_cards
+from benchmarks import connect_database, sign_in, timings
+from benchmarks.datagen import generate, PASSWORD
+
+# The in-Python reference scan gets too slow to run beyond this many posts
+MAX_POSTS_TO_SCAN = 20000
+
+
+def benchmark_models(viewer_id, repeat):
+    """
+    :param (str) viewer_id: user id of the user who runs the methods
+    :param (int) repeat: number of calls per method
+    :return (dict): timings by method
+    """
+    def viewer():
+        # a fresh object per call, like each request loads its own
+        return User.find(viewer_id)
+
+    results = {}
+    results['sees_posts_page'] = timings(lambda: viewer().sees_posts_page(), repeat)
+    if TimelineEntry.enabled:
+        results['timeline_page'] = timings(lambda: viewer().timeline_page(), repeat)
+    if Post.objects.count() <= MAX_POSTS_TO_SCAN:
+        results['sees_posts_by_scan'] = timings(lambda: viewer().sees_posts_by_scan(), max(1, repeat // 10))
+    results['prefetch'] = timings(lambda: Post.prefetch(viewer().sees_posts_page()[0]), repeat)
+
+    largest_circle_id = next(Circle._get_collection().aggregate([
+        {'$match': {'deleted': {'$ne': True}}},
+        {'$project': {'size': {'$size': '$members'}}},
+        {'$sort': {'size': -1}},
+        {'$limit': 1}
+    ]))['_id']
+    member = User.objects.first()
+    results['check_member'] = timings(lambda: Circle.objects.get(id=largest_circle_id).check_member(member), repeat)
+
+    post = viewer().sees_posts_page(limit=1)[0][0]
+    comment = viewer().create_comment('benchmark comment', post)
+    results['create_comment'] = timings(lambda: viewer().create_comment('benchmark comment', post), repeat)
+    results['create_nested_comment'] = timings(
+        lambda: viewer().create_nested_comment('benchmark reply', comment, post), repeat)
+
+    owner = Circle.objects(id=largest_circle_id).scalar('owner').first()
+    results['toggle_member'] = timings(
+        lambda: owner.toggle_member(Circle.objects.get(id=largest_circle_id), member), repeat)
+    return results
+
+
+def benchmark_routes(viewer_id, repeat):
+    """
+    :param (str) viewer_id: user id of the signed in user
+    :param (int) repeat: number of requests per route
+    :return (dict): timings by route
+    """
+    client = app.test_client()
+    sign_in(client, viewer_id, PASSWORD)
+    profile_id = User.objects.order_by('id').skip(1).first().user_id
+    results = {}
+    for name, path in [('/', '/'), ('/profile/<id>', '/profile/{}'.format(profile_id)), ('/users', '/users')]:
+        client.get(path)
+        results[name] = timings(lambda: client.get(path), repeat)
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000', help='comma separated numbers of users')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help='keep the user and circle cache on')
+    parser.add_argument('--post-card-cache', action='store_true', help='keep the rendered post card cache on')
+    parser.add_argument('--timeline', action='store_true', help='run with FEED_MODE=timeline')
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    cache.configure(enabled=args.cache)
+    post_cards.enabled = args.post_card_cache
+    TimelineEntry.enabled = args.timeline
+    results = {
+        'revision': _git_revision(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'seed': args.seed,
+        'cache': args.cache,
+        'post_card_cache': args.post_card_cache,
+        'timeline': args.timeline,
+        'sizes': {}
+    }
+    for size in [int(size) for size in args.sizes.split(',')]:
+        connect_database(args.mongodb_uri)
+        cache.configure(enabled=args.cache)
+        post_cards.clear()
+        counts = generate(users=size, seed=args.seed)
+        if args.timeline:
+            TimelineEntry.backfill()
+        viewer_id = 'user0'
+        results['sizes'][size] = {
+            'counts': counts,
+            'models': benchmark_models(viewer_id, args.repeat),
+            'routes': benchmark_routes(viewer_id, args.repeat)
+        }
+        print('{} users, {} circles, {} posts, {} comments'.format(
+            counts['users'], counts['circles'], counts['posts'], counts['comments']))
+        for group in ['models', 'routes']:
+            for name, result in results['sizes'][size][group].items():
+                print('  {:<24}{:>10.2f} ms mean{:>10.2f} ms p99'.format(name, result['mean'], result['p99']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
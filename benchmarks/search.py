@@ -0,0 +1,74 @@
+"""
+Search latency over a synthetic corpus, for common, rare and multi word queries
+
+    python -m benchmarks.search [--users 2000] [--repeat 50] [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+
+The corpus scales with --users, see benchmarks.datagen. Queries are drawn from the generated text,
+    common words are the most frequent keywords of the index, rare words the ones that appear a few times
+"""
+import argparse
+import json
+import random
+import time
+from collections import Counter
+from app import app
+from models import User, SearchEntry, cache
+from benchmarks import connect_database, sign_in, timings
+from benchmarks.datagen import generate, PASSWORD
+
+
+def _queries(rng, count):
+    """
+    :return (dict[str, list[str]]): queries by kind
+    """
+    frequencies = Counter()
+    for entry in SearchEntry._get_collection().find({}, {'keywords': 1}).limit(20000):
+        frequencies.update(entry['keywords'])
+    ranked = [word for word, _ in frequencies.most_common()]
+    common = ranked[:20]
+    rare = [word for word, frequency in frequencies.items() if 2 <= frequency <= 5] or ranked[-20:]
+    return {
+        'common word': [rng.choice(common) for _ in range(count)],
+        'rare word': [rng.choice(rare) for _ in range(count)],
+        'three words': [' '.join(rng.sample(ranked[:500], 3)) for _ in range(count)]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    connect_database(args.mongodb_uri)
+    cache.configure(enabled=False)
+    counts = generate(users=args.users, seed=args.seed)
+    start = time.perf_counter()
+    counts['search_entries'] = SearchEntry.rebuild()
+    results = {'counts': counts, 'rebuild_seconds': time.perf_counter() - start, 'models': {}, 'routes': {}}
+
+    rng = random.Random(args.seed)
+    viewer = User.find('user0')
+    client = app.test_client()
+    sign_in(client, 'user0', PASSWORD)
+    for kind, queries in _queries(rng, args.repeat).items():
+        model_queries = iter(queries)
+        results['models'][kind] = timings(lambda: viewer.search(next(model_queries)), len(queries))
+        route_queries = iter(queries)
+        results['routes'][kind] = timings(lambda: client.get('/search', query_string={'q': next(route_queries)}), len(queries))
+
+    print('{} posts, {} comments, {} index entries, rebuilt in {:.1f} s'.format(
+        counts['posts'], counts['comments'], counts['search_entries'], results['rebuild_seconds']))
+    for group in ['models', 'routes']:
+        for kind, result in results[group].items():
+            print('  {:<8}{:<16}{:>10.2f} ms p50{:>10.2f} ms p99'.format(group, kind, result['p50'], result['p99']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
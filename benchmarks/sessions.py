@@ -0,0 +1,52 @@
+"""
+Requests per second of / and /users for each session backend
+
+    python -m benchmarks.sessions [--requests 200] [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+"""
+import argparse
+import json
+from app import app, db
+from models import User
+from sessions import SESSION_BACKENDS, create_session_interface
+from benchmarks import connect_database, sign_in, requests_per_second
+
+ROUTES = ['/', '/users']
+
+
+def seed(users=50, posts_per_user=2):
+    for i in range(users):
+        User.create('user{}'.format(i), 'password')
+    viewer = User.find('user0')
+    viewer.create_circle('friends')
+    for i in range(users):
+        author = User.find('user{}'.format(i))
+        for j in range(posts_per_user):
+            author.create_post('post {} by user{}'.format(j, i), j % 2 == 0, [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    connect_database(args.mongodb_uri)
+    seed()
+    results = {}
+    for backend in SESSION_BACKENDS:
+        app.session_interface = create_session_interface(backend, db)
+        client = app.test_client()
+        sign_in(client, 'user0', 'password')
+        results[backend] = {route: requests_per_second(client, route, args.requests) for route in ROUTES}
+
+    print('{:<8}'.format('backend') + ''.join('{:>12}'.format(route) for route in ROUTES))
+    for backend, result in results.items():
+        print('{:<8}'.format(backend) + ''.join('{:>10.1f}/s'.format(result[route]) for route in ROUTES))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Queries and latency of a feed page before and after the author and circle snapshots of posts and comments are backfilled
+
+    python -m benchmarks.snapshots [--users 1000] [--repeat 20] [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+
+The data set is generated without snapshots, like posts and comments written before snapshots existed,
+    so the first run loads authors and circles by reference and the second one reads them from the snapshots
+"""
+import argparse
+import json
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+from app import app
+from models import User, Post, cache
+from fragments import post_cards
+from migrations import backfill_snapshots
+from benchmarks import connect_database, sign_in, timings
+from benchmarks.datagen import generate, PASSWORD
+
+
+@contextmanager
+def _count_queries():
+    """
+    Count finds and aggregations sent to the database, on mongomock and on a mongod alike
+    Queries that a query sends itself, like the find behind a mongomock aggregation, are not counted
+    :return (list[int]): a one element list holding the count
+    """
+    collection_class = type(Post._get_collection())
+    count = [0]
+    nesting = [0]
+
+    def counted(method):
+        def query(*args, **kwargs):
+            if not nesting[0]:
+                count[0] += 1
+            nesting[0] += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                nesting[0] -= 1
+        return query
+
+    with patch.object(collection_class, 'find', counted(collection_class.find)), \
+            patch.object(collection_class, 'aggregate', counted(collection_class.aggregate)):
+        yield count
+
+
+def _render_feed(viewer_id):
+    """
+    Load the first feed page of a user and touch everything that cards/_post.jinja2 and cards/_comment.jinja2 touch
+    """
+    viewer = User.find(viewer_id)
+    posts, _ = viewer.sees_posts_page()
+    Post.prefetch(posts)
+
+    def render_comments(comments):
+        for comment in comments:
+            comment.author.user_id
+            render_comments(comment.comments)
+
+    for post in posts:
+        post.author.user_id
+        if viewer.owns_post(post):
+            post.sharing_scope_str
+        render_comments(post.comments)
+
+
+def _measure(client, viewer_id, repeat):
+    """
+    :return (dict): queries and timings of the feed page, rendered by the models and served by /
+    """
+    with _count_queries() as model_queries:
+        _render_feed(viewer_id)
+    with _count_queries() as route_queries:
+        client.get('/')
+    return {
+        'model_queries': model_queries[0],
+        'route_queries': route_queries[0],
+        'models': timings(lambda: _render_feed(viewer_id), repeat),
+        'route': timings(lambda: client.get('/'), repeat)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    connect_database(args.mongodb_uri)
+    cache.configure(enabled=False)
+    post_cards.enabled = False
+    counts = generate(users=args.users, snapshots=False, seed=args.seed)
+    # user0 writes the most posts, so their feed shows their own posts with circle names
+    viewer_id = 'user0'
+    client = app.test_client()
+    sign_in(client, viewer_id, PASSWORD)
+
+    results = {'counts': counts, 'without snapshots': _measure(client, viewer_id, args.repeat)}
+    start = time.perf_counter()
+    results['backfilled'] = backfill_snapshots()
+    results['backfill_seconds'] = time.perf_counter() - start
+    results['with snapshots'] = _measure(client, viewer_id, args.repeat)
+
+    print('{} posts, {} comments, backfilled {} in {:.1f} s'.format(
+        counts['posts'], counts['comments'], results['backfilled'], results['backfill_seconds']))
+    print('{:<20}{:>16}{:>16}{:>16}{:>16}'.format('', 'model queries', 'model ms p50', 'route queries', 'route ms p50'))
+    for name in ['without snapshots', 'with snapshots']:
+        result = results[name]
+        print('{:<20}{:>16}{:>16.1f}{:>16}{:>16.1f}'.format(
+            name, result['model_queries'], result['models']['p50'], result['route_queries'], result['route']['p50']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Requests per second of /api/me and /api/users with access tokens trusted unchecked, as before they were revoked,
+checked against the database on every request, and checked against the in-memory cache
+
+    python -m benchmarks.tokens [--requests 500] [--mongodb-uri mongodb://localhost:27017/minigplus-benchmark]
+"""
+import argparse
+import json
+from flask_jwt_extended import create_access_token
+from app import app
+from models import User, cache
+from benchmarks import connect_database, requests_per_second
+
+ROUTES = ['/api/me', '/api/users']
+# Mode: whether tokens are checked for revocation, and whether the check may read the cache
+MODES = {'unchecked': (False, True), 'database': (True, False), 'memory': (True, True)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--mongodb-uri')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    connect_database(args.mongodb_uri)
+    for i in range(args.users):
+        User.create('user{}'.format(i), 'password')
+    with app.app_context():
+        headers = {'Authorization': 'Bearer {}'.format(create_access_token(identity=User.find('user0')))}
+    client = app.test_client()
+    results = {}
+    for mode, (checked, cached) in MODES.items():
+        app.config['JWT_BLACKLIST_ENABLED'] = checked
+        cache.configure(enabled=cached)
+        results[mode] = {route: requests_per_second(client, route, args.requests, headers) for route in ROUTES}
+    app.config['JWT_BLACKLIST_ENABLED'] = True
+    cache.configure()
+
+    print('{:<10}'.format('tokens') + ''.join('{:>14}'.format(route) for route in ROUTES))
+    for mode, result in results.items():
+        print('{:<10}'.format(mode) + ''.join('{:>12.1f}/s'.format(result[route]) for route in ROUTES))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import time
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    In-process cache with least recently used eviction and a time to live for each entry
+    """
+
+    def __init__(self, max_size=10000, ttl_seconds=30):
+        """
+        :param (int) max_size: max number of entries
+        :param (float) ttl_seconds: seconds an entry stays valid
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get an entry
+        :param key: the key
+        :return: the value, or MISSING if there is no valid entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Set an entry, evicting the least recently used one if the cache is full
+        :param key: the key
+        :param value: the value
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Delete an entry
+        :param key: the key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LocalSharedCacheBackend(object):
+    """
+    Stand-in for a shared cache that lives in this process, for tests and single process deployments
+    A shared cache backend is a cache shared by all worker processes, e.g. backed by memcached or redis,
+        with these methods:
+        get(key) returns the value of a string key, or MISSING if there is no entry
+        set(key, value, ttl_seconds) sets an entry that stays valid for ttl_seconds
+        delete(key) deletes an entry
+    Values are whatever the backend can serialize
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._entries.get(key, (MISSING, 0))
+            if value is not MISSING and expires_at < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            return value
+
+    def set(self, key, value, ttl_seconds):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl_seconds)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class Cache(object):
+    """
+    Two level read-through cache: an in-process LRU in front of an optional shared backend
+    Writers invalidate entries explicitly. Other processes only see an invalidation in the shared backend,
+        their in-process entries expire after the LRU's time to live
+    """
+
+    def __init__(self, max_size=10000, ttl_seconds=30, shared=None, shared_ttl_seconds=300):
+        """
+        :param (int) max_size: max number of in-process entries
+        :param (float) ttl_seconds: seconds an in-process entry stays valid
+        :param shared: optional shared backend, see LocalSharedCacheBackend
+        :param (float) shared_ttl_seconds: seconds a shared entry stays valid
+        """
+        self.local = LRUCache(max_size, ttl_seconds)
+        self.shared = shared
+        self.shared_ttl_seconds = shared_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True
+
+    def configure(self, max_size=None, ttl_seconds=None, shared=None, enabled=True):
+        """
+        Reconfigure the cache and drop all in-process entries
+        """
+        if max_size is not None:
+            self.local.max_size = max_size
+        if ttl_seconds is not None:
+            self.local.ttl_seconds = ttl_seconds
+        self.shared = shared
+        self.enabled = enabled
+        self.local.clear()
+
+    def get_or_load(self, key, loader):
+        """
+        Get an entry, loading and caching it on a miss
+        :param (str) key: the key
+        :param (callable) loader: loads the value, None is cached as well
+        :return: the value
+        """
+        if not self.enabled:
+            return loader()
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.local.set(key, value)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.shared_ttl_seconds)
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drop entries
+        :param (str) keys: the keys
+        """
+        for key in keys:
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete(key)
+
+    @property
+    def stats(self):
+        """
+        :return (dict): hit and miss counters
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.local)}
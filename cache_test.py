@@ -0,0 +1,55 @@
+import unittest
+from unittest.mock import patch
+from cache import LRUCache, Cache, LocalSharedCacheBackend, MISSING
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIs(lru.get('b'), MISSING)
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_expires(self):
+        lru = LRUCache(ttl_seconds=10)
+        with patch('cache.time.monotonic', return_value=100):
+            lru.set('a', 1)
+        with patch('cache.time.monotonic', return_value=105):
+            self.assertEqual(lru.get('a'), 1)
+        with patch('cache.time.monotonic', return_value=111):
+            self.assertIs(lru.get('a'), MISSING)
+
+
+class CacheTests(unittest.TestCase):
+    def test_get_or_load(self):
+        cache = Cache()
+        loads = []
+        for _ in range(3):
+            self.assertEqual(cache.get_or_load('a', lambda: loads.append(1) or 'value'), 'value')
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.stats, {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_caches_none(self):
+        cache = Cache()
+        cache.get_or_load('a', lambda: None)
+        self.assertIsNone(cache.get_or_load('a', lambda: 'value'))
+
+    def test_invalidate_through_shared_backend(self):
+        shared = LocalSharedCacheBackend()
+        worker, other_worker = Cache(shared=shared), Cache(shared=shared)
+        worker.get_or_load('a', lambda: 'old')
+        self.assertEqual(other_worker.get_or_load('a', lambda: 'unused'), 'old')
+        self.assertEqual(other_worker.hits, 1)
+        worker.invalidate('a')
+        other_worker.local.clear()
+        self.assertEqual(other_worker.get_or_load('a', lambda: 'new'), 'new')
+
+    def test_disabled(self):
+        cache = Cache()
+        cache.configure(enabled=False)
+        cache.get_or_load('a', lambda: 'old')
+        self.assertEqual(cache.get_or_load('a', lambda: 'new'), 'new')
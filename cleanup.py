@@ -0,0 +1,62 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('minigplus.cleanup')
+
+
+class Cleaner(object):
+    """
+    Runs the cleanup of tombstoned documents in a background thread, so that deletes return right away
+    Cleanups run one at a time in submission order. A cleanup that fails or is lost with the process
+        leaves its tombstone behind, for the next sweep to clean up
+    With background off, cleanups run inline in the calling thread
+    """
+
+    def __init__(self, background=False):
+        """
+        :param (bool) background: whether to run cleanups in a background thread
+        """
+        self._executor = None
+        self._lock = threading.Lock()
+        self.configure(background)
+
+    def configure(self, background=False):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            self.background = background
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception('cleanup {} failed, the next sweep retries it'.format(fn.__qualname__))
+
+    def submit(self, fn, *args):
+        """
+        Run a cleanup
+        :param (callable) fn: the cleanup
+        :param args: its arguments
+        """
+        if not self.background:
+            self._run(fn, *args)
+            return
+        with self._lock:
+            if self._executor is None:
+                # Started on first use, so that importing the app does not start threads
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix='cleanup')
+            self._executor.submit(self._run, fn, *args)
+
+    def wait(self):
+        """
+        Wait until all submitted cleanups are done
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+cleaner = Cleaner()
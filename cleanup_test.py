@@ -0,0 +1,36 @@
+import threading
+import unittest
+from cleanup import Cleaner
+
+
+class CleanerTests(unittest.TestCase):
+    def test_inline(self):
+        done = []
+        Cleaner().submit(done.append, 1)
+        self.assertEqual(done, [1])
+
+    def test_background(self):
+        cleaner = Cleaner(background=True)
+        started = threading.Event()
+        release = threading.Event()
+        done = []
+
+        def cleanup(value):
+            started.set()
+            release.wait(5)
+            done.append((value, threading.current_thread() is threading.main_thread()))
+
+        cleaner.submit(cleanup, 1)
+        cleaner.submit(cleanup, 2)
+        self.assertTrue(started.wait(5))
+        self.assertEqual(done, [])
+        release.set()
+        cleaner.wait()
+        self.assertEqual(done, [(1, False), (2, False)])
+
+    def test_logs_failures(self):
+        def cleanup():
+            raise ValueError()
+
+        with self.assertLogs('minigplus.cleanup', 'ERROR'):
+            Cleaner().submit(cleanup)
@@ -1,2 +1,19 @@
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+
 class UnauthorizedAccess(Exception):
     status_code = 401
+
+
+class HashingOverloaded(ServiceUnavailable):
+    description = 'Too many passwords are being checked, try again later'
+
+    def __init__(self, retry_after=1):
+        super(HashingOverloaded, self).__init__(retry_after=retry_after)
+
+
+class SignInThrottled(TooManyRequests):
+    description = 'Too many sign in attempts, try again later'
+
+    def __init__(self, retry_after=1):
+        super(SignInThrottled, self).__init__(retry_after=retry_after)
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+logger = logging.getLogger('minigplus.events')
+
+# Event types. Post events carry the post id, its author, whether it is public and its circles, as strings,
+#     so that subscribers can tell who may see them. Membership events carry the ids of the users whose circles changed
+POST_CREATED = 'post_created'
+POST_DELETED = 'post_deleted'
+COMMENTS_CHANGED = 'comments_changed'
+MEMBERSHIPS_CHANGED = 'memberships_changed'
+
+
+class LocalBroker(object):
+    """
+    Stand-in for a broker that lives in this process, for tests and single process deployments
+    A broker delivers events, dicts that serialize to JSON, to the subscribers of all processes,
+        e.g. backed by redis pub/sub, with these methods:
+        publish(event) publishes an event
+        subscribe(callback) calls callback with every event published after subscribing, from any thread,
+            and returns a function that unsubscribes
+    Callbacks run in the publishing thread
+    """
+
+    def __init__(self):
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback(event)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+        return unsubscribe
+
+
+class Events(object):
+    """
+    Publishes what changes in models.py to viewers that keep an event stream open, see async_api /api/events
+    Publishing is best effort, a failure is logged and never fails the write that published
+    """
+
+    def __init__(self, broker=None):
+        """
+        :param broker: the broker, a LocalBroker by default
+        """
+        self.broker = broker or LocalBroker()
+
+    def configure(self, broker=None):
+        self.broker = broker or LocalBroker()
+
+    def publish(self, event):
+        """
+        :param (dict) event: the event, with its type under 'type'
+        """
+        try:
+            self.broker.publish(event)
+        except Exception:
+            logger.exception('publishing {} failed'.format(event.get('type')))
+
+    def subscribe(self, callback):
+        """
+        :param (callable) callback: called with every event
+        :return (callable): a function that unsubscribes
+        """
+        return self.broker.subscribe(callback)
+
+
+events = Events()
@@ -0,0 +1,60 @@
+import unittest
+from models_test import MongomockTestCase
+from models import User, Circle, Post, Comment
+from events import events, Events, LocalBroker, POST_CREATED, POST_DELETED, COMMENTS_CHANGED, MEMBERSHIPS_CHANGED
+
+
+class LocalBrokerTests(unittest.TestCase):
+    def test_publish_and_unsubscribe(self):
+        broker = LocalBroker()
+        received = []
+        unsubscribe = broker.subscribe(received.append)
+        broker.publish({'type': 'a'})
+        unsubscribe()
+        unsubscribe()
+        broker.publish({'type': 'b'})
+        self.assertEqual(received, [{'type': 'a'}])
+
+    def test_publish_failure_is_swallowed(self):
+        def fail(event):
+            raise ValueError()
+
+        publisher = Events()
+        publisher.subscribe(fail)
+        with self.assertLogs('minigplus.events'):
+            publisher.publish({'type': 'a'})
+
+
+class PublishTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(PublishTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def setUp(self):
+        super(PublishTests, self).setUp()
+        for user_id in ['alice', 'bob']:
+            User.create(user_id, 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.alice.create_circle('friends')
+        self.friends = Circle.objects.get(name='friends')
+        self.received = []
+        self.addCleanup(events.subscribe(self.received.append))
+
+    def test_post_events(self):
+        post = self.alice.create_post('friends only', False, [self.friends])
+        self.alice.create_comment('comment', post)
+        self.alice.delete_post(post)
+        self.assertEqual([event['type'] for event in self.received], [POST_CREATED, COMMENTS_CHANGED, POST_DELETED])
+        self.assertEqual(self.received[0], {
+            'type': POST_CREATED, 'post': str(post.id), 'author': str(self.alice.id),
+            'isPublic': False, 'circles': [str(self.friends.id)]})
+
+        self.alice.toggle_member(self.friends, self.bob)
+        self.assertTrue(self.bob.sees_post(Post.from_event(self.received[0])))
+        self.assertFalse(User.find('alice').sees_post(Post.from_event(dict(self.received[0], author=str(self.bob.id)))))
+
+    def test_membership_events(self):
+        self.alice.toggle_member(self.friends, self.bob)
+        self.alice.delete_circle(Circle.objects.get(id=self.friends.id))
+        self.assertEqual(self.received, [{'type': MEMBERSHIPS_CHANGED, 'users': [str(self.bob.id)]}] * 2)
@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache(object):
+    """
+    Rendered HTML fragments, bounded by their total size with least recently used eviction
+    Entries are grouped by the object they render, so that all of its entries can be dropped at once
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        :param (int) max_bytes: max total size of the fragments, in bytes of their UTF-8 encoding
+        """
+        self.max_bytes = max_bytes
+        self.size = 0  # in bytes
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True
+        self._fragments = OrderedDict()  # (fragment, size in bytes) by (group, key)
+        self._keys_by_group = {}
+        self._lock = threading.Lock()
+
+    def get_or_render(self, group, key, render):
+        """
+        Get a fragment, rendering and caching it on a miss
+        :param group: the object that the fragment renders, e.g. a post id
+        :param key: everything else that the fragment depends on, must be hashable
+        :param (callable) render: renders the fragment
+        :return (str): the fragment
+        """
+        if not self.enabled:
+            return render()
+        with self._lock:
+            entry = self._fragments.get((group, key))
+            if entry is not None:
+                self._fragments.move_to_end((group, key))
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        fragment = render()
+        size = len(fragment.encode('utf-8'))
+        with self._lock:
+            if (group, key) not in self._fragments and size <= self.max_bytes:
+                self._fragments[(group, key)] = (fragment, size)
+                self._keys_by_group.setdefault(group, set()).add(key)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self._remove(*next(iter(self._fragments)))
+        return fragment
+
+    def has(self, group, key):
+        """
+        :return (bool): whether a fragment is cached, without counting a hit or a miss
+        """
+        with self._lock:
+            return self.enabled and (group, key) in self._fragments
+
+    def _remove(self, group, key):
+        self.size -= self._fragments.pop((group, key))[1]
+        keys = self._keys_by_group[group]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_group[group]
+
+    def invalidate(self, group):
+        """
+        Drop all fragments of an object
+        :param group: the object
+        """
+        with self._lock:
+            for key in list(self._keys_by_group.get(group, ())):
+                self._remove(group, key)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self._keys_by_group.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+def post_card_key(viewer, post, path):
+    """
+    Everything besides the post itself that a post card depends on
+    The thread and the circles are part of the card, their changes bump post.version, and which Delete buttons
+        the viewer sees follows from who they are, so the key needs neither loaded
+    :param (User) viewer: the viewing user
+    :param (Post) post: the post
+    :param (str) path: path of the page, reply links point back to it
+    :return (tuple): the key
+    """
+    return viewer.id, post.version, path
+
+
+# Rendered cards/_post.jinja2 cards by post id
+post_cards = FragmentCache()
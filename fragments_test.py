@@ -0,0 +1,107 @@
+import unittest
+from fragments import FragmentCache, post_card_key
+from models import User, Circle, Post, Comment
+from models_test import MongomockTestCase, count_queries
+
+
+class FragmentCacheTests(unittest.TestCase):
+    def test_get_or_render(self):
+        fragments = FragmentCache()
+        renders = []
+        for _ in range(3):
+            self.assertEqual(fragments.get_or_render('post', 'key', lambda: renders.append(1) or '<div>'), '<div>')
+        self.assertEqual(len(renders), 1)
+        self.assertEqual((fragments.hits, fragments.misses, fragments.size), (2, 1, 5))
+
+    def test_evicts_least_recently_used(self):
+        fragments = FragmentCache(max_bytes=10)
+        fragments.get_or_render('a', 'key', lambda: 'aaaa')
+        fragments.get_or_render('b', 'key', lambda: 'bbbb')
+        fragments.get_or_render('a', 'key', lambda: 'a')
+        fragments.get_or_render('c', 'key', lambda: 'cccc')
+        self.assertEqual(fragments.size, 8)
+        self.assertEqual(fragments.get_or_render('a', 'key', lambda: 'new'), 'aaaa')
+        self.assertEqual(fragments.get_or_render('b', 'key', lambda: 'new'), 'new')
+
+    def test_does_not_keep_fragments_larger_than_max(self):
+        fragments = FragmentCache(max_bytes=2)
+        self.assertEqual(fragments.get_or_render('a', 'key', lambda: 'aaaa'), 'aaaa')
+        self.assertEqual((len(fragments), fragments.size), (0, 0))
+
+    def test_invalidate(self):
+        fragments = FragmentCache()
+        fragments.get_or_render('a', 'key1', lambda: 'a1')
+        fragments.get_or_render('a', 'key2', lambda: 'a2')
+        fragments.get_or_render('b', 'key1', lambda: 'b1')
+        fragments.invalidate('a')
+        self.assertEqual((len(fragments), fragments.size), (1, 2))
+        self.assertEqual(fragments.get_or_render('a', 'key1', lambda: 'new'), 'new')
+        self.assertEqual(fragments.get_or_render('b', 'key1', lambda: 'new'), 'b1')
+
+    def test_size_in_bytes(self):
+        fragments = FragmentCache(max_bytes=5)
+        fragments.get_or_render('a', 'key', lambda: '\u00e9\u00e9')
+        self.assertEqual(fragments.size, 4)
+        self.assertEqual(fragments.get_or_render('b', 'key', lambda: '\u00e9\u00e9\u00e9'), '\u00e9\u00e9\u00e9')
+        self.assertEqual((len(fragments), fragments.size), (1, 4))
+
+    def test_has(self):
+        fragments = FragmentCache()
+        self.assertFalse(fragments.has('a', 'key'))
+        fragments.get_or_render('a', 'key', lambda: 'a')
+        self.assertTrue(fragments.has('a', 'key'))
+        self.assertEqual((fragments.hits, fragments.misses), (0, 1))
+        fragments.enabled = False
+        self.assertFalse(fragments.has('a', 'key'))
+
+    def test_disabled(self):
+        fragments = FragmentCache()
+        fragments.enabled = False
+        fragments.get_or_render('a', 'key', lambda: 'a')
+        self.assertEqual(fragments.get_or_render('a', 'key', lambda: 'new'), 'new')
+
+
+class PostCardKeyTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(PostCardKeyTests, self).__init__(*args, **kwargs)
+        self.user1 = User(user_id='user1', password='1')
+        self.user2 = User(user_id='user2', password='2')
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def setUp(self):
+        super(PostCardKeyTests, self).setUp()
+        self.user1.save()
+        self.user2.save()
+
+    def _key(self, viewer, post, path='/'):
+        return post_card_key(viewer, Post.objects.get(id=post.id), path)
+
+    def test_depends_on_comments(self):
+        post = self.user1.create_post('post', True, [])
+        key = self._key(self.user2, post)
+        comment = self.user2.create_comment('comment', post)
+        self.assertNotEqual(self._key(self.user2, post), key)
+        key = self._key(self.user2, post)
+        self.user2.delete_comment(comment, post)
+        self.assertNotEqual(self._key(self.user2, post), key)
+
+    def test_depends_on_circles(self):
+        self.user1.create_circle('friends')
+        circle = Circle.objects.get(name='friends')
+        post = self.user1.create_post('post', False, [circle])
+        key = self._key(self.user1, post)
+        Circle.purge(circle.id)
+        self.assertNotEqual(self._key(self.user1, post), key)
+
+    def test_depends_on_path_and_viewer(self):
+        post = self.user1.create_post('post', True, [])
+        self.assertNotEqual(self._key(self.user2, post, '/'), self._key(self.user2, post, '/profile/user1'))
+        self.assertNotEqual(self._key(self.user1, post), self._key(self.user2, post))
+
+    def test_does_not_load_thread(self):
+        post = self.user1.create_post('post', True, [])
+        self.user2.create_comment('comment', post)
+        post = Post.objects.get(id=post.id)
+        with count_queries() as queries:
+            post_card_key(self.user2, post, '/')
+        self.assertEqual(queries[0], 0)
@@ -0,0 +1,124 @@
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from custom_exceptions import HashingOverloaded
+
+DEFAULT_METHOD = 'pbkdf2:sha256:260000'
+
+
+def _parse_method(method):
+    """
+    :param (str) method: werkzeug hash method, as configured or as it prefixes a hash, e.g. pbkdf2:sha256
+    :return (tuple): the method with its defaults filled in, e.g. ('pbkdf2', 'sha256', 260000)
+    """
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':
+        return tuple(parts)
+    try:
+        iterations = int(parts[2]) if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+    except ValueError:
+        return tuple(parts)
+    return 'pbkdf2', parts[1] if len(parts) > 1 else '', iterations
+
+
+class PasswordHasher(object):
+    """
+    Runs password hashing in a bounded pool of worker processes, so that a burst of sign ins
+        cannot take the CPU of the web workers away from other requests
+    When the pool and its queue are full, new work is rejected right away instead of queueing up
+    With no workers, hashing runs inline in the calling thread
+    """
+
+    def __init__(self, workers=0, queue_size=0, method=DEFAULT_METHOD, timeout_seconds=10):
+        """
+        :param (int) workers: number of worker processes, 0 to hash inline
+        :param (int) queue_size: number of jobs that may wait for a free worker
+        :param (str) method: werkzeug hash method for new hashes, e.g. pbkdf2:sha256:260000
+        :param (float) timeout_seconds: max seconds to wait for a job
+        """
+        self._executor = None
+        self._lock = threading.Lock()
+        self.configure(workers, queue_size, method, timeout_seconds)
+
+    def configure(self, workers=0, queue_size=0, method=DEFAULT_METHOD, timeout_seconds=10):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.workers = workers
+            self.queue_size = queue_size
+            self.method = method
+            self.timeout_seconds = timeout_seconds
+            self._slots = threading.BoundedSemaphore(workers + queue_size) if workers else None
+
+    def _submit(self, fn, *args):
+        """
+        Run a job in the pool
+        :return (Future): the job's result
+        :raise (HashingOverloaded) when the pool and its queue are full
+        """
+        if not self.workers:
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded()
+        with self._lock:
+            if self._executor is None:
+                # Started on first use, so that importing the app does not fork
+                self._executor = ProcessPoolExecutor(self.workers)
+            future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _result(self, future):
+        """
+        Wait for a job
+        :param (Future) future: the job
+        :return: its result
+        :raise (HashingOverloaded) when it does not finish in time, the pool is too busy to serve it
+        """
+        try:
+            return future.result(self.timeout_seconds)
+        except TimeoutError:
+            future.cancel()
+            raise HashingOverloaded()
+
+    def hash(self, password):
+        """
+        :param (str) password: password
+        :return (str): hash of the password with the configured method
+        :raise (HashingOverloaded) when the pool and its queue are full, or the job times out
+        """
+        return self._result(self._submit(generate_password_hash, password, self.method))
+
+    def check(self, password_hash, password):
+        """
+        :param (str) password_hash: stored hash
+        :param (str) password: password
+        :return (bool): whether the password matches the hash
+        :raise (HashingOverloaded) when the pool and its queue are full, or the job times out
+        """
+        return self._result(self._submit(check_password_hash, password_hash, password))
+
+    def needs_rehash(self, password_hash):
+        """
+        :param (str) password_hash: stored hash
+        :return (bool): whether the hash was made with another method or number of iterations than the configured one
+        """
+        return _parse_method(password_hash.split('$', 1)[0]) != _parse_method(self.method)
+
+    def rehash_later(self, password, on_rehashed):
+        """
+        Hash a password with the configured method in the background, skipped when the pool is busy
+        :param (str) password: password
+        :param (callable) on_rehashed: called with the new hash
+        """
+        try:
+            future = self._submit(generate_password_hash, password, self.method)
+        except HashingOverloaded:
+            return
+        future.add_done_callback(lambda done: done.exception() is None and on_rehashed(done.result()))
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,50 @@
+import time
+import unittest
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+from hashing import PasswordHasher
+from custom_exceptions import HashingOverloaded
+
+
+class PasswordHasherTests(unittest.TestCase):
+    def test_inline(self):
+        hasher = PasswordHasher(method='pbkdf2:sha256:1000')
+        password_hash = hasher.hash('password')
+        self.assertTrue(password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(hasher.check(password_hash, 'password'))
+        self.assertFalse(hasher.check(password_hash, 'wrong password'))
+
+    def test_pool(self):
+        hasher = PasswordHasher(workers=1, queue_size=1, method='pbkdf2:sha256:1000')
+        self.addCleanup(hasher.configure)
+        self.assertTrue(hasher.check(hasher.hash('password'), 'password'))
+
+    def test_rejects_when_full(self):
+        hasher = PasswordHasher(workers=1, queue_size=0, method='pbkdf2:sha256:1000')
+        self.addCleanup(hasher.configure)
+        busy = hasher._submit(time.sleep, 1)
+        with self.assertRaises(HashingOverloaded):
+            hasher.hash('password')
+        busy.result()
+        time.sleep(0.1)
+        self.assertTrue(hasher.hash('password'))
+
+    def test_needs_rehash(self):
+        hasher = PasswordHasher(method='pbkdf2:sha256:2000')
+        self.assertTrue(hasher.needs_rehash(PasswordHasher(method='pbkdf2:sha256:1000').hash('password')))
+        self.assertFalse(hasher.needs_rehash(hasher.hash('password')))
+        self.assertTrue(hasher.needs_rehash(PasswordHasher(method='pbkdf2:sha512:2000').hash('password')))
+
+    def test_needs_rehash_default_iterations(self):
+        hasher = PasswordHasher(method='pbkdf2:sha256')
+        password_hash = 'pbkdf2:sha256:{}$salt$hash'.format(DEFAULT_PBKDF2_ITERATIONS)
+        self.assertFalse(hasher.needs_rehash(password_hash))
+        self.assertFalse(PasswordHasher(method=password_hash.split('$')[0]).needs_rehash(password_hash))
+        self.assertTrue(hasher.needs_rehash('pbkdf2:sha256:1000$salt$hash'))
+
+    def test_timeout_overloaded(self):
+        hasher = PasswordHasher(workers=1, queue_size=1, method='pbkdf2:sha256:1000', timeout_seconds=0.1)
+        self.addCleanup(hasher.configure)
+        busy = hasher._submit(time.sleep, 1)
+        with self.assertRaises(HashingOverloaded):
+            hasher.hash('password')
+        busy.result()
@@ -0,0 +1,135 @@
+"""
+The indexes that the models declare, how they compare to the ones in the database, and checks of query plans
+Processes create missing indexes when they first touch a collection, run `flask ensure-indexes` before deploying
+    new ones, so that large collections are not indexed while requests wait
+"""
+from pymongo.errors import OperationFailure
+from models import User, Circle, Post, Comment, TimelineEntry, SearchEntry
+
+# Models whose collections the app queries
+MODELS = [User, Circle, Post, Comment, TimelineEntry, SearchEntry]
+# A query plan that examines more documents than this many per returned one is a problem
+MAX_DOCS_EXAMINED_PER_RETURNED = 10
+# Commands whose plans explain reports, writes are planned without being applied
+EXPLAINABLE_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'findAndModify', 'update', 'delete'}
+# Fields that the driver adds to commands, which explain does not take
+DRIVER_FIELDS = {'$db', '$clusterTime', '$readPreference', 'lsid', 'txnNumber', 'writeConcern', 'readConcern'}
+
+
+def _index_name(keys):
+    """
+    :param (list[tuple[str, int]]) keys: keys of an index
+    :return (str): the name that Mongo gives the index by default, e.g. author_1__id_-1
+    """
+    return '_'.join('{}_{}'.format(field, direction) for field, direction in keys)
+
+
+def _index_usage(collection):
+    """
+    :param (Collection) collection: the collection
+    :return (dict[str, int]|None): operations that used each index since the mongod started, by index name,
+        None where $indexStats is not supported, e.g. on mongomock
+    """
+    try:
+        return {stats['name']: stats['accesses']['ops'] for stats in collection.aggregate([{'$indexStats': {}}])}
+    except (OperationFailure, NotImplementedError):
+        return None
+
+
+def index_report(create=False):
+    """
+    Compare the indexes that the models declare with the ones in the database
+    Usage counts start over when the mongod restarts, so an index is only reported unused after it ran for a while
+    :param (bool) create: whether to create the missing indexes
+    :return (list[dict]): the collection, name and status of every index that is missing, created,
+        undeclared (in the database but declared by no model) or unused (declared and never used), in model order
+    """
+    report = []
+    for document_class in MODELS:
+        collection = document_class._get_collection()
+        compared = document_class.compare_indexes()
+        if create and compared['missing']:
+            document_class.ensure_indexes()
+        for status, indexes in [('created' if create else 'missing', compared['missing']), ('undeclared', compared['extra'])]:
+            report.extend({'collection': collection.name, 'index': _index_name(keys), 'status': status} for keys in indexes)
+        declared = {_index_name(spec['fields']) for spec in document_class._meta['index_specs']}
+        for name, ops in sorted((_index_usage(collection) or {}).items()):
+            if ops == 0 and name in declared:
+                report.append({'collection': collection.name, 'index': name, 'status': 'unused'})
+    return report
+
+
+def explainable(command):
+    """
+    The commands to explain for a command that the driver sent
+    :param (dict) command: the command, as a CommandListener receives it
+    :return (list[dict]): the commands, one per statement of an update or delete, none if it is not a query
+    """
+    name = next(iter(command))
+    if name not in EXPLAINABLE_COMMANDS:
+        return []
+    command = {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+    if name in ('update', 'delete'):
+        statements = 'updates' if name == 'update' else 'deletes'
+        return [dict(command, **{statements: [statement]}) for statement in command[statements]]
+    return [command]
+
+
+def explain(database, command):
+    """
+    :param (Database) database: database of a mongod
+    :param (dict) command: an explainable command, see explainable
+    :return (dict): the plan of the command and how it executed
+    """
+    return database.command({'explain': command, 'verbosity': 'executionStats'})
+
+
+def _query_layers(explanation):
+    """
+    :return (iterable[tuple[dict, dict]]): query planner and execution stats of each query in an explanation,
+        one for a find, one per $cursor stage of an aggregation
+    """
+    if isinstance(explanation, dict):
+        if 'queryPlanner' in explanation:
+            yield explanation['queryPlanner'], explanation.get('executionStats') or {}
+            return
+        values = explanation.values()
+    elif isinstance(explanation, list):
+        values = explanation
+    else:
+        return
+    for value in values:
+        yield from _query_layers(value)
+
+
+def _stages(plan):
+    """
+    :return (iterable[str]): names of the stages of a plan tree
+    """
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+def plan_problems(explanation, max_docs_examined_per_returned=MAX_DOCS_EXAMINED_PER_RETURNED):
+    """
+    What is wrong with the plan of a query: a collection scan, or many documents examined per returned one
+    :param (dict) explanation: output of explain in executionStats verbosity
+    :param (float) max_docs_examined_per_returned: most documents a query may examine per document it returns
+    :return (list[str]): the problems, empty if there are none
+    """
+    problems = []
+    for planner, stats in _query_layers(explanation):
+        namespace = planner.get('namespace')
+        if 'COLLSCAN' in _stages(planner.get('winningPlan')):
+            problems.append('{}: COLLSCAN'.format(namespace))
+        examined = stats.get('totalDocsExamined', 0)
+        returned = stats.get('nReturned', 0)
+        if examined > max(returned, 1) * max_docs_examined_per_returned:
+            problems.append('{}: examined {} documents for {} returned'.format(namespace, examined, returned))
+    return problems
@@ -0,0 +1,185 @@
+"""
+Run the query plan checks of the routes against a throwaway database of a local mongod, which they drop first:
+
+    MONGODB_TEST_URI=mongodb://localhost:27017/minigplus-plans python -m pytest indexes_test.py
+
+Without MONGODB_TEST_URI they are skipped, mongomock has no query planner
+"""
+import os
+import unittest
+from bson.objectid import ObjectId
+from mongoengine import disconnect
+from mongoengine.connection import get_db
+from pymongo import monitoring
+from models_test import MongomockTestCase
+from models import User, Circle, Post, Comment, TimelineEntry, SearchEntry, cache
+from indexes import index_report, explainable, explain, plan_problems, MODELS
+
+MONGODB_TEST_URI = os.environ.get('MONGODB_TEST_URI')
+
+
+def _find_explanation(stage, returned, examined):
+    return {
+        'queryPlanner': {'namespace': 'minigplus.post', 'winningPlan': {'stage': 'LIMIT', 'inputStage': stage}},
+        'executionStats': {'nReturned': returned, 'totalDocsExamined': examined}
+    }
+
+
+class PlanProblemsTests(unittest.TestCase):
+    def test_index_scan(self):
+        stage = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'author_1__id_-1'}}
+        self.assertEqual(plan_problems(_find_explanation(stage, 20, 20)), [])
+        self.assertEqual(plan_problems(_find_explanation(stage, 0, 0)), [])
+        self.assertEqual(
+            plan_problems(_find_explanation(stage, 2, 500)),
+            ['minigplus.post: examined 500 documents for 2 returned'])
+
+    def test_collection_scan(self):
+        self.assertEqual(
+            plan_problems(_find_explanation({'stage': 'COLLSCAN'}, 1, 1)),
+            ['minigplus.post: COLLSCAN'])
+
+    def test_aggregation(self):
+        explanation = {'stages': [
+            {'$cursor': _find_explanation({'stage': 'COLLSCAN'}, 5, 5)},
+            {'$group': {'_id': '$post'}}
+        ]}
+        self.assertEqual(plan_problems(explanation), ['minigplus.post: COLLSCAN'])
+
+    def test_explainable(self):
+        self.assertEqual(explainable({'insert': 'post', 'documents': []}), [])
+        self.assertEqual(
+            explainable({'find': 'post', 'filter': {}, 'lsid': {}, '$db': 'minigplus'}),
+            [{'find': 'post', 'filter': {}}])
+        self.assertEqual(
+            explainable({'delete': 'comment', 'deletes': [{'q': {'a': 1}}, {'q': {'b': 1}}], 'ordered': False}),
+            [{'delete': 'comment', 'deletes': [{'q': {'a': 1}}], 'ordered': False},
+             {'delete': 'comment', 'deletes': [{'q': {'b': 1}}], 'ordered': False}])
+
+
+class IndexReportTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(IndexReportTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend(MODELS)
+
+    def test_report(self):
+        self.assertEqual(index_report(), [])
+        Comment._get_collection().drop_index('author_1')
+        Post._get_collection().create_index('content')
+        self.assertEqual(index_report(), [
+            {'collection': 'post', 'index': 'content_1', 'status': 'undeclared'},
+            {'collection': 'comment', 'index': 'author_1', 'status': 'missing'}
+        ])
+        self.assertEqual(index_report(create=True), [
+            {'collection': 'post', 'index': 'content_1', 'status': 'undeclared'},
+            {'collection': 'comment', 'index': 'author_1', 'status': 'created'}
+        ])
+        self.assertIn('author_1', Comment._get_collection().index_information())
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    Keeps the commands that Mongo clients created after it send
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.recording = False
+
+    def started(self, event):
+        if self.recording:
+            self.commands.append(event.command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@unittest.skipUnless(MONGODB_TEST_URI, 'set MONGODB_TEST_URI to the uri of a throwaway mongod database')
+class RoutePlanTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.recorder = CommandRecorder()
+        monitoring.register(cls.recorder)
+        os.environ['MONGODB_URI'] = MONGODB_TEST_URI
+        from app import app
+        from flask_jwt_extended import create_access_token
+        from cleanup import cleaner
+        from fragments import post_cards
+        from benchmarks import connect_database, sign_in
+        from benchmarks.datagen import generate, PASSWORD
+        connect_database(MONGODB_TEST_URI)
+        # every lookup goes to the database, and purges run in the request that deletes
+        cache.configure(enabled=False)
+        post_cards.enabled = False
+        cleaner.configure(background=False)
+        generate(users=200)
+        SearchEntry.rebuild()
+        TimelineEntry.backfill()
+        index_report(create=True)
+        cls.client = app.test_client()
+        sign_in(cls.client, 'user0', PASSWORD)
+        with app.app_context():
+            cls.token = create_access_token(identity=User.find('user0'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.recorder.recording = False
+        disconnect()
+
+    def _check(self, method, path, **kwargs):
+        """
+        Send a request, and explain every query it sent
+        """
+        self.recorder.commands = []
+        self.recorder.recording = True
+        try:
+            response = self.client.open(path, method=method, **kwargs)
+        finally:
+            self.recorder.recording = False
+        self.assertLess(response.status_code, 400, '{} {}'.format(method, path))
+        self.assertTrue(self.recorder.commands, '{} {} sent no queries'.format(method, path))
+        problems = [
+            '{}: {}'.format(next(iter(command)), problem)
+            for recorded in self.recorder.commands
+            for command in explainable(recorded)
+            for problem in plan_problems(explain(get_db(), command))
+        ]
+        self.assertEqual(problems, [], '{} {}'.format(method, path))
+
+    def test_routes(self):
+        viewer = User.find('user0')
+        post = Post.objects(is_public=True, comment_count__gt=0).first()
+        comment = Comment.objects(post=post.id).first()
+        own_post = Post.objects(author=viewer.id).first()
+        circle = Circle.objects(owner=viewer.id).first()
+        other_user = User.objects(user_id='user1').first()
+        word = SearchEntry.objects.first().keywords[0]
+        api = {'headers': {'Authorization': 'Bearer ' + self.token}}
+        for method, path, kwargs in [
+            ('GET', '/', {}),
+            ('GET', '/?before={}'.format(ObjectId()), {}),
+            ('GET', '/profile/user1', {}),
+            ('GET', '/users', {}),
+            ('GET', '/users?q=user1', {}),
+            ('GET', '/circles', {}),
+            ('GET', '/search?q={}'.format(word), {}),
+            ('GET', '/posts/{}/comments'.format(post.id), {}),
+            ('GET', '/posts/{}/card'.format(own_post.id), {}),
+            ('GET', '/reply/{}/{}'.format(post.id, comment.id), {}),
+            ('POST', '/add-post', {'data': {'content': 'plans', 'circles': [str(circle.id)]}}),
+            ('POST', '/add-comment', {'data': {'post_id': str(own_post.id), 'content': 'plans'}}),
+            ('POST', '/toggle-member', {'data': {'circle_id': str(circle.id), 'user_id': str(other_user.id)}}),
+            ('POST', '/rename-circle', {'data': {'id': str(circle.id), 'name': 'renamed'}}),
+            ('POST', '/rm-post', {'data': {'id': str(own_post.id)}}),
+            ('GET', '/api/me', api),
+            ('GET', '/api/users', api),
+            ('GET', '/api/users?q=user1', api),
+            ('GET', '/api/posts', api),
+            ('GET', '/api/posts/{}/comments'.format(post.id), api),
+            ('GET', '/api/search?q={}'.format(word), api)
+        ]:
+            with self.subTest(method=method, path=path):
+                self._check(method, path, **kwargs)
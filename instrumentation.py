@@ -0,0 +1,214 @@
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from flask import request, request_started, before_render_template, template_rendered
+from pymongo import monitoring
+
+logger = logging.getLogger('minigplus.requests')
+
+# Upper bounds in seconds of the histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the histogram buckets for queries per request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def query_shape(command):
+    """
+    What a command queries, without any values, which may hold password hashes or the content of posts
+    :param (dict) command: a Mongo command
+    :return (dict): the top level filter keys, sort keys and pipeline stages of the command, and how many documents
+        it inserts, updates or deletes
+    """
+    shape = {}
+    for field in ['filter', 'query', 'sort']:
+        if isinstance(command.get(field), dict):
+            shape[field] = list(command[field])
+    for field in ['updates', 'deletes']:
+        if field in command:
+            shape[field] = [list(statement.get('q', {})) for statement in command[field]]
+    if 'documents' in command:
+        shape['documents'] = len(command['documents'])
+    if 'pipeline' in command:
+        shape['pipeline'] = [next(iter(stage), None) for stage in command['pipeline']]
+    return shape
+
+
+class RequestMetrics(object):
+    """
+    What a single request spent its time on
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.queries = []  # list of (command name, collection, milliseconds, query shape)
+        self._started_commands = {}
+        self.db_ms = 0.0
+        self.template_ms = 0.0
+        self._template_started_at = None
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+    @property
+    def total_ms(self):
+        return (time.perf_counter() - self.started_at) * 1000
+
+
+class Histogram(object):
+    """
+    Cumulative histogram in the Prometheus sense
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """
+        :param (str) name: metric name
+        :param (str) labels: rendered labels, e.g. route="index"
+        :return (list[str]): lines in the Prometheus text format
+        """
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, upper_bound, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+
+class Instrumentation(monitoring.CommandListener):
+    """
+    Records query count, DB time, template render time and total time of each request
+    Exposes them as a Server-Timing header, a structured log line and per route histograms at /metrics,
+        and logs the shape of every query of requests slower than SLOW_REQUEST_MS, see query_shape
+    Must be created before the Mongo client, which only reports to listeners registered before it is created
+    """
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.histograms = {}  # type: dict[tuple[str, str], Histogram]
+        self.gauges = {}  # type: dict[str, callable]
+        monitoring.register(self)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_REQUEST_MS', 500)
+        request_started.connect(self._request_started, app)
+        before_render_template.connect(self._before_render_template, app)
+        template_rendered.connect(self._template_rendered, app)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+        self.slow_request_ms = lambda: app.config['SLOW_REQUEST_MS']
+
+    @property
+    def current(self):
+        """
+        :return (RequestMetrics|None): metrics of the request handled by this thread
+        """
+        return getattr(self._local, 'metrics', None)
+
+    # Mongo commands
+
+    def started(self, event):
+        if self.current is not None:
+            self.current._started_commands[event.request_id] = event.command
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        metrics = self.current
+        if metrics is None:
+            return
+        command = metrics._started_commands.pop(event.request_id, {})
+        milliseconds = event.duration_micros / 1000.0
+        metrics.queries.append((event.command_name, command.get(event.command_name), milliseconds, query_shape(command)))
+        metrics.db_ms += milliseconds
+
+    # Flask signals
+
+    def _request_started(self, sender, **extra):
+        self._local.metrics = RequestMetrics()
+
+    def _before_render_template(self, sender, template, context, **extra):
+        if self.current is not None:
+            self.current._template_started_at = time.perf_counter()
+
+    def _template_rendered(self, sender, template, context, **extra):
+        metrics = self.current
+        if metrics is not None and metrics._template_started_at is not None:
+            metrics.template_ms += (time.perf_counter() - metrics._template_started_at) * 1000
+            metrics._template_started_at = None
+
+    def _after_request(self, response):
+        metrics = self.current
+        self._local.metrics = None
+        if metrics is None or request.endpoint == 'metrics':
+            return response
+        total_ms = metrics.total_ms
+        route = request.endpoint or 'unmatched'
+        response.headers['Server-Timing'] = ', '.join([
+            'db;dur={:.1f};desc="{} queries"'.format(metrics.db_ms, metrics.query_count),
+            'tpl;dur={:.1f}'.format(metrics.template_ms),
+            'total;dur={:.1f}'.format(total_ms)
+        ])
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'queries': metrics.query_count,
+            'db_ms': round(metrics.db_ms, 1),
+            'template_ms': round(metrics.template_ms, 1),
+            'total_ms': round(total_ms, 1)
+        }))
+        if total_ms >= self.slow_request_ms():
+            logger.warning('slow request {} {} took {:.1f} ms, queries:\n{}'.format(
+                request.method, request.path, total_ms, '\n'.join(
+                    '  {:.1f} ms {} {} {}'.format(milliseconds, command_name, collection, shape)
+                    for command_name, collection, milliseconds, shape in metrics.queries)))
+        with self._lock:
+            for name, buckets, value in [
+                ('http_request_duration_seconds', DURATION_BUCKETS, total_ms / 1000),
+                ('http_request_db_duration_seconds', DURATION_BUCKETS, metrics.db_ms / 1000),
+                ('http_request_template_duration_seconds', DURATION_BUCKETS, metrics.template_ms / 1000),
+                ('http_request_db_queries', QUERY_COUNT_BUCKETS, metrics.query_count)
+            ]:
+                key = (name, route)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+        return response
+
+    # Prometheus endpoint
+
+    def metrics(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append('# TYPE {} histogram'.format(name))
+                for (histogram_name, route), histogram in sorted(self.histograms.items()):
+                    if histogram_name == name:
+                        lines.extend(histogram.render(name, 'route="{}"'.format(route)))
+        for name, value in sorted(self.gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value()))
+        return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
@@ -0,0 +1,56 @@
+import unittest
+from types import SimpleNamespace
+from flask import Flask, render_template_string
+from instrumentation import Instrumentation
+
+
+class InstrumentationTests(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.instrumentation = instrumentation = Instrumentation(self.app)
+
+        commands = [
+            {'find': 'user', 'filter': {'user_id': 'alice', 'password': 'pbkdf2:sha256:1000$salt$hash'}},
+            {'insert': 'user', 'documents': [{'user_id': 'bob', 'password': 'pbkdf2:sha256:1000$salt$hash'}]}
+        ]
+
+        @self.app.route('/page')
+        def page():
+            for request_id, command in enumerate(commands):
+                instrumentation.started(SimpleNamespace(request_id=request_id, command=command))
+                instrumentation.succeeded(SimpleNamespace(
+                    request_id=request_id, command_name=next(iter(command)), duration_micros=1500))
+            return render_template_string('{{ value }}', value='rendered')
+
+        self.client = self.app.test_client()
+
+    def test_server_timing(self):
+        response = self.client.get('/page')
+        self.assertEqual(response.data, b'rendered')
+        server_timing = response.headers['Server-Timing']
+        self.assertIn('db;dur=3.0;desc="2 queries"', server_timing)
+        self.assertIn('tpl;dur=', server_timing)
+        self.assertIn('total;dur=', server_timing)
+
+    def test_metrics(self):
+        self.client.get('/page')
+        self.client.get('/page')
+        metrics = self.client.get('/metrics').data.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', metrics)
+        self.assertIn('http_request_duration_seconds_count{route="page"} 2', metrics)
+        self.assertIn('http_request_db_queries_bucket{route="page",le="2"} 2', metrics)
+        self.assertIn('http_request_db_queries_bucket{route="page",le="1"} 0', metrics)
+        self.assertIn('http_request_db_duration_seconds_sum{route="page"} 0.006', metrics)
+
+    def test_logs_slow_request_queries(self):
+        self.app.config['SLOW_REQUEST_MS'] = 0
+        with self.assertLogs('minigplus.requests', 'WARNING') as logs:
+            self.client.get('/page')
+        self.assertIn("find user {'filter': ['user_id', 'password']}", logs.output[0])
+        self.assertIn("insert user {'documents': 1}", logs.output[0])
+        self.assertNotIn('alice', logs.output[0])
+        self.assertNotIn('hash', logs.output[0])
+
+    def test_ignores_queries_outside_requests(self):
+        self.instrumentation.succeeded(SimpleNamespace(request_id=0, command_name='find', duration_micros=1500))
+        self.assertIsNone(self.instrumentation.current)
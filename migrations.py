@@ -0,0 +1,202 @@
+import logging
+from pymongo import UpdateOne
+from models import User, Circle, Post, Comment, cache
+
+logger = logging.getLogger('minigplus.cleanup')
+
+BATCH_SIZE = 1000
+
+
+def migrate_comment_threads():
+    """
+    Convert comments stored as lists of references in Post.comments and Comment.comments
+        into comments that carry their post and ancestors, then drop the lists
+    Comments that no post reaches are left as they are
+    :return (int): number of migrated comments
+    """
+    posts = Post._get_collection()
+    comments = Comment._get_collection()
+    migrated = 0
+    updates = []
+    for post in posts.find({'comments': {'$exists': True}}, {'comments': 1}):
+        visited = set()
+        level = [(comment_id, []) for comment_id in post['comments']]
+        while level:
+            replies = {
+                comment['_id']: comment.get('comments', [])
+                for comment in comments.find({'_id': {'$in': [comment_id for comment_id, _ in level]}}, {'comments': 1})
+            }
+            next_level = []
+            for comment_id, ancestors in level:
+                if comment_id not in replies or comment_id in visited:
+                    continue
+                visited.add(comment_id)
+                updates.append(UpdateOne({'_id': comment_id}, {'$set': {'post': post['_id'], 'ancestors': ancestors}}))
+                next_level.extend((reply_id, ancestors + [comment_id]) for reply_id in replies[comment_id])
+            level = next_level
+            if len(updates) >= BATCH_SIZE:
+                comments.bulk_write(updates, ordered=False)
+                migrated += len(updates)
+                updates = []
+    if updates:
+        comments.bulk_write(updates, ordered=False)
+        migrated += len(updates)
+    posts.update_many({'comments': {'$exists': True}}, {'$unset': {'comments': ''}})
+    comments.update_many({'comments': {'$exists': True}}, {'$unset': {'comments': ''}})
+    return migrated
+
+
+def _backfill_batch(collection, documents, with_circles):
+    """
+    Write the snapshots of a batch of documents where they are missing or differ from the referenced documents
+    :param (Collection) collection: the collection, of posts or comments
+    :param (list[dict]) documents: the documents, with their references and snapshots
+    :param (bool) with_circles: whether the documents are posts, which also snapshot the names of their circles
+    :return (int): number of updated documents
+    """
+    author_ids = list({document['author'] for document in documents if 'author' in document})
+    user_ids = {
+        user['_id']: user['user_id']
+        for user in User._get_collection().find({'_id': {'$in': author_ids}}, {'user_id': 1})
+    }
+    circle_ids = list({circle_id for document in documents for circle_id in document.get('circles') or []})
+    circle_names = {
+        circle['_id']: circle['name']
+        for circle in Circle._get_collection().find({'_id': {'$in': circle_ids}}, {'name': 1})
+    } if circle_ids else {}
+    updates = []
+    for document in documents:
+        snapshots = {}
+        if document.get('author') in user_ids:
+            snapshots['author_user_id'] = user_ids[document['author']]
+        if with_circles:
+            snapshots['circle_names'] = {
+                str(circle_id): circle_names[circle_id]
+                for circle_id in document.get('circles') or [] if circle_id in circle_names
+            }
+        changed = {field: value for field, value in snapshots.items() if document.get(field) != value}
+        if changed:
+            update = {'$set': changed}
+            if 'circle_names' in changed:
+                # cached cards show the names of the circles
+                update['$inc'] = {'version': 1}
+            updates.append(UpdateOne({'_id': document['_id']}, update))
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+def backfill_snapshots():
+    """
+    Write the author and circle snapshots of posts and comments that were written before snapshots existed,
+        and repair the ones that went stale, e.g. when the propagation of a circle rename was lost
+    Documents are read and written BATCH_SIZE at a time, with one query per referenced collection and batch
+    :return (int): number of updated documents
+    """
+    updated = 0
+    for collection, fields, with_circles in [
+        (Post._get_collection(), {'author': 1, 'author_user_id': 1, 'circles': 1, 'circle_names': 1}, True),
+        (Comment._get_collection(), {'author': 1, 'author_user_id': 1}, False)
+    ]:
+        batch = []
+        for document in collection.find({}, fields):
+            batch.append(document)
+            if len(batch) >= BATCH_SIZE:
+                updated += _backfill_batch(collection, batch, with_circles)
+                batch = []
+        if batch:
+            updated += _backfill_batch(collection, batch, with_circles)
+    return updated
+
+
+def _count_by(collection, field):
+    """
+    :return (dict): number of documents that are not tombstones by value of a field
+    """
+    return {
+        group['_id']: group['count']
+        for group in collection.aggregate([
+            {'$match': {'deleted': {'$ne': True}}},
+            {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}
+        ])
+    }
+
+
+def _repair(collection, counts_by_field):
+    """
+    Set counter fields of every document of a collection to their counted values, where they differ
+    :param (Collection) collection: the collection
+    :param (dict) counts_by_field: counted values by document id, by counter field name
+    :return (list[ObjectId]): ids of the repaired documents
+    """
+    repaired = []
+    updates = []
+    for document in collection.find({}, {field: 1 for field in counts_by_field}):
+        counters = {field: counts.get(document['_id'], 0) for field, counts in counts_by_field.items()}
+        if any(document.get(field) != count for field, count in counters.items()):
+            updates.append(UpdateOne({'_id': document['_id']}, {'$set': counters}))
+            repaired.append(document['_id'])
+        if len(updates) >= BATCH_SIZE:
+            collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+    return repaired
+
+
+def reconcile_counters():
+    """
+    Recompute the counter caches Post.comment_count, User.post_count and User.circle_count from the documents they count,
+        and repair the ones that drifted
+    Counts are grouped in the database, writes racing the command may leave counters off until the next run
+    :return (int): number of repaired documents
+    """
+    repaired_posts = _repair(Post._get_collection(), {
+        'comment_count': _count_by(Comment._get_collection(), 'post')
+    })
+    repaired_users = _repair(User._get_collection(), {
+        'post_count': _count_by(Post._get_collection(), 'author'),
+        'circle_count': _count_by(Circle._get_collection(), 'owner')
+    })
+    cache.invalidate(*['user:{}'.format(user_id) for user_id in repaired_users])
+    return len(repaired_posts) + len(repaired_users)
+
+
+def _missing_ids(collection, ids):
+    """
+    :return (list[ObjectId]): the ids that no document of a collection has
+    """
+    missing = []
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start + BATCH_SIZE]
+        found = {document['_id'] for document in collection.find({'_id': {'$in': batch}}, {'_id': 1})}
+        missing.extend(id for id in batch if id not in found)
+    return missing
+
+
+def collect_garbage():
+    """
+    Purge tombstones whose background cleanup never ran, and delete orphaned comments:
+        comments of posts that no longer exist, replies to comments that no longer exist,
+        and comments that belong to no post, which deleting posts before materialized comment threads left behind
+    :return (dict): number of purged tombstones and of deleted orphaned comments
+    """
+    purged = 0
+    for document_class in [User, Circle, Post, Comment]:
+        for document in document_class._get_collection().find({'deleted': True}, {'_id': 1}):
+            document_class.purge(document['_id'])
+            purged += 1
+
+    comments = Comment._get_collection()
+    orphaned = 0
+    missing_post_ids = _missing_ids(Post._get_collection(), [id for id in comments.distinct('post') if id is not None])
+    if missing_post_ids:
+        orphaned += comments.delete_many({'post': {'$in': missing_post_ids}}).deleted_count
+    missing_comment_ids = _missing_ids(comments, comments.distinct('ancestors'))
+    for start in range(0, len(missing_comment_ids), BATCH_SIZE):
+        orphaned += Comment.bulk_delete({'ancestors': {'$in': missing_comment_ids[start:start + BATCH_SIZE]}})
+    if Post._get_collection().find_one({'comments': {'$exists': True}}, {'_id': 1}):
+        logger.warning('comments without a post are kept until migrate_comment_threads has run')
+    else:
+        orphaned += comments.delete_many({'post': {'$exists': False}}).deleted_count
+    return {'tombstones': purged, 'orphaned_comments': orphaned}
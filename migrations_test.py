@@ -0,0 +1,120 @@
+from bson.objectid import ObjectId
+from models_test import MongomockTestCase
+from models import User, Circle, Post, Comment
+from unittest.mock import patch
+from migrations import migrate_comment_threads, backfill_snapshots, reconcile_counters, collect_garbage
+from cleanup import cleaner
+
+
+class MigrateCommentThreadsTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(MigrateCommentThreadsTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Post, Comment])
+
+    def test_migrate(self):
+        User.create('alice', 'password')
+        alice = User.find('alice')
+        posts = Post._get_collection()
+        comments = Comment._get_collection()
+        reply_to_reply_id = comments.insert_one({'author': alice.id, 'content': 'reply to reply', 'comments': []}).inserted_id
+        reply_id = comments.insert_one({'author': alice.id, 'content': 'reply', 'comments': [reply_to_reply_id]}).inserted_id
+        first_id = comments.insert_one({'author': alice.id, 'content': 'first', 'comments': [reply_id]}).inserted_id
+        orphan_id = comments.insert_one({'author': alice.id, 'content': 'orphan', 'comments': []}).inserted_id
+        post_id = posts.insert_one({
+            'author': alice.id, 'content': 'post', 'is_public': True, 'circles': [], 'comments': [first_id]
+        }).inserted_id
+
+        self.assertEqual(migrate_comment_threads(), 3)
+
+        self.assertEqual(comments.count_documents({'comments': {'$exists': True}}), 0)
+        self.assertEqual(posts.count_documents({'comments': {'$exists': True}}), 0)
+        self.assertNotIn('post', comments.find_one({'_id': orphan_id}))
+        post = Post.objects.get(id=post_id)
+        self.assertEqual([comment.content for comment in post.comments], ['first'])
+        self.assertEqual([comment.content for comment in post.comments[0].comments], ['reply'])
+        self.assertEqual(
+            [ancestor.id for ancestor in post.comments[0].comments[0].comments[0].ancestors],
+            [first_id, reply_id])
+
+
+class ReconcileCountersTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(ReconcileCountersTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def test_reconcile(self):
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        alice = User.find('alice')
+        bob = User.find('bob')
+        alice.create_circle('friends')
+        post = alice.create_post('post', True, [])
+        bob.create_post('bob post', True, [])
+        first = bob.create_comment('first', post)
+        bob.create_nested_comment('reply', first, post)
+        User.objects(id=alice.id).update_one(set__post_count=5, unset__circle_count=True)
+        Post.objects(id=post.id).update_one(set__comment_count=0)
+
+        self.assertEqual(reconcile_counters(), 2)
+
+        self.assertEqual(Post.objects.get(id=post.id).comment_count, 2)
+        alice = User.get(alice.id)
+        self.assertEqual((alice.post_count, alice.circle_count), (1, 1))
+        self.assertEqual(reconcile_counters(), 0)
+
+
+class BackfillSnapshotsTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(BackfillSnapshotsTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def test_backfill(self):
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        alice = User.find('alice')
+        bob = User.find('bob')
+        alice.create_circle('friends')
+        friends = Circle.objects.get(name='friends')
+        alice.toggle_member(friends, bob)
+        posts = [alice.create_post('post {}'.format(i), False, [friends]) for i in range(3)]
+        comment = bob.create_comment('comment', posts[0])
+        for document_class in [Post, Comment]:
+            document_class._get_collection().update_many({}, {'$unset': {'author_user_id': '', 'circle_names': ''}})
+        Circle.objects(id=friends.id).update_one(set__name='close friends')
+
+        with patch('migrations.BATCH_SIZE', 2):
+            self.assertEqual(backfill_snapshots(), 4)
+        self.assertEqual(backfill_snapshots(), 0)
+
+        post = Post.objects.get(id=posts[0].id)
+        self.assertEqual(post.author_user_id, 'alice')
+        self.assertEqual(post.circle_names, {str(friends.id): 'close friends'})
+        self.assertEqual(post.version, posts[0].version + 2)
+        self.assertEqual(Comment.objects.get(id=comment.id).author_user_id, 'bob')
+
+
+class CollectGarbageTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(CollectGarbageTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def test_collect(self):
+        User.create('alice', 'password')
+        alice = User.find('alice')
+        post = alice.create_post('post', True, [])
+        first = alice.create_comment('first', post)
+        alice.create_nested_comment('reply', first, post)
+        comments = Comment._get_collection()
+        comments.insert_one({'author': alice.id, 'content': 'orphan'})
+        comments.insert_one({'author': alice.id, 'content': 'orphan of a post', 'post': ObjectId(), 'ancestors': []})
+        comments.delete_one({'_id': first.id})
+        with patch.object(cleaner, 'submit'):
+            deleted_post = alice.create_post('deleted post', True, [])
+            alice.delete_post(deleted_post)
+
+        self.assertEqual(collect_garbage(), {'tombstones': 1, 'orphaned_comments': 3})
+
+        self.assertEqual(comments.count_documents({}), 0)
+        self.assertEqual([p.id for p in Post.objects()], [post.id])
+        self.assertEqual(Post._get_collection().count_documents({}), 1)
+        self.assertEqual(collect_garbage(), {'tombstones': 0, 'orphaned_comments': 0})
@@ -1,8 +1,135 @@
+import itertools
+import math
+import re
 import time
 from flask_login import UserMixin
-from mongoengine import Document, ListField, BooleanField, ReferenceField, StringField, PULL, CASCADE, NotUniqueError
-from werkzeug.security import generate_password_hash, check_password_hash
+from mongoengine import Document, ListField, BooleanField, IntField, ReferenceField, StringField, DictField, PULL, CASCADE
+from mongoengine import NotUniqueError
+from mongoengine import queryset_manager
+from mongoengine.base import BaseList
+from bson.objectid import ObjectId
+from pymongo import UpdateOne, DeleteOne
 from custom_exceptions import UnauthorizedAccess
+from cache import Cache
+from hashing import hasher
+from fragments import post_cards
+from cleanup import cleaner
+from events import events, POST_CREATED, POST_DELETED, COMMENTS_CHANGED, MEMBERSHIPS_CHANGED
+
+POSTS_PER_PAGE = 20
+# Threads are collapsed to the first top level comments of a post, the first replies of a comment,
+#     and a few levels of replies, the rest is loaded a page at a time
+COMMENTS_PER_POST = 5
+REPLIES_PER_COMMENT = 3
+REPLY_LEVELS = 3
+USERS_PER_PAGE = 50
+SEARCH_RESULTS_PER_PAGE = 20
+# Words of a search beyond this many are ignored
+MAX_SEARCH_TERMS = 8
+
+# Users and their circles, invalidated by the methods that write them
+cache = Cache()
+
+
+def _reference_ids(document, field_name):
+    """
+    Ids in a list of references, without dereferencing them
+    :param (Document) document: the document
+    :param (str) field_name: name of a list of references field
+    :return (list[ObjectId]): referenced ids
+    """
+    return [getattr(value, 'id', value) for value in document._data.get(field_name) or []]
+
+
+def _reference_id(document, field_name):
+    """
+    Id in a reference, without dereferencing it
+    :param (Document) document: the document
+    :param (str) field_name: name of a reference field
+    :return (ObjectId): referenced id
+    """
+    value = document._data.get(field_name)
+    return getattr(value, 'id', value)
+
+
+def _hydrate_reference(document, field_name, loaded):
+    """
+    Replace a reference with an already loaded document
+    :param (Document) document: the document
+    :param (str) field_name: name of a reference field
+    :param (dict[ObjectId, Document]) loaded: loaded documents by id
+    """
+    referenced_id = _reference_id(document, field_name)
+    if referenced_id in loaded:
+        document._data[field_name] = loaded[referenced_id]
+
+
+def _hydrate_references(document, field_name, loaded):
+    """
+    Replace a list of references with already loaded documents, so that it is not dereferenced again
+    :param (Document) document: the document
+    :param (str) field_name: name of a list of references field
+    :param (dict[ObjectId, Document]) loaded: loaded documents by id
+    """
+    hydrated = BaseList(
+        [loaded[referenced_id] for referenced_id in _reference_ids(document, field_name) if referenced_id in loaded],
+        document,
+        field_name)
+    hydrated._dereferenced = True
+    document._data[field_name] = hydrated
+
+
+def _hydrate_author_snapshots(documents):
+    """
+    Replace the author references of documents with users built from their author_user_id snapshots, without a query
+    Only the ids and user ids of these users are loaded
+    :param (list[Document]) documents: posts or comments, hydrated in place
+    :return (list[Document]): the documents without a snapshot, written before snapshots and not backfilled yet
+    """
+    authors = {}
+    missing = []
+    for document in documents:
+        author_user_id = document._data.get('author_user_id')
+        if author_user_id is None:
+            missing.append(document)
+            continue
+        author_id = _reference_id(document, 'author')
+        if author_id not in authors:
+            authors[author_id] = User._from_son({'_id': author_id, 'user_id': author_user_id})
+        document._data['author'] = authors[author_id]
+    return missing
+
+
+def _hydrate_authors(documents):
+    """
+    Hydrate the authors of documents from their snapshots, and load the ones without a snapshot with one query
+    :param (list[Document]) documents: documents with an author reference field, hydrated in place
+    """
+    documents = _hydrate_author_snapshots(documents)
+    author_ids = {_reference_id(document, 'author') for document in documents}
+    authors = {author.id: author for author in User.objects(id__in=list(author_ids))} if author_ids else {}
+    for document in documents:
+        _hydrate_reference(document, 'author', authors)
+
+
+def _keywords(text):
+    """
+    Words of a text as they are indexed and searched
+    :param (str) text: the text
+    :return (list[str]): unique lowercase words, in order of appearance
+    """
+    return list(dict.fromkeys(re.findall(r'\w+', text.lower())))
+
+
+def visibility_query(user_id, member_circle_ids, author_field='author'):
+    """
+    Raw query for the posts that a user can see, the visibility rule of User.sees_post
+    :param (ObjectId) user_id: id of the user
+    :param (iterable[ObjectId]) member_circle_ids: ids of the circles that the user is a member of
+    :param (str) author_field: name of the field that holds the author of the post
+    :return (dict): the query
+    """
+    return {'$or': [{author_field: user_id}, {'is_public': True}, {'circles': {'$in': list(member_circle_ids)}}]}
 
 
 class CreatedAtMixin(object):
@@ -15,9 +142,37 @@ class CreatedAtMixin(object):
         return int(time.mktime(self.created_at.timetuple()))
 
 
-class User(Document, UserMixin, CreatedAtMixin):
+class TombstoneDocument(Document):
+    """
+    A document that is deleted in two steps: it is marked as a tombstone right away, which hides it from objects,
+        and then purged together with everything that references it, in bulk by cleanup.cleaner
+    Subclasses define the purge as a static method purge(document_id), which deletes a tombstoned document
+        and everything that references it
+    Raw collection queries must exclude tombstones themselves
+    """
+    deleted = BooleanField(default=False)
+    meta = {'abstract': True}
+
+    @queryset_manager
+    def objects(doc_cls, queryset):
+        return queryset.filter(deleted__ne=True)
+
+    def tombstone(self):
+        """
+        Hide the document from reads and schedule its purge
+        """
+        self._get_collection().update_one({'_id': self.id}, {'$set': {'deleted': True}})
+        cleaner.submit(self.purge, self.id)
+
+
+class User(TombstoneDocument, UserMixin, CreatedAtMixin):
     user_id = StringField(required=True, unique=True)
     password = StringField(required=True)
+    # Counter caches, kept up to date with $inc, see migrations.reconcile_counters
+    post_count = IntField(default=0)
+    circle_count = IntField(default=0)
+    # Goes up whenever the circles the user is a member of change, access tokens carry it, see auth.py
+    membership_version = IntField(default=0)
 
     # User
 
@@ -32,33 +187,39 @@ class User(Document, UserMixin, CreatedAtMixin):
         """
         new_user = User()
         new_user.user_id = user_id
-        new_user.password = generate_password_hash(password)
+        new_user.password = hasher.hash(password)
         try:
             new_user.save()
         except NotUniqueError:
             return False
+        cache.invalidate('user_id:{}'.format(user_id))
         return True
 
     @staticmethod
     def check(user_id, password):
         """
         Check whether the user exists
+        A hash made with an outdated method is upgraded in the background on success
         :param (str) user_id: user id
         :param (str) password: password
         :return (User|bool): Whether the user exists
-        :exception (RuntimeError): If more than one user for the user id is found
-        """
-        users = User.objects(user_id=user_id)
-        found_users = []
-        for user in users:
-            if check_password_hash(user.password, password):
-                found_users.append(user)
-        if not found_users:
+        :raise (HashingOverloaded) when too many passwords are being checked
+        """
+        found_user = User.objects(user_id=user_id).first()
+        if found_user is None or not hasher.check(found_user.password, password):
             return False
-        elif len(found_users) == 1:
-            return found_users[0]
-        else:
-            raise RuntimeError('More than one user for user id {} found!'.format(user_id))
+        if hasher.needs_rehash(found_user.password):
+            hasher.rehash_later(password, lambda new_password: found_user.update_password(found_user.password, new_password))
+        return found_user
+
+    def update_password(self, old_password, new_password):
+        """
+        Replace the stored password hash, unless it was changed in the meantime
+        :param (str) old_password: hash that is expected to be stored
+        :param (str) new_password: new hash
+        """
+        User.objects(id=self.id, password=old_password).update_one(set__password=new_password)
+        cache.invalidate('user:{}'.format(self.id))
 
     @staticmethod
     def find(user_id):
@@ -67,13 +228,92 @@ class User(Document, UserMixin, CreatedAtMixin):
         :param (str) user_id: user id
         :return (User|bool): Whether the user exists
         """
-        found_users = User.objects(user_id=user_id)
-        if not found_users:
+        found_id = cache.get_or_load(
+            'user_id:{}'.format(user_id),
+            lambda: User.objects(user_id=user_id).scalar('id').first())
+        if found_id is None:
             return False
-        elif len(found_users) == 1:
-            return found_users[0]
-        else:
-            raise RuntimeError('More than one user for user id {} found!'.format(user_id))
+        return User.get(found_id) or False
+
+    @staticmethod
+    def get(id):
+        """
+        Get a user by object id
+        :param (ObjectId|str) id: object id
+        :return (User|None): the user, None if not found
+        """
+        son = cache.get_or_load('user:{}'.format(id), lambda: User.objects(id=id).as_pymongo().first())
+        if son is None:
+            return None
+        return User._from_son(son)
+
+    @property
+    def member_circle_ids(self):
+        """
+        Ids of all circles that the user is a member of
+        Looked up through the index on Circle.members and the cache, and then kept on this user object,
+            which lives as long as the request that loaded it
+        :return (set[ObjectId]): ids of the circles
+        """
+        if getattr(self, '_member_circle_ids', None) is None:
+            self._member_circle_ids = set(cache.get_or_load(
+                'member_circle_ids:{}'.format(self.id),
+                lambda: list(Circle.objects(members=self.id).scalar('id'))))
+        return self._member_circle_ids
+
+    def directory_page(self, prefix=None, after=None, limit=USERS_PER_PAGE):
+        """
+        A page of other users, ordered by user id
+        Both the prefix and the cursor are ranges on the unique index on user_id, and only the fields that the directory
+            shows are fetched
+        :param (str) prefix: only users whose user id starts with this, case sensitive
+        :param (str) after: cursor, only users whose user id sorts after this one
+        :param (int) limit: max number of users in the page
+        :return (list[User], str|None): users in the page, with only id, user_id and their counters loaded,
+            and the cursor for the next page, None if this is the last page
+        """
+        users = User.objects(user_id__ne=self.user_id)
+        if prefix:
+            users = users.filter(user_id__startswith=prefix)
+        if after is not None:
+            users = users.filter(user_id__gt=after)
+        users = list(users.only('user_id', 'post_count', 'circle_count').order_by('user_id').limit(limit + 1))
+        if len(users) > limit:
+            return users[:limit], users[limit - 1].user_id
+        return users, None
+
+    def delete_account(self):
+        """
+        Delete the user with their posts, comments and circles
+        """
+        self.tombstone()
+        cache.invalidate('user:{}'.format(self.id), 'user_id:{}'.format(self.user_id))
+
+    @staticmethod
+    def purge(user_id):
+        posts = Post._get_collection()
+        circles = Circle._get_collection()
+        post_ids = posts.distinct('_id', {'author': user_id})
+        Comment._get_collection().delete_many({'post': {'$in': post_ids}})
+        TimelineEntry._get_collection().delete_many({'$or': [{'post': {'$in': post_ids}}, {'owner': user_id}]})
+        SearchEntry._get_collection().delete_many({'post': {'$in': post_ids}})
+        posts.delete_many({'author': user_id})
+        comment_ids = Comment._get_collection().distinct('_id', {'author': user_id})
+        Comment.bulk_delete({'$or': [{'_id': {'$in': comment_ids}}, {'ancestors': {'$in': comment_ids}}]})
+        circle_ids = circles.distinct('_id', {'owner': user_id})
+        for collection in [posts, SearchEntry._get_collection()]:
+            collection.update_many({'circles': {'$in': circle_ids}}, {'$pull': {'circles': {'$in': circle_ids}}})
+        circles.delete_many({'owner': user_id})
+        circles.update_many({'members': user_id}, {'$pull': {'members': user_id}})
+        User._get_collection().delete_one({'_id': user_id})
+
+    def _increment(self, **counters):
+        """
+        Atomically change counter caches of the user
+        :param counters: the change by counter name
+        """
+        User.objects(id=self.id).update_one(**{'inc__' + name: change for name, change in counters.items()})
+        cache.invalidate('user:{}'.format(self.id))
 
     # Post
 
@@ -83,13 +323,22 @@ class User(Document, UserMixin, CreatedAtMixin):
         :param (str) content: the content
         :param (bool) is_public: whether the post is public
         :param (list[Circle]) circles: circles to share with
+        :return (Post): the new post
         """
         new_post = Post()
         new_post.author = self.id
+        new_post.author_user_id = self.user_id
         new_post.content = content
         new_post.is_public = is_public
         new_post.circles = circles
+        new_post.circle_names = {str(circle.id): circle.name for circle in circles}
         new_post.save()
+        self._increment(post_count=1)
+        SearchEntry.add(new_post)
+        if TimelineEntry.enabled:
+            TimelineEntry.fan_out(new_post)
+        new_post.publish(POST_CREATED)
+        return new_post
 
     def owns_post(self, post):
         """
@@ -97,7 +346,7 @@ class User(Document, UserMixin, CreatedAtMixin):
         :param (Post) post: the post
         :return (bool): whether the user owns the post
         """
-        return self.id == post.author.id
+        return self.id == _reference_id(post, 'author')
 
     def sees_post(self, post):
         """
@@ -110,10 +359,7 @@ class User(Document, UserMixin, CreatedAtMixin):
         elif post.is_public:
             return True
         else:
-            for circle in post.circles:
-                if circle.check_member(self):
-                    return True
-        return False
+            return any(circle_id in self.member_circle_ids for circle_id in _reference_ids(post, 'circles'))
 
     def delete_post(self, post):
         """
@@ -121,17 +367,82 @@ class User(Document, UserMixin, CreatedAtMixin):
         :param (Post) post: the post
         :raise (UnauthorizedAccess) when access is unauthorized
         """
-        if post.author.id == self.id:
-            post.delete()
+        if self.owns_post(post):
+            post.tombstone()
+            self._increment(post_count=-1)
+            post_cards.invalidate(post.id)
+            post.publish(POST_DELETED)
         else:
             raise UnauthorizedAccess()
 
+    def visible_posts(self, by_user=None, before=None):
+        """
+        Query for all posts that are visible to the user
+        The visibility rule of sees_post is expressed as a single query so that filtering and ordering happen in the database
+        :param (User) by_user: posts that are authored by this user
+        :param (ObjectId) before: only posts older than the post with this id
+        :return (QuerySet): all posts that are visible to the user, reverse chronologically ordered
+        """
+        posts = Post.objects(__raw__=visibility_query(self.id, self.member_circle_ids))
+        if by_user is not None:
+            posts = posts.filter(author=by_user)
+        if before is not None:
+            posts = posts.filter(id__lt=before)
+        return posts.order_by('-id')
+
+    def timeline_page(self, before=None, limit=POSTS_PER_PAGE):
+        """
+        A page of posts that are visible to the user, read from the user's timeline
+        Public posts are not fanned out and are merged in here instead
+        :param (ObjectId) before: cursor, only posts older than the post with this id
+        :param (int) limit: max number of posts in the page
+        :return (list[Post], ObjectId|None): posts in the page, reverse chronologically ordered,
+            and the cursor for the next page, None if this is the last page
+        """
+        entries = TimelineEntry.objects(owner=self.id)
+        public_posts = Post.objects(is_public=True)
+        if before is not None:
+            entries = entries.filter(post__lt=before)
+            public_posts = public_posts.filter(id__lt=before)
+        post_ids = set(_reference_id(entry, 'post') for entry in entries.order_by('-post').limit(limit + 1))
+        post_ids.update(public_posts.order_by('-id').limit(limit + 1).scalar('id'))
+        post_ids = sorted(post_ids, reverse=True)[:limit + 1]
+        # The cursor comes from the entries, tombstoned posts whose purge is pending are left out of the page only
+        page_ids = post_ids[:limit]
+        posts = list(Post.objects(id__in=page_ids).order_by('-id')) if page_ids else []
+        if len(post_ids) > limit:
+            return posts, page_ids[-1]
+        return posts, None
+
+    def sees_posts_page(self, by_user=None, before=None, limit=POSTS_PER_PAGE):
+        """
+        A page of posts that are visible to the user
+        :param (User) by_user: posts that are authored by this user
+        :param (ObjectId) before: cursor, only posts older than the post with this id
+        :param (int) limit: max number of posts in the page
+        :return (list[Post], ObjectId|None): posts in the page, reverse chronologically ordered,
+            and the cursor for the next page, None if this is the last page
+        """
+        posts = list(self.visible_posts(by_user, before).limit(limit + 1))
+        if len(posts) > limit:
+            return posts[:limit], posts[limit - 1].id
+        return posts, None
+
     def sees_posts(self, by_user=None):
         """
         All posts that are visible to the user
         :param (User) by_user: posts that are authored by this user
         :return (list[Post]): all posts that are visible to the user, reverse chronologically ordered
         """
+        return list(self.visible_posts(by_user))
+
+    def sees_posts_by_scan(self, by_user=None):
+        """
+        All posts that are visible to the user, filtered and sorted in Python
+        Reference implementation of sees_posts
+        :param (User) by_user: posts that are authored by this user
+        :return (list[Post]): all posts that are visible to the user, reverse chronologically ordered
+        """
         if by_user is None:
             posts = Post.objects()
         else:
@@ -139,6 +450,16 @@ class User(Document, UserMixin, CreatedAtMixin):
         posts = filter(lambda post: self.sees_post(post), posts)
         return list(reversed(sorted(posts, key=lambda post: post.created_at)))
 
+    def search(self, query, page=0, limit=SEARCH_RESULTS_PER_PAGE):
+        """
+        Search posts and comments that the user can see, see SearchEntry.search
+        :param (str) query: the search terms
+        :param (int) page: the page, from 0
+        :param (int) limit: max results per page
+        :return (list[tuple[Post, Comment|None]], bool): the results, and whether there are more pages
+        """
+        return SearchEntry.search(self, query, page, limit)
+
     # Comment
 
     def create_comment(self, content, parent_post):
@@ -146,15 +467,19 @@ class User(Document, UserMixin, CreatedAtMixin):
         Create a comment for the user
         :param (str) content: the content
         :param (Post) parent_post: the post that this comment is attached to
+        :return (Comment): the new comment
         :raise (UnauthorizedAccess) when access is unauthorized
         """
         if self.sees_post(parent_post):
             new_comment = Comment()
             new_comment.author = self.id
+            new_comment.author_user_id = self.user_id
             new_comment.content = content
+            new_comment.post = parent_post.id
             new_comment.save()
-            parent_post.comments.append(new_comment)
-            parent_post.save()
+            parent_post.touch(comment_count_change=1)
+            SearchEntry.add(parent_post, new_comment)
+            return new_comment
         else:
             raise UnauthorizedAccess()
 
@@ -164,15 +489,20 @@ class User(Document, UserMixin, CreatedAtMixin):
         :param (str) content: the content
         :param (Comment) parent_comment: the comment that this nested comment is attached to
         :param (Post) parent_post: the post that this comment is attached to
+        :return (Comment): the new comment
         :raise (UnauthorizedAccess) when access is unauthorized
         """
-        if self.sees_post(parent_post):
+        if self.sees_post(parent_post) and _reference_id(parent_comment, 'post') == parent_post.id:
             new_comment = Comment()
             new_comment.author = self.id
+            new_comment.author_user_id = self.user_id
             new_comment.content = content
+            new_comment.post = parent_post.id
+            new_comment.ancestors = _reference_ids(parent_comment, 'ancestors') + [parent_comment.id]
             new_comment.save()
-            parent_comment.comments.append(new_comment)
-            parent_comment.save()
+            parent_post.touch(comment_count_change=1)
+            SearchEntry.add(parent_post, new_comment)
+            return new_comment
         else:
             raise UnauthorizedAccess()
 
@@ -183,7 +513,7 @@ class User(Document, UserMixin, CreatedAtMixin):
         :param (Post) parent_post: its parent post
         :return (bool): whether the user owns a comment
         """
-        return self.owns_post(parent_post) or self.id == comment.author.id
+        return self.owns_post(parent_post) or self.id == _reference_id(comment, 'author')
 
     def owns_nested_comment(self, comment, parent_comment, parent_post):
         """
@@ -195,32 +525,36 @@ class User(Document, UserMixin, CreatedAtMixin):
         """
         return self.owns_post(parent_post) \
             or self.owns_comment(parent_comment, parent_post) \
-            or self.id == comment.author.id
+            or self.id == _reference_id(comment, 'author')
 
     def delete_comment(self, comment, parent_post):
         """
-        Delete a comment
+        Delete a comment and its replies
         :param (Comment) comment: the comment
         :param (Post) parent_post: comment's parent post
-        :raise (UnauthorizedAccess) when access is unauthorized
+        :raise (UnauthorizedAccess) when access is unauthorized, or the comment is not on the post
         """
-        if self.owns_comment(comment, parent_post):
-            parent_post.comments.remove(comment)
-            comment.delete()
+        if _reference_id(comment, 'post') == parent_post.id and self.owns_comment(comment, parent_post):
+            comment.tombstone()
+            parent_post.touch()
         else:
             raise UnauthorizedAccess()
 
     def delete_nested_comment(self, comment, parent_comment, parent_post):
         """
-        Delete a nested comment
+        Delete a nested comment and its replies
         :param (Comment) comment: the comment
         :param (Comment) parent_comment: comment's parent comment
         :param (Post) parent_post: parent comment's parent post
-        :raise (UnauthorizedAccess) when access is unauthorized
+        :raise (UnauthorizedAccess) when access is unauthorized, or the comments are not where the arguments put them
         """
-        if self.owns_comment(parent_comment, parent_post):
-            parent_comment.comments.remove(comment)
-            comment.delete()
+        ancestor_ids = _reference_ids(comment, 'ancestors')
+        if _reference_id(parent_comment, 'post') == parent_post.id \
+                and _reference_id(comment, 'post') == parent_post.id \
+                and ancestor_ids and ancestor_ids[-1] == parent_comment.id \
+                and self.owns_comment(parent_comment, parent_post):
+            comment.tombstone()
+            parent_post.touch()
         else:
             raise UnauthorizedAccess()
 
@@ -240,24 +574,124 @@ class User(Document, UserMixin, CreatedAtMixin):
             new_circle.save()
         except NotUniqueError:
             return False
+        self._increment(circle_count=1)
+        cache.invalidate('owned_circles:{}'.format(self.id))
         return True
 
+    def owned_circles(self):
+        """
+        All circles owned by the user
+        :return (list[Circle]): the circles
+        """
+        return [
+            Circle._from_son(son)
+            for son in cache.get_or_load(
+                'owned_circles:{}'.format(self.id),
+                lambda: list(Circle.objects(owner=self.id).as_pymongo()))
+        ]
+
+    def circle_memberships(self, users):
+        """
+        Which of the user's circles each of some users is a member of, in one query
+        Only the matching members of each circle are read, not the whole member lists
+        :param (list[User]) users: the users, e.g. a page of the directory
+        :return (dict[ObjectId, set[ObjectId]]): ids of the circles by user id, users in no circle are left out
+        """
+        user_ids = [user.id for user in users]
+        if not user_ids:
+            return {}
+        return {
+            group['_id']: set(group['circles'])
+            for group in Circle._get_collection().aggregate([
+                {'$match': {'owner': self.id, 'deleted': {'$ne': True}, 'members': {'$in': user_ids}}},
+                {'$project': {'members': 1}},
+                {'$unwind': '$members'},
+                {'$match': {'members': {'$in': user_ids}}},
+                {'$group': {'_id': '$members', 'circles': {'$push': '$_id'}}}
+            ])
+        }
+
+    def rename_circle(self, circle, name):
+        """
+        Rename a circle, the snapshots of its name in the posts shared with it are updated in the background
+        :param (Circle) circle: the circle
+        :param (str) name: new name of the circle
+        :return (bool): Whether renaming is successful.
+            If False, name is already taken
+        :raise (UnauthorizedAccess) when access is unauthorized
+        """
+        if _reference_id(circle, 'owner') == self.id:
+            try:
+                Circle.objects(id=circle.id).update_one(set__name=name)
+            except NotUniqueError:
+                return False
+            cache.invalidate('owned_circles:{}'.format(self.id))
+            cleaner.submit(Circle.propagate_name, circle.id)
+            return True
+        else:
+            raise UnauthorizedAccess()
+
     def toggle_member(self, circle, toggled_user):
         """
         Toggle a user's membership in a circle
         :param (Circle) circle: the circle
         :param (User) toggled_user: toggled user
+        :return (bool): whether the user is a member after toggling
         :raise (UnauthorizedAccess) when access is unauthorized
         """
-        if circle.owner.id == self.id:
-            if circle.check_member(toggled_user):
-                circle.members.remove(toggled_user)
-            else:
-                circle.members.append(toggled_user)
-            circle.save()
+        if _reference_id(circle, 'owner') == self.id:
+            # Both updates are atomic on the server, so concurrent toggles never overwrite each other's members
+            updated_circle = Circle.objects(id=circle.id, members=toggled_user.id) \
+                .modify(new=True, pull__members=toggled_user.id)
+            if updated_circle is None:
+                updated_circle = Circle.objects(id=circle.id) \
+                    .modify(new=True, add_to_set__members=toggled_user.id)
+            is_member = updated_circle is not None and updated_circle.check_member(toggled_user)
+            self._membership_changed(circle, toggled_user, is_member)
+            return is_member
         else:
             raise UnauthorizedAccess()
 
+    def set_member(self, circle, member, is_member):
+        """
+        Add a user to a circle or remove them from it, with one atomic update that only matches when it changes something,
+            so that concurrent calls asking for the same membership change it at most once
+        :param (Circle) circle: the circle
+        :param (User) member: the user
+        :param (bool) is_member: whether the user is to be a member
+        :return (bool): whether the membership changed
+        :raise (UnauthorizedAccess) when access is unauthorized
+        """
+        if _reference_id(circle, 'owner') != self.id:
+            raise UnauthorizedAccess()
+        if is_member:
+            changed = Circle.objects(id=circle.id, members__ne=member.id).update_one(add_to_set__members=member.id)
+        else:
+            changed = Circle.objects(id=circle.id, members=member.id).update_one(pull__members=member.id)
+        if changed:
+            self._membership_changed(circle, member, is_member)
+        return bool(changed)
+
+    def _membership_changed(self, circle, member, is_member):
+        """
+        Bring caches, the membership version, events and timelines up to date after a user joined or left a circle
+        :param (Circle) circle: the circle, owned by this user
+        :param (User) member: the user
+        :param (bool) is_member: whether the user is a member now
+        """
+        member._member_circle_ids = None
+        User.objects(id=member.id).update_one(inc__membership_version=1)
+        cache.invalidate(
+            'owned_circles:{}'.format(self.id),
+            'member_circle_ids:{}'.format(member.id),
+            'user:{}'.format(member.id))
+        events.publish({'type': MEMBERSHIPS_CHANGED, 'users': [str(member.id)]})
+        if TimelineEntry.enabled:
+            if is_member:
+                TimelineEntry.grant(circle, [member.id])
+            else:
+                TimelineEntry.revoke(circle, [member.id])
+
     def delete_circle(self, circle):
         """
         Delete a circle
@@ -265,18 +699,28 @@ class User(Document, UserMixin, CreatedAtMixin):
         :raise (UnauthorizedAccess) when access is unauthorized
         """
         if circle.owner.id == self.id:
-            circle.delete()
+            member_ids = _reference_ids(circle, 'members')
+            if TimelineEntry.enabled:
+                TimelineEntry.revoke(circle, member_ids)
+            circle.tombstone()
+            self._increment(circle_count=-1)
+            User.objects(id__in=member_ids).update(inc__membership_version=1)
+            cache.invalidate('owned_circles:{}'.format(self.id), *[
+                key.format(member_id) for member_id in member_ids for key in ['member_circle_ids:{}', 'user:{}']
+            ])
+            events.publish({'type': MEMBERSHIPS_CHANGED, 'users': [str(member_id) for member_id in member_ids]})
         else:
             raise UnauthorizedAccess()
 
 
-class Circle(Document):
+class Circle(TombstoneDocument):
     owner = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)  # type: User
     name = StringField(required=True)
     members = ListField(ReferenceField(User, reverse_delete_rule=PULL), default=[])  # type: list[User]
     meta = {
         'indexes': [
-            {'fields': ('owner', 'name'), 'unique': True}
+            {'fields': ('owner', 'name'), 'unique': True},
+            'members'
         ]
     }
 
@@ -286,21 +730,311 @@ class Circle(Document):
         :param (User) user: checked user
         :return (bool): whether the user is in the circle
         """
-        return len(list(filter(lambda member: member.id == user.id, self.members))) != 0
+        return user.id in _reference_ids(self, 'members')
+
+    @staticmethod
+    def propagate_name(circle_id):
+        """
+        Write the name of a circle into the snapshots of the posts shared with it, after it was renamed
+        Their versions are bumped so that their cached cards are rendered again
+        A propagation that is lost leaves stale names behind, for migrations.backfill_snapshots to repair
+        :param (ObjectId) circle_id: id of the circle
+        """
+        circle = Circle._get_collection().find_one({'_id': circle_id}, {'name': 1})
+        if circle is None:
+            return
+        snapshot_field = 'circle_names.{}'.format(circle_id)
+        Post._get_collection().update_many(
+            {'circles': circle_id, snapshot_field: {'$ne': circle['name']}},
+            {'$set': {snapshot_field: circle['name']}, '$inc': {'version': 1}})
+
+    @staticmethod
+    def purge(circle_id):
+        Post._get_collection().update_many(
+            {'circles': circle_id},
+            {
+                '$pull': {'circles': circle_id},
+                '$unset': {'circle_names.{}'.format(circle_id): ''},
+                '$inc': {'version': 1}
+            })
+        SearchEntry._get_collection().update_many({'circles': circle_id}, {'$pull': {'circles': circle_id}})
+        Circle._get_collection().delete_one({'_id': circle_id})
 
 
-class Comment(Document, CreatedAtMixin):
+class Comment(TombstoneDocument, CreatedAtMixin):
     author = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)  # type: User
+    # Snapshot of the user id of the author, user ids never change, see Post.author_user_id
+    author_user_id = StringField()
     content = StringField(required=True)
-    comments = ListField(ReferenceField('Comment', reverse_delete_rule=PULL), default=[])  # type: list[Comment]
+    post = ReferenceField('Post', required=True)  # type: Post
+    ancestors = ListField(ReferenceField('Comment'), default=[])  # type: list[Comment]
+    meta = {
+        'indexes': [
+            ('post', 'id'),
+            'ancestors',
+            # comments of a user whose account is purged
+            'author'
+        ]
+    }
+
+    @property
+    def comments(self):
+        """
+        First replies to the comment, attached when the thread of its post is loaded
+        :return (list[Comment]): the replies, chronologically ordered
+        """
+        return getattr(self, '_comments', [])
+
+    @property
+    def has_more_comments(self):
+        """
+        :return (bool): whether the comment has more replies than the attached ones
+        """
+        return getattr(self, '_has_more_comments', False)
+
+    @staticmethod
+    def bulk_delete(query):
+        """
+        Delete comments in bulk with their search entries, and take them off the comment counts of their posts
+        :param (dict) query: filter of the comments
+        :return (int): number of deleted comments
+        """
+        comments = Comment._get_collection()
+        comment_ids = comments.distinct('_id', query)
+        if not comment_ids:
+            return 0
+        query = {'_id': {'$in': comment_ids}}
+        counts = list(comments.aggregate([{'$match': query}, {'$group': {'_id': '$post', 'count': {'$sum': 1}}}]))
+        deleted = comments.delete_many(query).deleted_count
+        SearchEntry._get_collection().delete_many({'comment': {'$in': comment_ids}})
+        updates = [
+            UpdateOne({'_id': count['_id']}, {'$inc': {'comment_count': -count['count'], 'version': 1}})
+            for count in counts if count['_id'] is not None
+        ]
+        if updates:
+            Post._get_collection().bulk_write(updates, ordered=False)
+        return deleted
+
+    @staticmethod
+    def purge(comment_id):
+        """
+        Delete a tombstoned comment and all replies under it in one query
+        :param (ObjectId) comment_id: id of the comment
+        """
+        Comment.bulk_delete({'$or': [{'_id': comment_id}, {'ancestors': comment_id}]})
+
+    @staticmethod
+    def _first_children(match, group_by, limit):
+        """
+        First comments of each group, with one query for all groups, which cuts each group in the database
+            so that only what is shown is loaded
+        :param (dict) match: filter of the comments
+        :param group_by: expression of the group of a comment, e.g. its post
+        :param (int) limit: comments per group, one more is loaded to tell whether there are more
+        :return (dict[ObjectId, list[Comment]]): the comments by group, chronologically ordered
+        """
+        return {
+            group['_id']: [Comment._from_son(son) for son in group['comments']]
+            for group in Comment._get_collection().aggregate([
+                {'$match': dict(match, deleted={'$ne': True})},
+                {'$sort': {'_id': 1}},
+                {'$group': {'_id': group_by, 'comments': {'$push': '$$ROOT'}}},
+                {'$project': {'comments': {'$slice': ['$comments', limit + 1]}}}
+            ])
+        }
+
+    @staticmethod
+    def _attach(parent, children, limit):
+        parent._comments = children[:limit]
+        parent._has_more_comments = len(children) > limit
+
+    @staticmethod
+    def _load_replies(comments, depth):
+        """
+        Load the first replies of comments and of their replies, REPLY_LEVELS levels deep, one query per level
+        :param (list[Comment]) comments: the comments, all with depth - 1 ancestors
+        :param (int) depth: number of ancestors of the replies
+        :return (list[Comment]): all loaded replies
+        """
+        loaded = []
+        level = comments
+        for level_number in range(1, REPLY_LEVELS + 2):
+            if not level:
+                break
+            # one level past the shown ones only tells whether their comments have replies
+            limit = REPLIES_PER_COMMENT if level_number <= REPLY_LEVELS else 0
+            replies = Comment._first_children(
+                {'ancestors': {'$in': [comment.id for comment in level], '$size': depth}},
+                {'$arrayElemAt': ['$ancestors', -1]},
+                limit)
+            for comment in level:
+                Comment._attach(comment, replies.get(comment.id, []), limit)
+            level = [reply for comment in level for reply in comment._comments]
+            loaded.extend(level)
+            depth += 1
+        return loaded
+
+    @staticmethod
+    def load_threads(posts):
+        """
+        Load the collapsed comment threads of posts and attach them to the posts in memory,
+            with one query per level of comments shown
+        :param (list[Post]) posts: the posts
+        :return (list[Comment]): all loaded comments
+        """
+        for post in posts:
+            Comment._attach(post, [], COMMENTS_PER_POST)
+        if not posts:
+            return []
+        comments_by_post = Comment._first_children(
+            {'post': {'$in': [post.id for post in posts]}, 'ancestors': {'$size': 0}}, '$post', COMMENTS_PER_POST)
+        for post in posts:
+            Comment._attach(post, comments_by_post.get(post.id, []), COMMENTS_PER_POST)
+        comments = [comment for post in posts for comment in post._comments]
+        return comments + Comment._load_replies(comments, 1)
+
+    @staticmethod
+    def page_query(post_id, ancestor_ids, after=None):
+        """
+        Raw query for the comments of a post at one level of its thread, see load_page
+        :param (ObjectId) post_id: id of the post
+        :param (list[ObjectId]) ancestor_ids: ids of the ancestors of the comments, empty for top level comments
+        :param (ObjectId) after: only comments newer than the comment with this id
+        :return (dict): the query, pages are sorted by _id
+        """
+        query = {'post': post_id, 'ancestors': ancestor_ids}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        return query
+
+    @staticmethod
+    def load_page(post, parent_comment=None, after=None, limit=REPLIES_PER_COMMENT):
+        """
+        Load a page of the top level comments of a post or of the replies to a comment,
+            with their collapsed replies and all authors
+        :param (Post) post: the post
+        :param (Comment) parent_comment: the comment whose replies to load, top level comments if None
+        :param (ObjectId) after: only comments newer than the comment with this id
+        :param (int) limit: max comments
+        :return (list[Comment], ObjectId|None): the comments, chronologically ordered,
+            and the cursor of the next page if there is one
+        """
+        if parent_comment is None:
+            ancestor_ids = []
+        else:
+            ancestor_ids = _reference_ids(parent_comment, 'ancestors') + [parent_comment.id]
+        comments = list(Comment.objects(__raw__=Comment.page_query(post.id, ancestor_ids, after)).order_by('id').limit(limit + 1))
+        next_cursor = comments[limit - 1].id if len(comments) > limit else None
+        comments = comments[:limit]
+        _hydrate_authors(comments + Comment._load_replies(comments, len(ancestor_ids) + 1))
+        return comments, next_cursor
 
 
-class Post(Document, CreatedAtMixin):
+class Post(TombstoneDocument, CreatedAtMixin):
     author = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)  # type: User
     content = StringField(required=True)
     is_public = BooleanField(required=True)
     circles = ListField(ReferenceField(Circle, reverse_delete_rule=PULL), default=[])  # type: list[Circle]
-    comments = ListField(ReferenceField(Comment, reverse_delete_rule=PULL), default=[])  # type: list[Comment]
+    # Snapshots written with the post so that rendering it dereferences nothing: the user id of the author,
+    #     and the names of the circles by id, which Circle.propagate_name updates after a rename.
+    #     Documents written before them are filled in by migrations.backfill_snapshots
+    author_user_id = StringField()
+    circle_names = DictField()
+    # Bumped whenever its comments change, rendered post cards are cached by it
+    version = IntField(default=0)
+    # Counter cache of comments including replies, see migrations.reconcile_counters
+    comment_count = IntField(default=0)
+    meta = {
+        'indexes': [
+            ('author', '-id'),
+            ('is_public', '-id'),
+            ('circles', '-id')
+        ]
+    }
+
+    @property
+    def comments(self):
+        """
+        First top level comments of the post with their first replies attached
+        The collapsed thread is loaded on first access
+        :return (list[Comment]): the comments, chronologically ordered
+        """
+        if getattr(self, '_comments', None) is None:
+            Comment.load_threads([self])
+        return self._comments
+
+    @property
+    def has_more_comments(self):
+        """
+        :return (bool): whether the post has more top level comments than the attached ones
+        """
+        self.comments
+        return self._has_more_comments
+
+    @staticmethod
+    def prefetch(posts, threads=True):
+        """
+        Load everything that rendering a page of posts references, one query per collection,
+            instead of dereferencing each reference separately
+        Authors and circles come from the snapshots of the posts and comments, only ones without a snapshot are queried
+        :param (list[Post]) posts: the posts, hydrated in place
+        :param (bool) threads: whether to load their collapsed comment threads too
+        :return (list[Post]): the posts
+        """
+        _hydrate_authors(list(posts) + (Comment.load_threads(posts) if threads else []))
+        circles = {}
+        for post in posts:
+            for circle_id, name in (post._data.get('circle_names') or {}).items():
+                circles.setdefault(ObjectId(circle_id), Circle._from_son({'_id': ObjectId(circle_id), 'name': name}))
+        missing_circle_ids = {circle_id for post in posts for circle_id in _reference_ids(post, 'circles')} - set(circles)
+        if missing_circle_ids:
+            circles.update((circle.id, circle) for circle in Circle.objects(id__in=list(missing_circle_ids)))
+        for post in posts:
+            _hydrate_references(post, 'circles', circles)
+        return posts
+
+    def touch(self, comment_count_change=0):
+        """
+        Mark the rendered card of the post as stale, in this process and in every other one
+        :param (int) comment_count_change: change of the number of comments, deleted comments are counted off when purged
+        """
+        Post.objects(id=self.id).update_one(inc__version=1, inc__comment_count=comment_count_change)
+        post_cards.invalidate(self.id)
+        self.publish(COMMENTS_CHANGED)
+
+    def publish(self, event_type):
+        """
+        Publish an event about the post, for the viewers who can see it, see events
+        :param (str) event_type: type of the event
+        """
+        events.publish({
+            'type': event_type,
+            'post': str(self.id),
+            'author': str(_reference_id(self, 'author')),
+            'isPublic': self.is_public,
+            'circles': [str(circle_id) for circle_id in _reference_ids(self, 'circles')]
+        })
+
+    @staticmethod
+    def from_event(event):
+        """
+        The post that a post event is about, with only what tells who can see it
+        :param (dict) event: the event
+        :return (Post): the post, not saved
+        """
+        return Post._from_son({
+            '_id': ObjectId(event['post']),
+            'author': ObjectId(event['author']),
+            'is_public': event['isPublic'],
+            'circles': [ObjectId(circle_id) for circle_id in event['circles']]
+        })
+
+    @staticmethod
+    def purge(post_id):
+        Comment._get_collection().delete_many({'post': post_id})
+        TimelineEntry._get_collection().delete_many({'post': post_id})
+        SearchEntry._get_collection().delete_many({'post': post_id})
+        Post._get_collection().delete_one({'_id': post_id})
 
     @property
     def sharing_scope_str(self):
@@ -310,3 +1044,254 @@ class Post(Document, CreatedAtMixin):
             return ', '.join(map(lambda circle: circle.name, self.circles))
         else:
             return '(private)'
+
+
+class TimelineEntry(Document):
+    """
+    A post in the timeline of a user who can see it, written when the post is created (fan-out-on-write)
+    Public posts are visible to everyone, so they are not written into any timeline
+    """
+    owner = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)  # type: User
+    post = ReferenceField(Post, required=True)  # type: Post
+    meta = {
+        'indexes': [
+            {'fields': ('owner', '-post'), 'unique': True},
+            # entries of a purged post
+            'post'
+        ]
+    }
+
+    # Whether timelines are maintained on writes, set from the FEED_MODE config
+    enabled = False
+
+    @staticmethod
+    def _write(owner_ids, post_ids):
+        """
+        Idempotently add posts to timelines
+        :param (list[ObjectId]) owner_ids: ids of the timeline owners
+        :param (list[ObjectId]) post_ids: ids of the posts, added to every timeline
+        """
+        updates = [
+            UpdateOne({'owner': owner_id, 'post': post_id}, {'$setOnInsert': {'owner': owner_id, 'post': post_id}}, upsert=True)
+            for owner_id in owner_ids for post_id in post_ids
+        ]
+        if updates:
+            TimelineEntry._get_collection().bulk_write(updates, ordered=False)
+
+    @staticmethod
+    def fan_out(post):
+        """
+        Write a post into the timelines of its author and of the members of the circles it is shared with
+        :param (Post) post: the post
+        """
+        if post.is_public:
+            return
+        owner_ids = {_reference_id(post, 'author')}
+        circle_ids = _reference_ids(post, 'circles')
+        if circle_ids:
+            owner_ids.update(Circle._get_collection().distinct(
+                'members', {'_id': {'$in': circle_ids}, 'deleted': {'$ne': True}}))
+        TimelineEntry._write(list(owner_ids), [post.id])
+
+    @staticmethod
+    def grant(circle, user_ids):
+        """
+        Write the posts shared with a circle into the timelines of users who joined it
+        :param (Circle) circle: the circle
+        :param (list[ObjectId]) user_ids: ids of the users
+        """
+        TimelineEntry._write(user_ids, list(Post.objects(circles=circle.id, is_public=False).scalar('id')))
+
+    @staticmethod
+    def revoke(circle, user_ids):
+        """
+        Remove the posts shared with a circle from the timelines of users who left it,
+            unless they still see them through another circle or authored them
+        :param (Circle) circle: the circle
+        :param (list[ObjectId]) user_ids: ids of the users
+        """
+        if not user_ids:
+            return
+        member_circle_ids = {user_id: set() for user_id in user_ids}
+        for other_circle in Circle.objects(id__ne=circle.id, members__in=user_ids).only('members'):
+            for member_id in _reference_ids(other_circle, 'members'):
+                if member_id in member_circle_ids:
+                    member_circle_ids[member_id].add(other_circle.id)
+        deletes = []
+        for post in Post.objects(circles=circle.id, is_public=False).only('author', 'circles'):
+            post_circle_ids = set(_reference_ids(post, 'circles'))
+            deletes.extend(
+                DeleteOne({'owner': user_id, 'post': post.id}) for user_id in user_ids
+                if user_id != _reference_id(post, 'author') and not member_circle_ids[user_id] & post_circle_ids
+            )
+        if deletes:
+            TimelineEntry._get_collection().bulk_write(deletes, ordered=False)
+
+    @staticmethod
+    def backfill():
+        """
+        Rebuild the timelines of all users from existing posts
+        :return (int): number of fanned out posts
+        """
+        TimelineEntry.drop_collection()
+        TimelineEntry.ensure_indexes()
+        count = 0
+        for post in Post.objects(is_public=False).only('author', 'is_public', 'circles').no_cache():
+            TimelineEntry.fan_out(post)
+            count += 1
+        return count
+
+
+class SearchEntry(Document):
+    """
+    A post or a comment in the inverted search index, keyed by its keywords through a multikey index
+    It carries the visibility of its post, so that searches apply the visibility rule of User.sees_post
+        in the same query that matches keywords
+    Entries are written when posts and comments are created, and deleted when they are purged
+    """
+    keywords = ListField(StringField())  # type: list[str]
+    post = ReferenceField(Post, required=True)  # type: Post
+    comment = ReferenceField(Comment)  # type: Comment
+    post_author = ReferenceField(User, required=True)  # type: User
+    is_public = BooleanField(required=True)
+    circles = ListField(ReferenceField(Circle), default=[])  # type: list[Circle]
+    meta = {
+        'indexes': [
+            'keywords',
+            'post',
+            'comment',
+            # entries shared with a purged circle
+            'circles'
+        ]
+    }
+
+    @staticmethod
+    def _son(post, content, comment_id=None):
+        """
+        :param (dict) post: raw post, with at least its _id, author, is_public and circles
+        :param (str) content: content of the post or comment
+        :param (ObjectId) comment_id: id of the comment, None to index the post itself
+        :return (dict): raw entry of the post or comment
+        """
+        return {
+            'keywords': _keywords(content),
+            'post': post['_id'],
+            'comment': comment_id,
+            'post_author': post['author'],
+            'is_public': post['is_public'],
+            'circles': post.get('circles', [])
+        }
+
+    @staticmethod
+    def add(post, comment=None):
+        """
+        Index a new post or comment
+        :param (Post) post: the post
+        :param (Comment) comment: a comment of the post, None to index the post itself
+        """
+        post_son = {
+            '_id': post.id,
+            'author': _reference_id(post, 'author'),
+            'is_public': post.is_public,
+            'circles': _reference_ids(post, 'circles')
+        }
+        if comment is None:
+            SearchEntry._get_collection().insert_one(SearchEntry._son(post_son, post.content))
+        else:
+            SearchEntry._get_collection().insert_one(SearchEntry._son(post_son, comment.content, comment.id))
+
+    @staticmethod
+    def search(viewer, query, page=0, limit=SEARCH_RESULTS_PER_PAGE):
+        """
+        Search posts and comments that a user can see
+        Entries are ranked by the summed inverse document frequency of the terms they contain, newest first on ties
+        :param (User) viewer: the searching user
+        :param (str) query: the search terms
+        :param (int) page: the page, from 0
+        :param (int) limit: max results per page
+        :return (list[tuple[Post, Comment|None]], bool): the posts, and the comments if the match is in one,
+            and whether there are more pages
+        """
+        terms = _keywords(query)[:MAX_SEARCH_TERMS]
+        if not terms:
+            return [], False
+        entries = SearchEntry._get_collection()
+        total = entries.estimated_document_count()
+        weights = {term: math.log(1 + total / max(1, entries.count_documents({'keywords': term}))) for term in terms}
+        hits = list(entries.aggregate([
+            {'$match': dict(visibility_query(viewer.id, viewer.member_circle_ids, 'post_author'), keywords={'$in': terms})},
+            {'$project': {
+                'post': 1,
+                'comment': 1,
+                'score': {'$add': [{'$cond': [{'$in': [term, '$keywords']}, weight, 0]} for term, weight in weights.items()]}
+            }},
+            {'$sort': {'score': -1, '_id': -1}},
+            {'$skip': page * limit},
+            {'$limit': limit + 1}
+        ]))
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        posts = {post.id: post for post in Post.objects(id__in=list({hit['post'] for hit in hits}))}
+        comment_ids = [hit['comment'] for hit in hits if hit.get('comment')]
+        comments = {comment.id: comment for comment in Comment.objects(id__in=comment_ids)} if comment_ids else {}
+        # so do the replies under a tombstoned comment, which go with it
+        ancestor_ids = {
+            ancestor_id for comment in comments.values() for ancestor_id in _reference_ids(comment, 'ancestors')}
+        if ancestor_ids:
+            tombstoned_ids = set(Comment._get_collection().distinct(
+                '_id', {'_id': {'$in': list(ancestor_ids)}, 'deleted': True}))
+            comments = {
+                comment_id: comment for comment_id, comment in comments.items()
+                if tombstoned_ids.isdisjoint(_reference_ids(comment, 'ancestors'))
+            }
+        Post.prefetch(list(posts.values()), threads=False)
+        _hydrate_authors(list(comments.values()))
+        results = []
+        for hit in hits:
+            # tombstoned posts and comments stay in the index until they are purged
+            if hit['post'] not in posts or (hit.get('comment') and hit['comment'] not in comments):
+                continue
+            results.append((posts[hit['post']], comments.get(hit.get('comment'))))
+        return results, has_more
+
+    @staticmethod
+    def rebuild():
+        """
+        Rebuild the index from all posts and comments
+        :return (int): number of indexed posts and comments
+        """
+        SearchEntry.drop_collection()
+        SearchEntry.ensure_indexes()
+        posts = Post._get_collection()
+        post_fields = {'author': 1, 'is_public': 1, 'circles': 1, 'content': 1}
+        count = 0
+
+        def insert(entries):
+            if entries:
+                SearchEntry._get_collection().insert_many(entries, ordered=False)
+            return len(entries)
+
+        batch = []
+        for post in posts.find({'deleted': {'$ne': True}}, post_fields):
+            batch.append(SearchEntry._son(post, post['content']))
+            if len(batch) >= 1000:
+                count += insert(batch)
+                batch = []
+        count += insert(batch)
+
+        comments = Comment._get_collection().find({'deleted': {'$ne': True}, 'post': {'$exists': True}}, {'post': 1, 'content': 1})
+        for batch in iter(lambda: list(itertools.islice(comments, 1000)), []):
+            batch_posts = {
+                post['_id']: post
+                for post in posts.find(
+                    {'_id': {'$in': list({comment['post'] for comment in batch})}, 'deleted': {'$ne': True}}, post_fields)
+            }
+            count += insert([
+                SearchEntry._son(batch_posts[comment['post']], comment['content'], comment['_id'])
+                for comment in batch if comment['post'] in batch_posts
+            ])
+        return count
+
+
+Post.register_delete_rule(Comment, 'post', CASCADE)
+Post.register_delete_rule(TimelineEntry, 'post', CASCADE)
@@ -1,6 +1,34 @@
+import os
 import unittest
-from mongoengine import connect, Document
-from models import User, Circle
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest.mock import patch
+from mongomock.collection import Collection
+from mongomock.store import lock as mongomock_store_lock
+from mongoengine import connect, disconnect, Document
+from models import User, Circle, Post, Comment, TimelineEntry, SearchEntry, cache
+from models import COMMENTS_PER_POST, REPLIES_PER_COMMENT, REPLY_LEVELS
+from custom_exceptions import UnauthorizedAccess
+from hashing import hasher
+from fragments import post_cards
+from cleanup import cleaner
+
+
+@contextmanager
+def count_queries():
+    """
+    Count queries sent to mongomock
+    :return (list[int]): a one element list holding the count
+    """
+    count = [0]
+    original_find = Collection.find
+
+    def find(collection, *args, **kwargs):
+        count[0] += 1
+        return original_find(collection, *args, **kwargs)
+
+    with patch.object(Collection, 'find', find):
+        yield count
 
 
 class MongomockTestCase(unittest.TestCase):
@@ -19,7 +47,12 @@ class MongomockTestCase(unittest.TestCase):
     def setUpClass(cls):
         connect(cls.__name__, host='mongomock://localhost')
 
+    @classmethod
+    def tearDownClass(cls):
+        disconnect()
+
     def setUp(self):
+        cache.local.clear()
         for mongo_object in self._mongo_objects:
             mongo_object.save()
 
@@ -49,3 +82,778 @@ class UserTests(MongomockTestCase):
     def test_check_wrong_password(self):
         User.create('username', 'password')
         self.assertFalse(User.check('username', 'wrong password'))
+
+    def test_check_upgrades_hash(self):
+        self.addCleanup(hasher.configure)
+        hasher.configure(method='pbkdf2:sha256:1000')
+        User.create('username', 'password')
+        hasher.configure(method='pbkdf2:sha256:2000')
+        self.assertTrue(User.check('username', 'password'))
+        self.assertTrue(User.objects.get(user_id='username').password.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(User.check('username', 'password'))
+
+    def test_find_after_create(self):
+        self.assertFalse(User.find('username'))
+        User.create('username', 'password')
+        self.assertEqual(User.find('username').user_id, 'username')
+
+    def test_get_is_cached(self):
+        User.create('username', 'password')
+        user_id = User.find('username').id
+        with count_queries() as queries:
+            User.get(user_id)
+            User.get(user_id)
+        self.assertEqual(queries[0], 0)
+
+
+class PostTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(PostTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def setUp(self):
+        super(PostTests, self).setUp()
+        for user_id in ['alice', 'bob', 'carol']:
+            User.create(user_id, 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.carol = User.find('carol')
+        self.alice.create_circle('friends')
+        self.friends = Circle.objects.get(owner=self.alice.id, name='friends')
+        self.alice.toggle_member(self.friends, self.bob)
+
+    def _create_posts(self):
+        self.alice.create_post('public', True, [])
+        self.alice.create_post('private', False, [])
+        self.alice.create_post('friends', False, [self.friends])
+        self.bob.create_post('bob public', True, [])
+        self.carol.create_post('carol private', False, [])
+
+    def test_sees_posts(self):
+        self._create_posts()
+        self.assertEqual(
+            [post.content for post in self.bob.sees_posts()],
+            ['bob public', 'friends', 'public'])
+        self.assertEqual(
+            [post.content for post in self.carol.sees_posts()],
+            ['carol private', 'bob public', 'public'])
+
+    def test_sees_posts_by_user(self):
+        self._create_posts()
+        self.assertEqual(
+            [post.content for post in self.bob.sees_posts(self.alice)],
+            ['friends', 'public'])
+        self.assertEqual(
+            [post.content for post in self.alice.sees_posts(self.alice)],
+            ['friends', 'private', 'public'])
+
+    def test_sees_posts_matches_scan(self):
+        self._create_posts()
+        for viewer in [self.alice, self.bob, self.carol]:
+            for by_user in [None, self.alice, self.bob, self.carol]:
+                self.assertEqual(
+                    [post.id for post in viewer.sees_posts(by_user)],
+                    [post.id for post in viewer.sees_posts_by_scan(by_user)])
+
+    def test_sees_posts_page(self):
+        self._create_posts()
+        posts, next_cursor = self.carol.sees_posts_page(limit=2)
+        self.assertEqual([post.content for post in posts], ['carol private', 'bob public'])
+        self.assertEqual(next_cursor, posts[-1].id)
+        posts, next_cursor = self.carol.sees_posts_page(before=next_cursor, limit=2)
+        self.assertEqual([post.content for post in posts], ['public'])
+        self.assertIsNone(next_cursor)
+
+    def _render(self, viewer, posts):
+        """
+        Touch everything that cards/_post.jinja2 and cards/_comment.jinja2 touch
+        """
+        def render_comment(comment, parent_comment, post):
+            rendered = [comment.author.user_id, comment.content]
+            if parent_comment is None:
+                rendered.append(viewer.owns_comment(comment, post))
+            else:
+                rendered.append(viewer.owns_nested_comment(comment, parent_comment, post))
+            for nested_comment in comment.comments:
+                rendered.extend(render_comment(nested_comment, comment, post))
+            return rendered
+
+        rendered = []
+        for post in posts:
+            rendered.extend([post.author.user_id, post.content, viewer.owns_post(post)])
+            if viewer.owns_post(post):
+                rendered.append(post.sharing_scope_str)
+            for comment in post.comments:
+                rendered.extend(render_comment(comment, None, post))
+        return rendered
+
+    def _create_threads(self, count):
+        for i in range(count):
+            post = self.alice.create_post('post {}'.format(i), False, [self.friends])
+            for comment in [self.bob.create_comment('comment', post), self.alice.create_comment('comment', post)]:
+                self.alice.create_nested_comment('nested comment', comment, post)
+
+    def test_prefetch_query_count(self):
+        query_counts = []
+        for count in [1, 10]:
+            self._create_threads(count - len(Post.objects()))
+            posts = self.alice.sees_posts()
+            with count_queries() as queries:
+                Post.prefetch(posts)
+                rendered = self._render(self.alice, posts)
+            query_counts.append(queries[0])
+            self.assertEqual(len(rendered), count * 16)
+        # comments level by level, users, circles
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertLessEqual(query_counts[0], REPLY_LEVELS + 4)
+
+    def test_prefetch_renders_same(self):
+        self._create_threads(3)
+        self.assertEqual(
+            self._render(self.alice, Post.prefetch(self.alice.sees_posts())),
+            self._render(self.alice, self.alice.sees_posts()))
+
+    def test_prefetch_from_snapshots(self):
+        self._create_threads(3)
+        renders = []
+        query_counts = []
+        for _ in range(2):
+            posts = self.alice.sees_posts()
+            with count_queries() as queries:
+                Post.prefetch(posts)
+                renders.append(self._render(self.alice, posts))
+            query_counts.append(queries[0])
+            for document_class in [Post, Comment]:
+                document_class._get_collection().update_many({}, {'$unset': {'author_user_id': '', 'circle_names': ''}})
+        self.assertIn('friends', renders[0])
+        self.assertEqual(renders[0], renders[1])
+        # without snapshots, authors and circles are loaded with one query each
+        self.assertEqual(query_counts[0] + 2, query_counts[1])
+
+    def test_rename_circle(self):
+        post = self.alice.create_post('friends', False, [self.friends])
+        self.alice.create_circle('family')
+        self.assertFalse(self.alice.rename_circle(self.friends, 'family'))
+        self.assertTrue(self.alice.rename_circle(self.friends, 'close friends'))
+        self.assertEqual([circle.name for circle in self.alice.owned_circles()], ['close friends', 'family'])
+        renamed_post = Post.objects.get(id=post.id)
+        self.assertEqual(renamed_post.circle_names, {str(self.friends.id): 'close friends'})
+        self.assertEqual(renamed_post.version, post.version + 1)
+        self.assertEqual(Post.prefetch([renamed_post])[0].sharing_scope_str, 'close friends')
+        with self.assertRaises(UnauthorizedAccess):
+            self.bob.rename_circle(self.friends, 'alice friends')
+
+    def test_delete_circle_drops_snapshot(self):
+        self.alice.create_circle('family')
+        family = Circle.objects.get(owner=self.alice.id, name='family')
+        post = self.alice.create_post('friends and family', False, [self.friends, family])
+        self.alice.delete_circle(family)
+        self.assertEqual(Post.objects.get(id=post.id).circle_names, {str(self.friends.id): 'friends'})
+
+
+class TimelineTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(TimelineTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment, TimelineEntry])
+
+    def setUp(self):
+        super(TimelineTests, self).setUp()
+        TimelineEntry.enabled = True
+        self.addCleanup(setattr, TimelineEntry, 'enabled', False)
+        for user_id in ['alice', 'bob', 'carol']:
+            User.create(user_id, 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.carol = User.find('carol')
+        self.alice.create_circle('friends')
+        self.alice.create_circle('family')
+        self.friends = Circle.objects.get(name='friends')
+        self.family = Circle.objects.get(name='family')
+        self.alice.toggle_member(self.friends, self.bob)
+
+    def _assert_timelines_match_feeds(self, limit=2):
+        for viewer in [self.alice, self.bob, self.carol]:
+            viewer = User.objects.get(id=viewer.id)
+            timeline = []
+            before = None
+            while True:
+                posts, before = viewer.timeline_page(before, limit)
+                timeline.extend(post.id for post in posts)
+                if before is None:
+                    break
+            self.assertEqual(timeline, [post.id for post in viewer.sees_posts()])
+
+    def _create_posts(self):
+        self.alice.create_post('public', True, [])
+        self.alice.create_post('private', False, [])
+        self.alice.create_post('friends', False, [self.friends])
+        self.alice.create_post('friends and family', False, [self.friends, self.family])
+        self.alice.create_post('family', False, [self.family])
+        self.bob.create_post('bob public', True, [])
+        self.carol.create_post('carol private', False, [])
+
+    def test_fan_out(self):
+        self._create_posts()
+        self._assert_timelines_match_feeds()
+        self.assertEqual(TimelineEntry.objects(owner=self.bob.id).count(), 2)
+
+    def test_toggle_member(self):
+        self._create_posts()
+        self.alice.toggle_member(self.family, self.carol)
+        self._assert_timelines_match_feeds()
+        self.alice.toggle_member(self.family, self.bob)
+        self.alice.toggle_member(self.friends, self.bob)
+        self._assert_timelines_match_feeds()
+        self.assertEqual(
+            [entry.post.content for entry in TimelineEntry.objects(owner=self.bob.id).order_by('-post')],
+            ['family', 'friends and family'])
+
+    def test_delete_circle(self):
+        self._create_posts()
+        self.alice.toggle_member(self.family, self.bob)
+        self.alice.delete_circle(Circle.objects.get(id=self.friends.id))
+        self._assert_timelines_match_feeds()
+
+    def test_delete_post(self):
+        self._create_posts()
+        self.alice.delete_post(Post.objects.get(content='friends'))
+        self._assert_timelines_match_feeds()
+        self.assertEqual(TimelineEntry.objects(owner=self.bob.id).count(), 1)
+
+    def test_delete_post_with_pending_purge(self):
+        for i in range(4):
+            self.alice.create_post('friends {}'.format(i), False, [self.friends])
+        with patch.object(cleaner, 'submit', lambda fn, *args: None):
+            for content in ['friends 3', 'friends 2']:
+                self.alice.delete_post(Post.objects.get(content=content))
+        self.assertEqual(TimelineEntry.objects(owner=self.bob.id).count(), 4)
+        self._assert_timelines_match_feeds()
+
+    def test_backfill(self):
+        TimelineEntry.enabled = False
+        self._create_posts()
+        self.alice.toggle_member(self.family, self.carol)
+        self.assertEqual(TimelineEntry.backfill(), 5)
+        self._assert_timelines_match_feeds()
+
+
+class CommentTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(CommentTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Post, Comment])
+
+    def setUp(self):
+        super(CommentTests, self).setUp()
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.post = self.alice.create_post('post', True, [])
+
+    def _thread(self, comments):
+        return [(comment.content, self._thread(comment.comments)) for comment in comments]
+
+    def test_load_thread(self):
+        first = self.bob.create_comment('first', self.post)
+        second = self.alice.create_comment('second', self.post)
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        self.bob.create_nested_comment('reply to reply', reply, self.post)
+        self.bob.create_nested_comment('another reply', second, self.post)
+        post = Post.objects.get(id=self.post.id)
+        with count_queries() as queries:
+            thread = self._thread(post.comments)
+        self.assertLessEqual(queries[0], REPLY_LEVELS + 2)
+        self.assertEqual(thread, [
+            ('first', [('reply', [('reply to reply', [])])]),
+            ('second', [('another reply', [])])
+        ])
+
+    def test_load_collapsed_thread(self):
+        for i in range(COMMENTS_PER_POST + 1):
+            self.bob.create_comment('comment {}'.format(i), self.post)
+        first, second = Comment.objects.order_by('id')[:2]
+        for i in range(REPLIES_PER_COMMENT + 1):
+            self.alice.create_nested_comment('reply {}'.format(i), first, self.post)
+        deep = second
+        for i in range(REPLY_LEVELS + 1):
+            deep = self.bob.create_nested_comment('deep {}'.format(i), deep, self.post)
+
+        post = Post.objects.get(id=self.post.id)
+        self.assertEqual(len(post.comments), COMMENTS_PER_POST)
+        self.assertTrue(post.has_more_comments)
+        self.assertEqual(
+            [reply.content for reply in post.comments[0].comments],
+            ['reply {}'.format(i) for i in range(REPLIES_PER_COMMENT)])
+        self.assertTrue(post.comments[0].has_more_comments)
+        deepest_shown = post.comments[1]
+        for i in range(REPLY_LEVELS):
+            self.assertEqual(len(deepest_shown.comments), 1)
+            deepest_shown = deepest_shown.comments[0]
+        self.assertEqual(deepest_shown.content, 'deep {}'.format(REPLY_LEVELS - 1))
+        self.assertEqual(deepest_shown.comments, [])
+        self.assertTrue(deepest_shown.has_more_comments)
+
+    def test_load_page(self):
+        for i in range(5):
+            self.bob.create_comment('comment {}'.format(i), self.post)
+        first = Comment.objects.order_by('id').first()
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        self.bob.create_nested_comment('reply to reply', reply, self.post)
+
+        comments, next_cursor = Comment.load_page(self.post, limit=2)
+        self.assertEqual([comment.content for comment in comments], ['comment 0', 'comment 1'])
+        self.assertEqual([reply.content for reply in comments[0].comments], ['reply'])
+        comments, next_cursor = Comment.load_page(self.post, after=next_cursor, limit=2)
+        self.assertEqual([comment.content for comment in comments], ['comment 2', 'comment 3'])
+        comments, next_cursor = Comment.load_page(self.post, after=next_cursor, limit=2)
+        self.assertEqual([comment.content for comment in comments], ['comment 4'])
+        self.assertIsNone(next_cursor)
+
+        comments, next_cursor = Comment.load_page(self.post, reply)
+        self.assertEqual([(comment.content, comment.author.user_id) for comment in comments], [('reply to reply', 'bob')])
+        self.assertIsNone(next_cursor)
+
+    def test_create_nested_comment_stores_ancestors(self):
+        first = self.bob.create_comment('first', self.post)
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        reply_to_reply = self.bob.create_nested_comment('reply to reply', reply, self.post)
+        self.assertEqual(
+            [ancestor.id for ancestor in Comment.objects.get(id=reply_to_reply.id).ancestors],
+            [first.id, reply.id])
+
+    def test_create_nested_comment_under_other_post(self):
+        other_post = self.alice.create_post('other post', True, [])
+        first = self.bob.create_comment('first', self.post)
+        with self.assertRaises(UnauthorizedAccess):
+            self.bob.create_nested_comment('reply', first, other_post)
+
+    def test_delete_comment_deletes_replies(self):
+        first = self.bob.create_comment('first', self.post)
+        second = self.bob.create_comment('second', self.post)
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        self.bob.create_nested_comment('reply to reply', reply, self.post)
+        self.bob.delete_comment(first, self.post)
+        self.assertEqual([comment.id for comment in Comment.objects()], [second.id])
+
+    def test_delete_nested_comment_deletes_replies(self):
+        first = self.bob.create_comment('first', self.post)
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        self.bob.create_nested_comment('reply to reply', reply, self.post)
+        self.bob.delete_nested_comment(reply, first, self.post)
+        self.assertEqual([comment.id for comment in Comment.objects()], [first.id])
+
+    def test_delete_comment_of_other_post(self):
+        # /rm-comment with a post_id of a post that the user owns, but not the one the comment is on
+        User.create('carol', 'password')
+        carol_comment = User.find('carol').create_comment('carol', self.post)
+        bob_post = self.bob.create_post('bob post', True, [])
+        with self.assertRaises(UnauthorizedAccess):
+            self.bob.delete_comment(carol_comment, bob_post)
+        self.assertEqual([comment.id for comment in Comment.objects()], [carol_comment.id])
+
+    def test_delete_nested_comment_under_other_parent(self):
+        # /rm-nested-comment with a parent_comment_id of a comment that the user wrote, but not the parent
+        User.create('carol', 'password')
+        carol = User.find('carol')
+        first = carol.create_comment('first', self.post)
+        carol_reply = carol.create_nested_comment('reply', first, self.post)
+        bob_comment = self.bob.create_comment('bob', self.post)
+        with self.assertRaises(UnauthorizedAccess):
+            self.bob.delete_nested_comment(carol_reply, bob_comment, self.post)
+        bob_post = self.bob.create_post('bob post', True, [])
+        with self.assertRaises(UnauthorizedAccess):
+            self.bob.delete_nested_comment(carol_reply, first, bob_post)
+        self.assertEqual(Comment.objects(id=carol_reply.id).count(), 1)
+
+    def test_delete_post_deletes_comments(self):
+        first = self.bob.create_comment('first', self.post)
+        self.alice.create_nested_comment('reply', first, self.post)
+        self.alice.delete_post(self.post)
+        self.assertEqual(len(Comment.objects()), 0)
+
+    def test_comment_writes_invalidate_post_card(self):
+        def render_card():
+            return post_cards.get_or_render(self.post.id, Post.objects.get(id=self.post.id).version, lambda: 'card')
+
+        versions = [Post.objects.get(id=self.post.id).version]
+        render_card()
+        first = self.bob.create_comment('first', self.post)
+        versions.append(Post.objects.get(id=self.post.id).version)
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        versions.append(Post.objects.get(id=self.post.id).version)
+        self.bob.delete_nested_comment(reply, first, self.post)
+        versions.append(Post.objects.get(id=self.post.id).version)
+        self.bob.delete_comment(first, self.post)
+        versions.append(Post.objects.get(id=self.post.id).version)
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(len(post_cards), 0)
+        render_card()
+        self.alice.delete_post(self.post)
+        self.assertEqual(len(post_cards), 0)
+
+    def test_comment_count(self):
+        first = self.bob.create_comment('first', self.post)
+        reply = self.alice.create_nested_comment('reply', first, self.post)
+        self.bob.create_nested_comment('reply to reply', reply, self.post)
+        self.bob.create_comment('second', self.post)
+        self.assertEqual(Post.objects.get(id=self.post.id).comment_count, 4)
+        self.bob.delete_nested_comment(reply, first, self.post)
+        self.assertEqual(Post.objects.get(id=self.post.id).comment_count, 2)
+        self.bob.delete_comment(first, self.post)
+        self.assertEqual(Post.objects.get(id=self.post.id).comment_count, 1)
+
+    def test_post_count(self):
+        self.assertEqual(User.get(self.alice.id).post_count, 1)
+        self.alice.create_post('another post', True, [])
+        self.assertEqual(User.get(self.alice.id).post_count, 2)
+        self.alice.delete_post(self.post)
+        self.assertEqual(User.get(self.alice.id).post_count, 1)
+
+
+class TombstoneTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(TombstoneTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def setUp(self):
+        super(TombstoneTests, self).setUp()
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.alice.create_circle('friends')
+        self.friends = Circle.objects.get(owner=self.alice.id)
+        self.alice.toggle_member(self.friends, self.bob)
+        self.post = self.alice.create_post('post', False, [self.friends])
+        self.comment = self.bob.create_comment('comment', self.post)
+        self.reply = self.alice.create_nested_comment('reply', self.comment, self.post)
+        self.cleanups = []
+        patcher = patch.object(cleaner, 'submit', lambda fn, *args: self.cleanups.append((fn, args)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run_cleanups(self):
+        for fn, args in self.cleanups:
+            fn(*args)
+
+    def test_delete_post(self):
+        self.alice.delete_post(self.post)
+        self.assertEqual(self.bob.sees_posts_page()[0], [])
+        self.assertEqual(Comment._get_collection().count_documents({}), 2)
+        self._run_cleanups()
+        self.assertEqual(Post._get_collection().count_documents({}), 0)
+        self.assertEqual(Comment._get_collection().count_documents({}), 0)
+
+    def test_delete_comment(self):
+        self.alice.delete_comment(self.comment, self.post)
+        self.assertEqual(Post.objects.get(id=self.post.id).comments, [])
+        self.assertEqual(Comment.load_page(self.post)[0], [])
+        self._run_cleanups()
+        self.assertEqual(Comment._get_collection().count_documents({}), 0)
+        self.assertEqual(Post.objects.get(id=self.post.id).comment_count, 0)
+
+    def test_delete_circle(self):
+        self.alice.delete_circle(Circle.objects.get(id=self.friends.id))
+        self.assertEqual(User.find('bob').sees_posts_page()[0], [])
+        self.assertEqual(self.alice.owned_circles(), [])
+        self._run_cleanups()
+        self.assertEqual(Circle._get_collection().count_documents({}), 0)
+        self.assertEqual(Post.objects.get(id=self.post.id).circles, [])
+
+    def test_delete_account(self):
+        bob_post = self.bob.create_post('bob post', True, [])
+        self.alice.create_comment('comment on bob post', bob_post)
+        self.alice.delete_account()
+        self.assertFalse(User.find('alice'))
+        self._run_cleanups()
+        self.assertEqual([post.id for post in Post.objects()], [bob_post.id])
+        self.assertEqual(Comment._get_collection().count_documents({}), 0)
+        self.assertEqual(Post.objects.get(id=bob_post.id).comment_count, 0)
+        self.assertEqual(Circle._get_collection().count_documents({}), 0)
+        self.assertEqual(User._get_collection().count_documents({}), 1)
+
+
+class SearchTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(SearchTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment, SearchEntry])
+
+    def setUp(self):
+        super(SearchTests, self).setUp()
+        for user_id in ['alice', 'bob', 'carol']:
+            User.create(user_id, 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.carol = User.find('carol')
+        self.alice.create_circle('friends')
+        self.friends = Circle.objects.get(owner=self.alice.id)
+        self.alice.toggle_member(self.friends, self.bob)
+
+    def _search(self, user, query, **kwargs):
+        results, _ = User.find(user.user_id).search(query, **kwargs)
+        return [(post.content, comment.content if comment else None) for post, comment in results]
+
+    def test_visibility(self):
+        self.alice.create_post('Hiking trip', True, [])
+        self.alice.create_post('hiking with friends', False, [self.friends])
+        self.alice.create_post('private hiking notes', False, [])
+        self.assertEqual(self._search(self.alice, 'hiking'), [
+            ('private hiking notes', None), ('hiking with friends', None), ('Hiking trip', None)])
+        self.assertEqual(self._search(self.bob, 'hiking'), [('hiking with friends', None), ('Hiking trip', None)])
+        self.assertEqual(self._search(self.carol, 'hiking'), [('Hiking trip', None)])
+
+    def test_comments(self):
+        post = self.alice.create_post('weekend plans', False, [self.friends])
+        self.bob.create_comment('count me in for hiking', post)
+        self.assertEqual(self._search(self.bob, 'hiking'), [('weekend plans', 'count me in for hiking')])
+        self.assertEqual(self._search(self.carol, 'hiking'), [])
+
+    def test_ranking(self):
+        self.alice.create_post('hiking in the alps', True, [])
+        self.alice.create_post('alps', True, [])
+        for i in range(3):
+            self.alice.create_post('hiking {}'.format(i), True, [])
+        self.assertEqual(self._search(self.carol, 'alps hiking')[:2], [('hiking in the alps', None), ('alps', None)])
+
+    def test_pages(self):
+        for i in range(5):
+            self.alice.create_post('hiking {}'.format(i), True, [])
+        results, has_more = self.carol.search('hiking', page=0, limit=2)
+        self.assertEqual(([post.content for post, _ in results], has_more), (['hiking 4', 'hiking 3'], True))
+        results, has_more = self.carol.search('hiking', page=2, limit=2)
+        self.assertEqual(([post.content for post, _ in results], has_more), (['hiking 0'], False))
+
+    def test_delete(self):
+        post = self.alice.create_post('hiking', False, [self.friends])
+        comment = self.bob.create_comment('hiking too', post)
+        self.bob.delete_comment(comment, post)
+        self.assertEqual(self._search(self.bob, 'hiking'), [('hiking', None)])
+        self.alice.delete_circle(Circle.objects.get(id=self.friends.id))
+        self.assertEqual(self._search(self.bob, 'hiking'), [])
+        self.alice.delete_post(post)
+        self.assertEqual(SearchEntry.objects.count(), 0)
+
+    def test_delete_comment_with_pending_purge(self):
+        post = self.alice.create_post('weekend plans', False, [self.friends])
+        comment = self.bob.create_comment('count me in', post)
+        self.alice.create_nested_comment('hiking then', comment, post)
+        with patch.object(cleaner, 'submit', lambda fn, *args: None):
+            self.bob.delete_comment(comment, post)
+        self.assertEqual(self._search(self.bob, 'hiking'), [])
+
+    def test_rebuild(self):
+        post = self.alice.create_post('hiking', False, [self.friends])
+        self.bob.create_comment('hiking too', post)
+        before = self._search(self.bob, 'hiking')
+        self.assertEqual(SearchEntry.rebuild(), 2)
+        self.assertEqual(self._search(self.bob, 'hiking'), before)
+
+
+class CircleTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(CircleTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle])
+
+    def test_circle_count(self):
+        self.alice.create_circle('family')
+        self.alice.create_circle('family')
+        self.assertEqual(User.get(self.alice.id).circle_count, 2)
+        self.alice.delete_circle(Circle.objects.get(owner=self.alice.id, name='family'))
+        self.assertEqual(User.get(self.alice.id).circle_count, 1)
+
+    def setUp(self):
+        super(CircleTests, self).setUp()
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.alice.create_circle('friends')
+        self.alice.create_circle('family')
+        self.friends = Circle.objects.get(name='friends')
+        self.family = Circle.objects.get(name='family')
+
+    def test_toggle_member(self):
+        self.alice.toggle_member(self.friends, self.bob)
+        self.assertTrue(Circle.objects.get(id=self.friends.id).check_member(self.bob))
+        self.alice.toggle_member(self.friends, self.bob)
+        self.assertFalse(Circle.objects.get(id=self.friends.id).check_member(self.bob))
+
+    def test_set_member(self):
+        published = []
+        with patch('models.events.publish', published.append):
+            self.assertTrue(self.alice.set_member(self.friends, self.bob, True))
+            self.assertFalse(self.alice.set_member(self.friends, self.bob, True))
+            self.assertTrue(Circle.objects.get(id=self.friends.id).check_member(self.bob))
+            self.assertEqual(User.get(self.bob.id).membership_version, 1)
+            self.assertTrue(self.alice.set_member(self.friends, self.bob, False))
+            self.assertFalse(self.alice.set_member(self.friends, self.bob, False))
+            self.assertFalse(Circle.objects.get(id=self.friends.id).check_member(self.bob))
+        self.assertEqual(User.get(self.bob.id).membership_version, 2)
+        self.assertEqual(len(published), 2)
+        with self.assertRaises(UnauthorizedAccess):
+            self.bob.set_member(self.friends, self.bob, True)
+
+    def test_member_circle_ids(self):
+        self.assertEqual(self.bob.member_circle_ids, set())
+        self.alice.toggle_member(self.friends, self.bob)
+        self.alice.toggle_member(self.family, self.bob)
+        self.assertEqual(self.bob.member_circle_ids, {self.friends.id, self.family.id})
+        self.alice.toggle_member(self.family, self.bob)
+        self.assertEqual(self.bob.member_circle_ids, {self.friends.id})
+
+    def test_owned_circles_after_create_circle(self):
+        self.assertEqual([circle.name for circle in self.alice.owned_circles()], ['friends', 'family'])
+        self.alice.create_circle('colleagues')
+        self.assertEqual([circle.name for circle in self.alice.owned_circles()], ['friends', 'family', 'colleagues'])
+
+    def test_owned_circles_after_toggle_member(self):
+        self.alice.owned_circles()
+        self.alice.toggle_member(self.friends, self.bob)
+        self.assertTrue(self.alice.owned_circles()[0].check_member(self.bob))
+
+    def test_member_circle_ids_across_requests(self):
+        self.assertEqual(User.find('bob').member_circle_ids, set())
+        self.alice.toggle_member(self.friends, self.bob)
+        self.assertEqual(User.find('bob').member_circle_ids, {self.friends.id})
+        with count_queries() as queries:
+            self.assertEqual(User.find('bob').member_circle_ids, {self.friends.id})
+        self.assertEqual(queries[0], 0)
+
+    def test_member_circle_ids_after_delete_circle(self):
+        self.alice.toggle_member(self.friends, self.bob)
+        self.alice.delete_circle(self.friends)
+        self.assertEqual(User.find('bob').member_circle_ids, set())
+
+    def test_check_member_does_not_dereference(self):
+        self.alice.toggle_member(self.friends, self.bob)
+        circle = Circle.objects.get(id=self.friends.id)
+        self.assertTrue(circle.check_member(self.bob))
+        self.assertFalse(any(isinstance(member, User) for member in circle._data['members']))
+
+
+class DirectoryTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(DirectoryTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle])
+
+    def setUp(self):
+        super(DirectoryTests, self).setUp()
+        for user_id in ['alice', 'bob', 'bobby', 'carol', 'dave']:
+            User.create(user_id, 'password')
+        self.alice = User.find('alice')
+        self.alice.create_circle('friends')
+        self.alice.create_circle('family')
+        self.friends = Circle.objects.get(name='friends')
+        self.family = Circle.objects.get(name='family')
+
+    def test_pages(self):
+        page, cursor = self.alice.directory_page(limit=2)
+        self.assertEqual([user.user_id for user in page], ['bob', 'bobby'])
+        page, cursor = self.alice.directory_page(after=cursor, limit=2)
+        self.assertEqual([user.user_id for user in page], ['carol', 'dave'])
+        self.assertIsNone(cursor)
+
+    def test_prefix(self):
+        page, cursor = self.alice.directory_page('bob')
+        self.assertEqual([user.user_id for user in page], ['bob', 'bobby'])
+        self.assertIsNone(cursor)
+        self.assertEqual(self.alice.directory_page('b.')[0], [])
+        self.assertEqual(self.alice.directory_page('ali')[0], [])
+
+    def test_projection(self):
+        User.find('carol').create_circle('friends')
+        page, _ = self.alice.directory_page('carol')
+        self.assertEqual(page[0]._data.get('password'), None)
+        self.assertEqual((page[0].post_count, page[0].circle_count), (0, 1))
+
+    def test_circle_memberships(self):
+        bob, carol, dave = User.find('bob'), User.find('carol'), User.find('dave')
+        self.alice.toggle_member(self.friends, bob)
+        self.alice.toggle_member(self.family, bob)
+        self.alice.toggle_member(self.family, carol)
+        User.find('dave').create_circle('friends')
+        User.find('dave').toggle_member(Circle.objects.get(owner=dave.id), carol)
+        page, _ = self.alice.directory_page()
+        with count_queries() as queries:
+            memberships = self.alice.circle_memberships(page)
+        self.assertEqual(queries[0], 1)
+        self.assertEqual(memberships, {bob.id: {self.friends.id, self.family.id}, carol.id: {self.family.id}})
+
+
+def _atomic(method):
+    def atomic_method(*args, **kwargs):
+        with mongomock_store_lock:
+            return method(*args, **kwargs)
+
+    return atomic_method
+
+
+class ConcurrentUpdateTests(MongomockTestCase):
+    """
+    Runs against a local mongod when MONGODB_TEST_URI is set, e.g. mongodb://localhost:27017/minigplus-test
+    """
+    THREADS = 8
+    USERS = 64
+
+    def __init__(self, *args, **kwargs):
+        super(ConcurrentUpdateTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    @classmethod
+    def setUpClass(cls):
+        connect(cls.__name__, host=os.environ.get('MONGODB_TEST_URI', 'mongomock://localhost'))
+
+    def setUp(self):
+        super(ConcurrentUpdateTests, self).setUp()
+        # mongomock applies a single update in several steps, a server applies it atomically
+        for method in ['_update', '_find_and_modify', '_insert']:
+            patcher = patch.object(Collection, method, _atomic(getattr(Collection, method)))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        User._get_collection().insert_many([
+            {'user_id': 'user{}'.format(i), 'password': 'password'} for i in range(self.USERS)
+        ])
+        self.users = list(User.objects())
+        self.owner = self.users[0]
+        self.owner.create_circle('friends')
+        self.circle = Circle.objects.get(name='friends')
+
+    def _toggle_all(self):
+        def toggle(member):
+            # every worker acts on its own stale copy of the circle, like separate requests do
+            return self.owner.toggle_member(Circle.objects.get(id=self.circle.id), member)
+
+        with ThreadPoolExecutor(self.THREADS) as executor:
+            return list(executor.map(toggle, self.users))
+
+    def test_concurrent_toggle_member_adds_every_member(self):
+        self.assertTrue(all(self._toggle_all()))
+        self.assertEqual(
+            {member.id for member in Circle.objects.get(id=self.circle.id).members},
+            {user.id for user in self.users})
+
+    def test_concurrent_toggle_member_removes_every_member(self):
+        self._toggle_all()
+        self.assertFalse(any(self._toggle_all()))
+        self.assertEqual(Circle.objects.get(id=self.circle.id).members, [])
+
+    def test_concurrent_set_member_changes_once(self):
+        member = self.users[1]
+        with ThreadPoolExecutor(self.THREADS) as executor:
+            changed = list(executor.map(
+                lambda _: self.owner.set_member(Circle.objects.get(id=self.circle.id), member, True),
+                range(self.THREADS)))
+        self.assertEqual(changed.count(True), 1)
+        self.assertEqual(User.get(member.id).membership_version, 1)
+        self.assertEqual([user.id for user in Circle.objects.get(id=self.circle.id).members], [member.id])
+
+    def test_concurrent_create_comment_keeps_every_comment(self):
+        post = self.owner.create_post('post', True, [])
+
+        def comment(member):
+            return member.create_comment('comment by {}'.format(member.user_id), post)
+
+        with ThreadPoolExecutor(self.THREADS) as executor:
+            list(executor.map(comment, self.users))
+        self.assertEqual(Comment.objects(post=post.id).count(), self.USERS)
+        self.assertEqual(Post.objects.get(id=post.id).comment_count, self.USERS)
@@ -0,0 +1,120 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+from custom_exceptions import SignInThrottled
+
+
+class TokenBuckets(object):
+    """
+    In-process token buckets: a bucket holds up to capacity tokens and gains refill_per_second tokens a second,
+        every attempt takes one token
+    Buckets that were not touched for the longest are evicted first when there are too many, they are the fullest
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        :param (int) max_size: max number of buckets
+        """
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_per_second):
+        """
+        Take a token from a bucket, a missing bucket starts full
+        :param (str) key: the key of the bucket
+        :param (float) capacity: max tokens of the bucket
+        :param (float) refill_per_second: tokens the bucket gains a second
+        :return (float): 0 if a token was taken, else the seconds until the bucket holds one
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+            wait_seconds = 0 if tokens >= 1 else (1 - tokens) / refill_per_second
+            self._buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+            return wait_seconds
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LocalSharedBucketStore(object):
+    """
+    Stand-in for a shared bucket store that lives in this process, for tests and single process deployments
+    A shared bucket store holds token buckets shared by all worker processes, e.g. a redis script that refills
+        and takes in one step, with one method:
+        take(key, capacity, refill_per_second) takes a token from the bucket of a string key, which holds at most
+            capacity tokens and gains refill_per_second a second, and returns 0 if a token was taken,
+            else the seconds until the bucket holds one
+    """
+
+    def __init__(self):
+        self._buckets = TokenBuckets()
+
+    def take(self, key, capacity, refill_per_second):
+        return self._buckets.take(key, capacity, refill_per_second)
+
+
+class SignInThrottle(object):
+    """
+    Limits sign in attempts by client IP and by user id, before any password is hashed
+    The IP bucket slows down one client trying many user ids, the user bucket many clients trying one user id
+    An attempt rejected by its IP bucket takes no token of its user bucket, so that the user can still sign in
+        from elsewhere. Buckets live in this process, unless a shared store is configured
+    """
+
+    def __init__(self, user_capacity=10, user_per_minute=5, ip_capacity=30, ip_per_minute=30, shared=None):
+        """
+        :param (float) user_capacity: attempts a user id may make in a burst
+        :param (float) user_per_minute: attempts a user id regains a minute
+        :param (float) ip_capacity: attempts a client IP may make in a burst
+        :param (float) ip_per_minute: attempts a client IP regains a minute
+        :param shared: optional shared store, see LocalSharedBucketStore
+        """
+        self.local = TokenBuckets()
+        self.rejected = 0
+        self.configure(user_capacity, user_per_minute, ip_capacity, ip_per_minute, shared)
+
+    def configure(self, user_capacity=10, user_per_minute=5, ip_capacity=30, ip_per_minute=30, shared=None,
+                  enabled=True):
+        """
+        Reconfigure the throttle and drop all in-process buckets
+        """
+        self.user_capacity = user_capacity
+        self.user_per_minute = user_per_minute
+        self.ip_capacity = ip_capacity
+        self.ip_per_minute = ip_per_minute
+        self.shared = shared
+        self.enabled = enabled
+        self.local.clear()
+
+    def _take(self, key, capacity, per_minute):
+        store = self.shared if self.shared is not None else self.local
+        return store.take(key, capacity, per_minute / 60)
+
+    def check(self, user_id, ip):
+        """
+        Count a sign in attempt
+        :param (str) user_id: the user id the client signs in as
+        :param (str) ip: the IP of the client
+        :raise (SignInThrottled) when the client IP or the user id made too many attempts
+        """
+        if not self.enabled:
+            return
+        wait_seconds = self._take('ip:{}'.format(ip), self.ip_capacity, self.ip_per_minute) or \
+            self._take('user:{}'.format(user_id), self.user_capacity, self.user_per_minute)
+        if wait_seconds:
+            self.rejected += 1
+            raise SignInThrottled(retry_after=max(1, math.ceil(wait_seconds)))
+
+
+sign_in_throttle = SignInThrottle()
@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import patch
+from flask import Flask
+from ratelimit import TokenBuckets, SignInThrottle, LocalSharedBucketStore
+from custom_exceptions import SignInThrottled
+
+
+class TokenBucketsTests(unittest.TestCase):
+    def test_refills(self):
+        buckets = TokenBuckets()
+        with patch('ratelimit.time.monotonic', return_value=100):
+            self.assertEqual([buckets.take('a', 2, 0.5) for _ in range(3)], [0, 0, 2])
+            self.assertEqual(buckets.take('b', 2, 0.5), 0)
+        with patch('ratelimit.time.monotonic', return_value=101):
+            self.assertEqual(buckets.take('a', 2, 0.5), 1)
+        with patch('ratelimit.time.monotonic', return_value=102):
+            self.assertEqual(buckets.take('a', 2, 0.5), 0)
+        with patch('ratelimit.time.monotonic', return_value=1000):
+            self.assertEqual([buckets.take('a', 2, 0.5) for _ in range(3)], [0, 0, 2])
+
+    def test_evicts_least_recently_taken(self):
+        buckets = TokenBuckets(max_size=2)
+        buckets.take('a', 1, 0.1)
+        buckets.take('b', 1, 0.1)
+        buckets.take('c', 1, 0.1)
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(buckets.take('a', 1, 0.1), 0)
+        self.assertGreater(buckets.take('c', 1, 0.1), 0)
+
+
+class SignInThrottleTests(unittest.TestCase):
+    def test_user_bucket(self):
+        throttle = SignInThrottle(user_capacity=2, user_per_minute=6)
+        with patch('ratelimit.time.monotonic', return_value=100):
+            throttle.check('alice', '10.0.0.1')
+            throttle.check('alice', '10.0.0.2')
+            with self.assertRaises(SignInThrottled) as raised:
+                throttle.check('alice', '10.0.0.3')
+            self.assertEqual(raised.exception.retry_after, 10)
+            throttle.check('bob', '10.0.0.3')
+        self.assertEqual(throttle.rejected, 1)
+
+    def test_ip_bucket_spares_users(self):
+        throttle = SignInThrottle(user_capacity=1, ip_capacity=2)
+        throttle.check('alice', '10.0.0.1')
+        throttle.check('bob', '10.0.0.1')
+        for _ in range(5):
+            with self.assertRaises(SignInThrottled):
+                throttle.check('carol', '10.0.0.1')
+        throttle.check('carol', '10.0.0.2')
+
+    def test_shared_store(self):
+        shared = LocalSharedBucketStore()
+        worker, other_worker = SignInThrottle(user_capacity=1, shared=shared), SignInThrottle(user_capacity=1, shared=shared)
+        worker.check('alice', '10.0.0.1')
+        with self.assertRaises(SignInThrottled):
+            other_worker.check('alice', '10.0.0.2')
+
+    def test_disabled(self):
+        throttle = SignInThrottle()
+        throttle.configure(user_capacity=1, enabled=False)
+        for _ in range(3):
+            throttle.check('alice', '10.0.0.1')
+
+    def test_rejects_before_checking(self):
+        app = Flask(__name__)
+        throttle = SignInThrottle(user_capacity=1)
+        checked = []
+
+        @app.route('/signin', methods=['POST'])
+        def signin():
+            throttle.check('alice', '10.0.0.1')
+            checked.append('alice')
+            return ''
+
+        client = app.test_client()
+        self.assertEqual(client.post('/signin').status_code, 200)
+        response = client.post('/signin')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '12')
+        self.assertEqual(checked, ['alice'])
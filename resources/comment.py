@@ -0,0 +1,48 @@
+from flask_restful import reqparse, Resource
+from models import Post as DbPost
+from models import Comment as DbComment
+from models import REPLIES_PER_COMMENT
+from flask_jwt_extended import jwt_required
+from auth import token_user
+from bson.objectid import ObjectId
+from utils import parse_cursor
+
+MAX_COMMENTS_PER_PAGE = 100
+
+comment_list_parser = reqparse.RequestParser()
+comment_list_parser.add_argument('parent', type=str, location='args')
+comment_list_parser.add_argument('after', type=str, location='args')
+comment_list_parser.add_argument('limit', type=int, location='args', default=REPLIES_PER_COMMENT)
+
+
+def serialize_comment(comment):
+    return {
+        'id': str(comment.id),
+        'author': comment.author.user_id,
+        'content': comment.content,
+        'createdAtSeconds': comment.created_at_unix_seconds,
+        'comments': [serialize_comment(reply) for reply in comment.comments],
+        'hasMoreComments': comment.has_more_comments
+    }
+
+
+class CommentList(Resource):
+    @jwt_required
+    def get(self, post_id):
+        args = comment_list_parser.parse_args()
+        user = token_user()
+        post = DbPost.objects(id=post_id).first() if ObjectId.is_valid(post_id) else None
+        if not post or not user.sees_post(post):
+            return {'message': 'post not found'}, 404
+        parent_comment = None
+        if args['parent']:
+            parent_id = parse_cursor(args['parent'])
+            parent_comment = DbComment.objects(id=parent_id, post=post.id).first() if parent_id else None
+            if not parent_comment:
+                return {'message': 'comment not found'}, 404
+        limit = min(max(args['limit'], 1), MAX_COMMENTS_PER_PAGE)
+        comments, next_cursor = DbComment.load_page(post, parent_comment, parse_cursor(args['after']), limit)
+        return {
+            'comments': [serialize_comment(comment) for comment in comments],
+            'nextCursor': str(next_cursor) if next_cursor else None
+        }, 200
@@ -0,0 +1,48 @@
+from flask_restful import reqparse, Resource
+from models import Post as DbPost
+from models import POSTS_PER_PAGE
+from flask_jwt_extended import jwt_required
+from auth import token_user
+from bson.objectid import ObjectId
+from utils import parse_cursor
+
+MAX_POSTS_PER_PAGE = 100
+
+post_list_parser = reqparse.RequestParser()
+post_list_parser.add_argument('before', type=str, location='args')
+post_list_parser.add_argument('limit', type=int, location='args', default=POSTS_PER_PAGE)
+
+
+def serialize_post(post):
+    return {
+        'id': str(post.id),
+        'author': post.author.user_id,
+        'content': post.content,
+        'isPublic': post.is_public,
+        'commentCount': post.comment_count,
+        'createdAtSeconds': post.created_at_unix_seconds
+    }
+
+
+class PostList(Resource):
+    @jwt_required
+    def get(self):
+        args = post_list_parser.parse_args()
+        user = token_user()
+        limit = min(max(args['limit'], 1), MAX_POSTS_PER_PAGE)
+        posts, next_cursor = user.sees_posts_page(before=parse_cursor(args['before']), limit=limit)
+        DbPost.prefetch(posts, threads=False)
+        return {
+            'posts': [serialize_post(post) for post in posts],
+            'nextCursor': str(next_cursor) if next_cursor else None
+        }, 200
+
+
+class Post(Resource):
+    @jwt_required
+    def get(self, post_id):
+        user = token_user()
+        post = DbPost.objects(id=post_id).first() if ObjectId.is_valid(post_id) else None
+        if not post or not user.sees_post(post):
+            return {'message': 'post not found'}, 404
+        return serialize_post(post), 200
@@ -0,0 +1,37 @@
+from flask_restful import reqparse, Resource
+from models import SEARCH_RESULTS_PER_PAGE
+from flask_jwt_extended import jwt_required
+from auth import token_user
+from resources.post import serialize_post
+
+MAX_SEARCH_RESULTS_PER_PAGE = 100
+
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', type=str, location='args', required=True)
+search_parser.add_argument('page', type=int, location='args', default=0)
+search_parser.add_argument('limit', type=int, location='args', default=SEARCH_RESULTS_PER_PAGE)
+
+
+class SearchResults(Resource):
+    @jwt_required
+    def get(self):
+        args = search_parser.parse_args()
+        user = token_user()
+        page = max(args['page'], 0)
+        limit = min(max(args['limit'], 1), MAX_SEARCH_RESULTS_PER_PAGE)
+        results, has_more = user.search(args['q'], page, limit)
+        return {
+            'results': [
+                {
+                    'post': serialize_post(post),
+                    'comment': {
+                        'id': str(comment.id),
+                        'author': comment.author.user_id,
+                        'content': comment.content,
+                        'createdAtSeconds': comment.created_at_unix_seconds
+                    } if comment else None
+                }
+                for post, comment in results
+            ],
+            'nextPage': page + 1 if has_more else None
+        }, 200
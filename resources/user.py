@@ -1,11 +1,29 @@
 from flask_restful import reqparse, Resource
 from models import User as DbUser
+from models import USERS_PER_PAGE
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from auth import token_user
+
+MAX_USERS_PER_PAGE = 100
 
 user_parser = reqparse.RequestParser()
 user_parser.add_argument('id', type=str, required=True)
 user_parser.add_argument('password', type=str, required=True)
 
+user_list_parser = reqparse.RequestParser()
+user_list_parser.add_argument('q', type=str, location='args')
+user_list_parser.add_argument('after', type=str, location='args')
+user_list_parser.add_argument('limit', type=int, location='args', default=USERS_PER_PAGE)
+
+
+def serialize_user(user):
+    return {
+        'id': user.user_id,
+        'postCount': user.post_count,
+        'circleCount': user.circle_count,
+        'createdAtSeconds': user.created_at_unix_seconds
+    }
+
 
 class UserList(Resource):
     def post(self):
@@ -18,12 +36,29 @@ class UserList(Resource):
 
     @jwt_required
     def get(self):
-        user_id = get_jwt_identity()
-        other_users = [
-            {'id': user.user_id, 'createdAtSeconds': user.created_at_unix_seconds}
-            for user in DbUser.objects(user_id__ne=user_id)
-        ]
-        return other_users, 200
+        args = user_list_parser.parse_args()
+        user = token_user()
+        limit = min(max(args['limit'], 1), MAX_USERS_PER_PAGE)
+        other_users, next_cursor = user.directory_page((args['q'] or '').strip(), args['after'] or None, limit)
+        memberships = user.circle_memberships(other_users)
+        return {
+            'users': [
+                dict(
+                    serialize_user(other_user),
+                    circles=sorted(str(circle_id) for circle_id in memberships.get(other_user.id, ())))
+                for other_user in other_users
+            ],
+            'nextCursor': next_cursor
+        }, 200
+
+
+class User(Resource):
+    @jwt_required
+    def get(self, user_id):
+        user = DbUser.find(user_id)
+        if not user:
+            return {'message': 'user not found'}, 404
+        return serialize_user(user), 200
 
 
 class Me(Resource):
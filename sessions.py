@@ -0,0 +1,214 @@
+import uuid
+import datetime
+from bson.tz_util import utc
+from flask import session as current_session
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from flask_login import user_logged_in
+from flask_mongoengine import MongoEngineSessionInterface
+from werkzeug.datastructures import CallbackDict
+from cache import LRUCache
+
+SESSION_BACKENDS = ('cookie', 'memory', 'mongo')
+
+
+def _new_sid():
+    return str(uuid.uuid4())
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """
+    Session whose data lives on the server, the cookie only holds its id
+    The data is loaded by loader on first access, so requests that never touch the session never hit the store
+    An id that the store has no session for is replaced by a new random one, so that a client never picks its own id
+    """
+
+    def __init__(self, sid, loader=None):
+        """
+        :param (str) sid: session id
+        :param (callable) loader: returns the stored data, or None if there is none
+        """
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, None, on_update)
+        self.sid = sid
+        self.previous_sid = None
+        self.modified = False
+        self._loader = loader
+
+    def _load(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            data = loader()
+            if data:
+                dict.update(self, data)
+            else:
+                self.sid = _new_sid()
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def regenerate(self):
+        """
+        Move the session to a new random id, e.g. on sign in, the one it had is removed from the store when it is saved
+        """
+        self._load()
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = _new_sid()
+        self.modified = True
+
+
+def _loading(method_name):
+    method = getattr(CallbackDict, method_name)
+
+    def loading_method(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+
+    loading_method.__name__ = method_name
+    return loading_method
+
+
+for _method_name in [
+    '__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__eq__', '__repr__',
+    'get', 'keys', 'values', 'items', 'pop', 'popitem', 'setdefault', 'update', 'clear', 'copy'
+]:
+    setattr(ServerSideSession, _method_name, _loading(_method_name))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Base for sessions stored on the server
+    The session is written back and the cookie is set only if the session was modified
+    Subclasses define the store:
+        load(sid) returns the stored data of an unexpired session, None if there is none
+        store(sid, data, expiration) stores data until the datetime expiration
+        remove(sid) removes a session
+    """
+
+    def get_expiration(self, app, session):
+        """
+        Expiration of a session, permanent ones last PERMANENT_SESSION_LIFETIME and others SESSION_TTL,
+            keyword arguments of datetime.timedelta as for MongoEngineSessionInterface, one day by default
+        """
+        if session.permanent:
+            lifetime = app.permanent_session_lifetime
+        elif 'SESSION_TTL' in app.config:
+            lifetime = datetime.timedelta(**app.config['SESSION_TTL'])
+        else:
+            lifetime = datetime.timedelta(days=1)
+        return datetime.datetime.utcnow().replace(tzinfo=utc) + lifetime
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return ServerSideSession(_new_sid())
+        return ServerSideSession(sid, lambda: self.load(sid))
+
+    def save_session(self, app, session, response):
+        if not session.modified:
+            return
+        domain = self.get_cookie_domain(app)
+        if session.previous_sid is not None:
+            self.remove(session.previous_sid)
+        if not session:
+            self.remove(session.sid)
+            response.delete_cookie(app.session_cookie_name, domain=domain)
+            return
+        expiration = self.get_expiration(app, session)
+        self.store(session.sid, dict(session), expiration)
+        response.set_cookie(
+            app.session_cookie_name,
+            session.sid,
+            expires=expiration,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            secure=self.get_cookie_secure(app))
+
+
+class InProcessSessionInterface(ServerSideSessionInterface):
+    """
+    Sessions kept in the memory of this process, until they expire or are evicted to make room for newer ones
+    Only suitable for a single worker process, sessions are lost on restart
+    """
+
+    def __init__(self, max_sessions=100000):
+        # sessions carry their own expiration
+        self.sessions = LRUCache(max_sessions, float('inf'))
+
+    def load(self, sid):
+        entry = self.sessions.get(sid)
+        if not isinstance(entry, tuple):
+            return None
+        data, expiration = entry
+        if expiration <= datetime.datetime.utcnow().replace(tzinfo=utc):
+            self.sessions.delete(sid)
+            return None
+        return data
+
+    def store(self, sid, data, expiration):
+        self.sessions.set(sid, (data, expiration))
+
+    def remove(self, sid):
+        self.sessions.delete(sid)
+
+
+class LazyMongoEngineSessionInterface(ServerSideSessionInterface):
+    """
+    Sessions stored in Mongo, in the same collection as MongoEngineSessionInterface,
+        but loaded lazily and written only if modified
+    """
+
+    def __init__(self, db, collection='session'):
+        self.cls = MongoEngineSessionInterface(db, collection).cls
+
+    def load(self, sid):
+        stored_session = self.cls.objects(sid=sid).first()
+        if stored_session is None:
+            return None
+        expiration = stored_session.expiration
+        if not expiration.tzinfo:
+            expiration = expiration.replace(tzinfo=utc)
+        if expiration <= datetime.datetime.utcnow().replace(tzinfo=utc):
+            return None
+        return stored_session.data
+
+    def store(self, sid, data, expiration):
+        self.cls(sid=sid, data=data, expiration=expiration).save()
+
+    def remove(self, sid):
+        self.cls.objects(sid=sid).delete()
+
+
+def regenerate_on_sign_in(app):
+    """
+    Move server side sessions to a new id when a user signs in, so that an id known before sign in is useless after it
+    :param (Flask) app: the app
+    """
+    user_logged_in.connect(_regenerate_session, app)
+
+
+def _regenerate_session(sender, **extra):
+    if isinstance(current_session._get_current_object(), ServerSideSession):
+        current_session.regenerate()
+
+
+def create_session_interface(backend, db):
+    """
+    Create the session interface for a backend
+    :param (str) backend: one of SESSION_BACKENDS
+        cookie: signed stateless cookie sessions, no store at all
+        memory: sessions in the memory of this process
+        mongo: sessions in Mongo
+    :param (MongoEngine) db: the app's db
+    :return (SessionInterface): the session interface
+    """
+    if backend == 'cookie':
+        return SecureCookieSessionInterface()
+    elif backend == 'memory':
+        return InProcessSessionInterface()
+    elif backend == 'mongo':
+        return LazyMongoEngineSessionInterface(db)
+    raise ValueError('Unknown session backend {}, expected one of {}'.format(backend, ', '.join(SESSION_BACKENDS)))
@@ -0,0 +1,147 @@
+import datetime
+import unittest
+from unittest.mock import patch
+from flask import Flask, session
+from flask_login import LoginManager, UserMixin, login_user
+from flask_mongoengine import MongoEngine
+from models_test import MongomockTestCase
+from sessions import InProcessSessionInterface, LazyMongoEngineSessionInterface, regenerate_on_sign_in
+
+
+class _User(UserMixin):
+    id = 'alice'
+
+
+class CountingSessionInterface(InProcessSessionInterface):
+    def __init__(self):
+        super(CountingSessionInterface, self).__init__()
+        self.loads = 0
+        self.stores = 0
+
+    def load(self, sid):
+        self.loads += 1
+        return super(CountingSessionInterface, self).load(sid)
+
+    def store(self, sid, data, expiration):
+        self.stores += 1
+        super(CountingSessionInterface, self).store(sid, data, expiration)
+
+
+class ServerSideSessionTests(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.session_interface = self.session_interface = CountingSessionInterface()
+
+        @self.app.route('/set')
+        def set_value():
+            session['value'] = 'stored'
+            return ''
+
+        @self.app.route('/get')
+        def get_value():
+            return session.get('value', 'missing')
+
+        @self.app.route('/untouched')
+        def untouched():
+            return ''
+
+        @self.app.route('/clear')
+        def clear():
+            session.clear()
+            return ''
+
+        self.client = self.app.test_client()
+
+    def test_round_trip(self):
+        self.client.get('/set')
+        self.assertEqual(self.client.get('/get').data, b'stored')
+
+    def test_stores_only_if_modified(self):
+        self.client.get('/set')
+        self.client.get('/get')
+        self.client.get('/get')
+        self.assertEqual(self.session_interface.stores, 1)
+
+    def test_loads_lazily(self):
+        self.client.get('/set')
+        self.client.get('/untouched')
+        self.assertEqual(self.session_interface.loads, 0)
+        self.client.get('/get')
+        self.assertEqual(self.session_interface.loads, 1)
+
+    def test_clear(self):
+        self.client.get('/set')
+        self.client.get('/clear')
+        self.assertEqual(self.client.get('/get').data, b'missing')
+
+
+class SessionStoreTests(object):
+    """
+    Tests of a session store, mixed into a test case whose session_interface returns the store
+    """
+
+    def setUp(self):
+        super(SessionStoreTests, self).setUp()
+        self.app = Flask(__name__)
+        self.app.secret_key = 'secret'
+        self.app.session_interface = self.store = self.session_interface()
+        login_manager = LoginManager(self.app)
+        login_manager.user_loader(lambda user_id: _User())
+        regenerate_on_sign_in(self.app)
+
+        @self.app.route('/set')
+        def set_value():
+            session['value'] = 'stored'
+            return ''
+
+        @self.app.route('/get')
+        def get_value():
+            return session.get('value', 'missing')
+
+        @self.app.route('/signin')
+        def signin():
+            login_user(_User())
+            return ''
+
+        self.client = self.app.test_client()
+
+    def _sid(self, response):
+        cookie = response.headers['Set-Cookie']
+        return cookie.split(';', 1)[0].split('=', 1)[1]
+
+    def test_replaces_unknown_sid(self):
+        self.client.set_cookie('localhost', 'session', 'attacker-chosen-sid')
+        sid = self._sid(self.client.get('/set'))
+        self.assertNotEqual(sid, 'attacker-chosen-sid')
+        self.assertIsNone(self.store.load('attacker-chosen-sid'))
+        self.assertEqual(self.store.load(sid), {'value': 'stored'})
+
+    def test_new_sid_on_sign_in(self):
+        sid = self._sid(self.client.get('/set'))
+        signed_in_sid = self._sid(self.client.get('/signin'))
+        self.assertNotEqual(signed_in_sid, sid)
+        self.assertIsNone(self.store.load(sid))
+        self.assertEqual(self.store.load(signed_in_sid)['value'], 'stored')
+        self.assertEqual(self.client.get('/get').data, b'stored')
+
+    def test_session_ttl(self):
+        self.app.config['SESSION_TTL'] = {'minutes': 5}
+        self.client.get('/set')
+        now = datetime.datetime.utcnow()
+        with patch('sessions.datetime.datetime') as frozen_datetime:
+            frozen_datetime.utcnow.return_value = now + datetime.timedelta(minutes=4)
+            self.assertEqual(self.client.get('/get').data, b'stored')
+            frozen_datetime.utcnow.return_value = now + datetime.timedelta(minutes=6)
+            self.assertEqual(self.client.get('/get').data, b'missing')
+
+
+class InProcessSessionStoreTests(SessionStoreTests, unittest.TestCase):
+    def session_interface(self):
+        return InProcessSessionInterface()
+
+
+class MongoSessionStoreTests(SessionStoreTests, MongomockTestCase):
+    def session_interface(self):
+        store = LazyMongoEngineSessionInterface(MongoEngine())
+        self._mongo_document_classes.append(store.cls)
+        return store
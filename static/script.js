@@ -1,3 +1,54 @@
 $(document).ready(function () {
     $('select.dropdown').dropdown();
+    // Replace a "Show more" link of a collapsed comment thread with the comments it points to
+    $(document).on('click', 'a.more-comments', function (event) {
+        event.preventDefault();
+        var link = $(this);
+        $.get(link.attr('href'), function (comments) {
+            link.replaceWith(comments);
+        });
+    });
+    // Insert new posts and reload changed ones as the event stream of async_api tells about them
+    var events = $('#events');
+    if (events.length && window.EventSource) {
+        var loadCard = function (message, insert) {
+            var postId = JSON.parse(message.data).post;
+            var url = events.data('card-url').replace('POST_ID', postId);
+            $.get(url, {next: window.location.pathname}, function (card) {
+                insert(postId, $(card));
+            });
+        };
+        var listen = function (token) {
+            var source = new EventSource(events.data('url') + '?token=' + encodeURIComponent(token));
+            source.addEventListener('post_created', function (message) {
+                var postId = JSON.parse(message.data).post;
+                if ($('#feed[data-live]').length && !$('[data-post-id="' + postId + '"]').length) {
+                    loadCard(message, function (postId, card) {
+                        $('#feed').prepend(card);
+                    });
+                }
+            });
+            source.addEventListener('comments_changed', function (message) {
+                if ($('[data-post-id="' + JSON.parse(message.data).post + '"]').length) {
+                    loadCard(message, function (postId, card) {
+                        $('[data-post-id="' + postId + '"]').replaceWith(card);
+                    });
+                }
+            });
+            source.addEventListener('post_deleted', function (message) {
+                $('[data-post-id="' + JSON.parse(message.data).post + '"]').remove();
+            });
+            // The stream closes when its token expired or was revoked, open it again with a new one
+            source.onerror = function () {
+                if (source.readyState === EventSource.CLOSED) {
+                    setTimeout(function () {
+                        $.getJSON(events.data('token-url'), function (data) {
+                            listen(data.token);
+                        });
+                    }, 5000);
+                }
+            };
+        };
+        listen(events.data('token'));
+    }
 });
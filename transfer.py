@@ -0,0 +1,152 @@
+import itertools
+import time
+from bson import json_util
+from pymongo.errors import BulkWriteError
+from models import User, Circle, Post, Comment, cache
+
+BATCH_SIZE = 1000
+# Progress is reported every this many documents of a collection, and when a collection is done
+PROGRESS_EVERY = 10000
+DUPLICATE_KEY = 11000
+
+# Collections in the order they are exported and must be imported, so that referenced documents come first
+MODELS = [User, Circle, Post, Comment]
+# Reference fields of each collection, single references and lists of references
+REFERENCES = {
+    User: [],
+    Circle: ['owner', 'members'],
+    Post: ['author', 'circles'],
+    Comment: ['author', 'post', 'ancestors']
+}
+
+
+def _natural_key(document_class, document):
+    """
+    :return (dict|None): filter on the unique fields of a document other than _id, None if there are none
+    """
+    if document_class is User:
+        return {'user_id': document['user_id']}
+    if document_class is Circle:
+        return {'owner': document['owner'], 'name': document['name']}
+    return None
+
+
+def _batches(iterable):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def export_documents(output, progress=None):
+    """
+    Write all users, circles, posts and comments as NDJSON, one {"collection": ..., "document": ...} line per document
+    Documents are written as stored, with their ObjectIds, in Extended JSON. Tombstones are left out
+    :param (file) output: text stream to write to
+    :param (callable) progress: called with the collection name, the number of documents so far and the elapsed seconds
+    :return (dict[str, int]): number of exported documents by collection name
+    """
+    counts = {}
+    for document_class in MODELS:
+        collection = document_class._get_collection()
+        start = time.perf_counter()
+        count = 0
+        for document in collection.find({'deleted': {'$ne': True}}).batch_size(BATCH_SIZE):
+            output.write(json_util.dumps(
+                {'collection': collection.name, 'document': document}, json_options=json_util.RELAXED_JSON_OPTIONS))
+            output.write('\n')
+            count += 1
+            if progress and count % PROGRESS_EVERY == 0:
+                progress(collection.name, count, time.perf_counter() - start)
+        if progress:
+            progress(collection.name, count, time.perf_counter() - start)
+        counts[collection.name] = count
+    return counts
+
+
+def _remap(document_class, document, remapped):
+    for field in REFERENCES[document_class]:
+        value = document.get(field)
+        if isinstance(value, list):
+            document[field] = [remapped.get(id, id) for id in value]
+        elif value is not None:
+            document[field] = remapped.get(value, value)
+
+
+def _insert(document_class, documents, remapped):
+    """
+    Insert a batch of documents, unordered
+    A document whose _id exists is taken as imported before and skipped. A document that collides on another unique key,
+        a user id or the name of a circle of the same owner, is taken as the existing document:
+        it is skipped and references to it are remapped to the existing one
+    :return (int, int, int): number of inserted, skipped and remapped documents
+    """
+    collection = document_class._get_collection()
+    try:
+        inserted = collection.insert_many(documents, ordered=False).inserted_ids
+        return len(inserted), 0, 0
+    except BulkWriteError as e:
+        failed = [error['op'] for error in e.details['writeErrors']]
+        other_errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY]
+        if other_errors:
+            raise
+    failed_ids = [op['_id'] for op in failed]
+    existing_ids = {document['_id'] for document in collection.find({'_id': {'$in': failed_ids}}, {'_id': 1})}
+    colliding = [op for op in failed if op['_id'] not in existing_ids]
+    keys = [_natural_key(document_class, op) for op in colliding]
+    if colliding and None in keys:
+        raise ValueError('{} documents collided on an unknown unique key'.format(collection.name))
+    if colliding:
+        fields = list(keys[0])
+        existing = {
+            tuple(document[field] for field in fields): document['_id']
+            for document in collection.find({'$or': keys}, dict.fromkeys(fields, 1))
+        }
+        for op, key in zip(colliding, keys):
+            remapped[op['_id']] = existing[tuple(key[field] for field in fields)]
+    return len(documents) - len(failed), len(existing_ids), len(colliding)
+
+
+def import_documents(lines, progress=None):
+    """
+    Insert documents from NDJSON lines written by export_documents, in batches
+    Lines are read as they come and memory stays constant, except for the ids of remapped documents, see _insert.
+        Collections must come in the order of MODELS
+    Counters are imported as they are, run migrations.reconcile_counters afterwards to count documents of remapped users and posts
+    :param (iterable[str]) lines: NDJSON lines
+    :param (callable) progress: called with the collection name, the number of documents so far and the elapsed seconds
+    :return (dict[str, dict[str, int]]): number of inserted, skipped and remapped documents by collection name
+    """
+    classes = {document_class._get_collection_name(): document_class for document_class in MODELS}
+    records = (json_util.loads(line) for line in lines if line.strip())
+    remapped = {}
+    counts = {}
+    last_index = 0
+    for name, group in itertools.groupby(records, key=lambda record: record['collection']):
+        if name not in classes:
+            raise ValueError('unknown collection {}'.format(name))
+        document_class = classes[name]
+        if MODELS.index(document_class) < last_index:
+            raise ValueError('{} documents came after documents that reference them'.format(name))
+        last_index = MODELS.index(document_class)
+        collection_counts = counts.setdefault(name, {'inserted': 0, 'skipped': 0, 'remapped': 0})
+        start = time.perf_counter()
+        reported = sum(collection_counts.values())
+        for batch in _batches(record['document'] for record in group):
+            for document in batch:
+                _remap(document_class, document, remapped)
+            inserted, skipped, remapped_count = _insert(document_class, batch, remapped)
+            collection_counts['inserted'] += inserted
+            collection_counts['skipped'] += skipped
+            collection_counts['remapped'] += remapped_count
+            if document_class is User:
+                cache.invalidate(*['user_id:{}'.format(document['user_id']) for document in batch])
+            count = sum(collection_counts.values())
+            if progress and count // PROGRESS_EVERY > reported // PROGRESS_EVERY:
+                progress(name, count, time.perf_counter() - start)
+            reported = count
+        if progress:
+            progress(name, sum(collection_counts.values()), time.perf_counter() - start)
+    return counts
@@ -0,0 +1,83 @@
+import io
+from unittest.mock import patch
+from models_test import MongomockTestCase
+from models import User, Circle, Post, Comment
+from transfer import export_documents, import_documents
+
+
+class TransferTests(MongomockTestCase):
+    def __init__(self, *args, **kwargs):
+        super(TransferTests, self).__init__(*args, **kwargs)
+        self._mongo_document_classes.extend([User, Circle, Post, Comment])
+
+    def setUp(self):
+        super(TransferTests, self).setUp()
+        User.create('alice', 'password')
+        User.create('bob', 'password')
+        self.alice = User.find('alice')
+        self.bob = User.find('bob')
+        self.alice.create_circle('friends')
+        self.friends = Circle.objects.get(name='friends')
+        self.alice.toggle_member(self.friends, self.bob)
+        self.post = self.alice.create_post('post', False, [self.friends])
+        self.comment = self.bob.create_comment('comment', self.post)
+        self.reply = self.alice.create_nested_comment('reply', self.comment, self.post)
+
+    def _export(self):
+        output = io.StringIO()
+        export_documents(output)
+        return output.getvalue().splitlines()
+
+    def _drop(self):
+        for document_class in [User, Circle, Post, Comment]:
+            document_class._get_collection().delete_many({})
+
+    def test_round_trip(self):
+        lines = self._export()
+        self.assertEqual(len(lines), 6)
+        self._drop()
+        with patch('transfer.BATCH_SIZE', 2):
+            counts = import_documents(iter(lines))
+        self.assertEqual(counts['post'], {'inserted': 1, 'skipped': 0, 'remapped': 0})
+        self.assertEqual(counts['comment']['inserted'], 2)
+        self.assertEqual(User.check('bob', 'password').id, self.bob.id)
+        post = Post.objects.get(id=self.post.id)
+        self.assertEqual(post.created_at, self.post.created_at)
+        self.assertEqual(post.comment_count, 2)
+        self.assertTrue(User.find('bob').sees_post(post))
+        self.assertEqual([comment.id for comment in post.comments], [self.comment.id])
+        self.assertEqual([reply.id for reply in post.comments[0].comments], [self.reply.id])
+
+    def test_import_twice(self):
+        lines = self._export()
+        counts = import_documents(iter(lines))
+        self.assertEqual(counts['user'], {'inserted': 0, 'skipped': 2, 'remapped': 0})
+        self.assertEqual(Comment.objects.count(), 2)
+
+    def test_remap_to_existing_user(self):
+        lines = self._export()
+        self._drop()
+        User.create('alice', 'other password')
+        existing_alice = User.find('alice')
+        counts = import_documents(iter(lines))
+        self.assertEqual(counts['user'], {'inserted': 1, 'skipped': 0, 'remapped': 1})
+        self.assertEqual(User.objects.count(), 2)
+        self.assertEqual(Circle.objects.get(id=self.friends.id).owner.id, existing_alice.id)
+        self.assertEqual(Post.objects.get(id=self.post.id).author.id, existing_alice.id)
+        self.assertEqual(Comment.objects.get(id=self.reply.id).author.id, existing_alice.id)
+
+    def test_tombstones_are_not_exported(self):
+        with patch('models.cleaner.submit'):
+            self.bob.delete_comment(self.comment, self.post)
+        self.assertEqual(len(self._export()), 5)
+
+    def test_order(self):
+        lines = self._export()
+        self._drop()
+        with self.assertRaises(ValueError):
+            import_documents(reversed(lines))
+
+    def test_progress(self):
+        reports = []
+        import_documents(iter(self._export()), lambda collection, count, seconds: reports.append((collection, count)))
+        self.assertEqual(reports, [('user', 2), ('circle', 1), ('post', 1), ('comment', 2)])
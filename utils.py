@@ -1,6 +1,7 @@
 from flask import flash, redirect
 from wtforms.validators import Optional, DataRequired
 from urllib.parse import urlparse, urljoin
+from bson.objectid import ObjectId
 
 
 def flash_error(error_msg):
@@ -30,6 +31,12 @@ def redirect_back(request, default_target):
         return redirect(redirect_target)
 
 
+def parse_cursor(cursor):
+    if cursor and ObjectId.is_valid(cursor):
+        return ObjectId(cursor)
+    return None
+
+
 class DataRequiredIf(object):
     """Validates field conditionally.
 
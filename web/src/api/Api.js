@@ -1,8 +1,10 @@
 import axios from 'axios'
 import ApiError from './ApiError'
-import {cookieExists, getCookie, setCookie} from "./authCookie";
+import {cookieExists, getCookie, setCookie, getRefreshCookie, setRefreshCookie} from "./authCookie";
 require('promise.prototype.finally').shim();
 axios.defaults.validateStatus = () => {return true}
+// Sends token refreshes and the requests repeated after them, past the interceptor of Api
+const uninterceptedAxios = axios.create()
 
 class ThenBuilder {
   constructor() {
@@ -43,6 +45,27 @@ class ThenBuilder {
 export default class Api {
   constructor(endpoint) {
     this.endpoint = endpoint
+    // Access tokens expire quickly, on a 401 exchange the refresh token for a new one and send the request again
+    axios.interceptors.response.use(res => {
+      if (res.status !== 401 || getRefreshCookie() === undefined) {
+        return res
+      }
+      return uninterceptedAxios.post(
+        `${this.endpoint}/refresh`,
+        null,
+        {
+          headers: {'Authorization': `Bearer ${getRefreshCookie()}`}
+        }
+      ).then(refreshed => {
+        if (refreshed.status !== 200) {
+          return res
+        }
+        setCookie(refreshed.data['access_token'])
+        return uninterceptedAxios(Object.assign({}, res.config, {
+          headers: Object.assign({}, res.config.headers, Api.authorizedHeaders())
+        }))
+      })
+    })
   }
 
   signUp(id, password) {
@@ -75,8 +98,9 @@ export default class Api {
       ).then(
         new ThenBuilder()
           .addResolve(200, res => {
-            const {'access_token': accessToken} = res.data
+            const {'access_token': accessToken, 'refresh_token': refreshToken} = res.data
             setCookie(accessToken)
+            setRefreshCookie(refreshToken)
           })
           .addReject(401, () => {return new ApiError(401)})
           .build(resolve, reject)
@@ -137,7 +161,7 @@ export default class Api {
       ).then(
         new ThenBuilder()
           .addResolve(200, res => {
-            return res.data
+            return res.data['users']
           })
           .addReject(401, () => {return new ApiError(401)})
           .build(resolve, reject)
@@ -1,6 +1,7 @@
 import Cookies from 'universal-cookie';
 
 const CookieKey = 'access_token'
+const RefreshCookieKey = 'refresh_token'
 const CookiePath = '/'
 
 export const cookieExists = () => {
@@ -18,7 +19,18 @@ export const setCookie = (accessToken) => {
   cookies.set(CookieKey, accessToken, { path: CookiePath })
 }
 
+export const getRefreshCookie = () => {
+  const cookies = new Cookies();
+  return cookies.get(RefreshCookieKey)
+}
+
+export const setRefreshCookie = (refreshToken) => {
+  const cookies = new Cookies();
+  cookies.set(RefreshCookieKey, refreshToken, { path: CookiePath })
+}
+
 export const removeCookie = () => {
   const cookies = new Cookies();
   cookies.remove(CookieKey, { path: CookiePath })
+  cookies.remove(RefreshCookieKey, { path: CookiePath })
 }